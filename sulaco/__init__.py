@@ -1,8 +1,18 @@
 
 LOCATION_CONNECTED_PREFIX = 'location_added:'
 LOCATION_DISCONNECTED_PREFIX = 'location_disconnected:'
+LOCATION_MOVED_PREFIX = 'location_moved:'
+LOCATION_LOADS_PREFIX = 'location_loads:'
 PUBLIC_MESSAGE_FROM_LOCATION_PREFIX = 'public_message_from_location:'
 PRIVATE_MESSAGE_FROM_LOCATION_PREFIX = 'private_message_from_location:'
+MULTICAST_MESSAGE_FROM_LOCATION_PREFIX = 'multicast_message_from_location:'
+# an input frame with the topic is echoed by the location
+PROBE_FROM_LOCATION_PREFIX = 'probe_from_location:'
+# the body of an echo from the source of a migrated location,
+# otherwise it's None
+SOURCE_PROBE_ECHO = 'source'
+# an input frame from an outer server that receives a moved location
+MOVE_CONFIRMED_PREFIX = 'move_confirmed:'
 
 # messages
 GET_LOCATIONS_INFO = 'get_locations_info'
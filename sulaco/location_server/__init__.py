@@ -2,3 +2,8 @@
 CONNECT_MESSAGE = 'location_connect_message'
 DISCONNECT_MESSAGE = 'location_disconnect_message'
 HEARTBEAT_MESSAGE = 'location_heartbeat_message'
+MOVE_MESSAGE = 'location_move_message'
+
+# migration requests
+MIGRATE_REQUEST = 'migrate'
+MIGRATE_COMMIT = 'commit'
@@ -3,93 +3,337 @@ import msgpack
 import logging
 import zmq
 
+from time import perf_counter
 from functools import partial
 from zmq.error import NotDone
 from zmq.eventloop.zmqstream import ZMQStream
+from zmq.utils.monitor import parse_monitor_message
+from tornado.gen import coroutine
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.stack_context import ExceptionStackContext
 
 from sulaco import (PUBLIC_MESSAGE_FROM_LOCATION_PREFIX,
-                    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX)
-from sulaco.utils import Sender
-from sulaco.utils.receiver import root_dispatch, INTERNAL_SIGN
+                    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
+                    MULTICAST_MESSAGE_FROM_LOCATION_PREFIX,
+                    PROBE_FROM_LOCATION_PREFIX,
+                    MOVE_CONFIRMED_PREFIX)
+from sulaco.utils import Sender, trace
+from sulaco.utils.trace import Tracer
+from sulaco.utils.lag import LagMonitor
+from sulaco.utils.rpc import request
+from sulaco.utils.stats import Stats
 from sulaco.location_server import (
     CONNECT_MESSAGE, DISCONNECT_MESSAGE,
     HEARTBEAT_MESSAGE)
+from sulaco.location_server.migration import MigrationServer, take_over
+from sulaco.location_server.tick import TickScheduler
 
 
 logger = logging.getLogger(__name__)
 
+STATS_COMPONENT = 'gateway'
+PROBE_PREFIX = PROBE_FROM_LOCATION_PREFIX.encode('utf-8')
+PROBE_BODY = msgpack.dumps(None)
+MOVE_CONFIRMED = MOVE_CONFIRMED_PREFIX.encode('utf-8')
+
+
+@coroutine
+def register_location(context, config, ident, data):
+    """
+    Resolves to False if the location manager refuses the location
+    or doesn't reply (location.register_timeout and
+    location.register_retries bound the waiting)
+    """
+
+    conf = config.location
+    start = perf_counter()
+    reply = yield request(context, config.location_manager.rep_address,
+                          [CONNECT_MESSAGE, ident, msgpack.dumps(data)],
+                          conf.get('register_timeout', 5),
+                          conf.get('register_retries', 2))
+    if reply is None:
+        logger.error("Location manager didn't register location '%s'", ident)
+        return False
+    connected = msgpack.loads(reply[0], encoding='utf-8')
+    if connected:
+        elapsed = perf_counter() - start
+        Stats.instance().gauge('sulaco_time_to_ready_seconds',
+                               lambda: elapsed, component='gateway',
+                               location=ident)
+        logger.info("Location '%s' is registered in %.3f seconds",
+                    ident, elapsed)
+    return connected
+
+
+def run_with_heartbeats(config, push_to_man, loads, ioloop=None):
+    """
+    Runs the IOLoop and sends one heartbeat for all locations
+    periodically. `loads` is a callable that returns {ident: load},
+    last and maximum lag of the IOLoop since the previous heartbeat
+    are added to every load. On exit or SIGTERM the locations
+    are disconnected.
+    """
+
+    ioloop = ioloop or IOLoop.instance()
+    lag_monitor = LagMonitor.instance()
+    def heartbeat():
+        current = loads()
+        if not current:
+            return
+        lag = lag_monitor.lag
+        max_lag = lag_monitor.take_peak()
+        for load in current.values():
+            load['lag'] = lag
+            load['max_lag'] = max_lag
+        push_to_man.send_multipart([HEARTBEAT_MESSAGE.encode('utf-8'),
+                                    msgpack.dumps(current)])
+    period = config.location.heartbeat_period * 1000
+    PeriodicCallback(heartbeat, period).start()
+
+    def stop(signum, frame):
+        ioloop.stop()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        ioloop.start()
+    finally:
+        parts = [DISCONNECT_MESSAGE.encode('utf-8')]
+        parts.extend(ident.encode('utf-8') for ident in loads())
+        if len(parts) > 1:
+            try:
+                push_to_man.send_multipart(parts, copy=False,
+                                           track=True).wait(2)
+            except NotDone:
+                pass
+
+
+class SubscriberCount(object):
+    """ Number of connections (outer servers) of a PUB socket """
+
+    def __init__(self, pub_sock):
+        self.count = 0
+        monitor = pub_sock.get_monitor_socket(zmq.EVENT_ACCEPTED |
+                                              zmq.EVENT_DISCONNECTED)
+        ZMQStream(monitor).on_recv(self._on_event)
+
+    def _on_event(self, parts):
+        event = parse_monitor_message(parts)['event']
+        if event == zmq.EVENT_ACCEPTED:
+            self.count += 1
+        elif event == zmq.EVENT_DISCONNECTED:
+            self.count = max(self.count - 1, 0)
+
 
 class Gateway(object):
+    """
+    Root of a location that can be migrated to another process
+    (see sulaco.location_server.migration) should implement
+    snapshot() and restore(state).
+    """
 
     def __init__(self, config, ident, data={}):
         self._config = config
         self._ident = ident
         self.data = data
+        self.busy = 0 # seconds spent in handlers, for load accounting
+        self.migration = None # OutgoingMigration while moving out
+        self.incoming = None # IncomingMigration while moving in
+        self.subscribers = None # SubscriberCount of the publisher
+        self.interest = None # InterestGrid with users as observers
+        self.ticks = None # TickScheduler in tick mode
+        self._output = None # topic -> bodies while output is batched
 
     def setup(self, root):
         self._root = root
 
-    def connect(self, pub_address, pull_address):
-        context = zmq.Context()
-        req_socket = context.socket(zmq.REQ)
-        req_socket.connect(self._config.location_manager.rep_address)
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def ident(self):
+        return self._ident
+
+    def _registration_data(self, pub_address, pull_address,
+                           migration_address):
         data = self.data.copy()
         data.update(ident=self._ident,
                     pub_address=pub_address,
                     pull_address=pull_address)
-        req_socket.send(CONNECT_MESSAGE.encode('utf-8'), zmq.SNDMORE)
-        req_socket.send(self._ident.encode('utf-8'), zmq.SNDMORE)
-        req_socket.send(msgpack.dumps(data))
-        connected = msgpack.loads(req_socket.recv(), encoding='utf-8')
-        req_socket.close()
+        if migration_address is not None:
+            data['migration_address'] = migration_address
+        return data
+
+    def connect(self, pub_address, pull_address, migration_address=None):
+        """
+        Returns False if the location manager refuses the location,
+        runs the IOLoop until the reply (use connect_async while
+        the IOLoop is running). With migration_address the location
+        can be migrated out.
+        """
+
+        return IOLoop.instance().run_sync(partial(
+            self.connect_async, pub_address, pull_address, migration_address))
+
+    @coroutine
+    def connect_async(self, pub_address, pull_address,
+                      migration_address=None):
+        """ Resolves to True when the location is registered """
+
+        context = zmq.Context()
+        data = self._registration_data(pub_address, pull_address,
+                                       migration_address)
+        connected = yield register_location(context, self._config,
+                                            self._ident, data)
         if not connected:
             return False
+        self._bind(context, pub_address, pull_address, migration_address)
+        return True
+
+    @coroutine
+    def migrate(self, pub_address, pull_address, migration_address=None,
+                timeout=5):
+        """ Moves the running location to this process """
 
+        context = zmq.Context()
+        self._bind(context, pub_address, pull_address, migration_address)
+        data = self._registration_data(pub_address, pull_address,
+                                       migration_address)
+        moved = yield take_over(context, self._config, self, data, timeout)
+        return moved
+
+    def _bind(self, context, pub_address, pull_address, migration_address):
         self._push_to_man = context.socket(zmq.PUSH)
         self._push_to_man.connect(self._config.location_manager.pull_address)
 
         self._pub_sock = context.socket(zmq.PUB)
         self._pub_sock.bind(pub_address)
+        self.subscribers = SubscriberCount(self._pub_sock)
 
         self._pull_sock = context.socket(zmq.PULL)
         self._pull_sock.bind(pull_address)
         ZMQStream(self._pull_sock).on_recv(self._receive)
-        return True
+
+        if migration_address is not None:
+            def get_gateway(ident):
+                return self if ident == self._ident else None
+            def on_migrated(gateway):
+                IOLoop.instance().stop()
+            MigrationServer(context, migration_address,
+                            get_gateway, on_migrated)
+
+    @property
+    def migrated(self):
+        """ True after the location is committed to another process """
+
+        return self.migration is not None and self.migration.committed
+
+    def finish_migration(self):
+        self.migration = None
 
     def start(self, ioloop=None):
-        ioloop = ioloop or IOLoop.instance()
-        def heartbeat():
-            parts = (HEARTBEAT_MESSAGE.encode('utf-8'),
-                     self._ident.encode('utf-8'))
-            self._push_to_man.send_multipart(parts)
-        period = self._config.location.heartbeat_period * 1000
-        PeriodicCallback(heartbeat, period).start()
-
-        def stop(signum, frame):
-            ioloop.stop()
-        signal.signal(signal.SIGTERM, stop)
-        try:
-            ioloop.start()
-        finally:
-            parts = (DISCONNECT_MESSAGE.encode('utf-8'),
-                     self._ident.encode('utf-8'))
-            try:
-                self._push_to_man.send_multipart(parts, copy=False,
-                                                    track=True).wait(2)
-            except NotDone:
-                pass
+        run_with_heartbeats(self._config, self._push_to_man,
+                            lambda: {} if self.migrated
+                                    else {self._ident: self.load()},
+                            ioloop)
+
+    def load(self):
+        """
+        Load reported with heartbeats: number of users (root's
+        user_count() if it's implemented, otherwise observers
+        of the area of interest) and input queued for the next tick
+        """
+
+        user_count = getattr(self._root, 'user_count', None)
+        if user_count is not None:
+            users = user_count()
+        elif self.interest is not None:
+            users = len(self.interest)
+        else:
+            users = 0
+        queue = 0 if self.ticks is None else self.ticks.queued
+        return {'users': users, 'queue': queue}
 
     def _receive(self, parts):
-        assert len(parts) == 1
-        message = msgpack.loads(parts[0], encoding='utf-8')
-        logger.debug("Received message: %s", message)
-        path = message['path'].split('.')
-        kwargs = message['kwargs']
-        sign = message['sign']
+        """ Every frame is a message, several frames come as a batch """
+
         with ExceptionStackContext(self.exception_handler):
-            root_dispatch(self._root, path, kwargs, sign)
+            for data in parts:
+                self.input(data)
+
+    def input(self, data):
+        migration = self.migration
+        if migration is not None:
+            migration.input(data)
+        elif self.incoming is not None:
+            self.incoming.input(data)
+        elif data.startswith(MOVE_CONFIRMED):
+            # a late confirmation of the move, see IncomingMigration
+            pass
+        elif self.ticks is not None and not data.startswith(PROBE_PREFIX):
+            self.ticks.queue(data)
+        else:
+            self.dispatch_input(data)
+
+    def enable_ticks(self, rate, systems=(), ioloop=None):
+        """ Switches the location to tick mode, rate is ticks per second """
+
+        self.ticks = TickScheduler(self, rate, systems, ioloop)
+        self.ticks.start()
+        return self.ticks
+
+    def begin_output(self):
+        """ Messages are kept until flush_output """
+
+        if self._output is None:
+            self._output = {}
+
+    def flush_output(self):
+        """
+        Sends kept messages, messages with the same topic (recipient)
+        go as one multipart message in the order they were produced
+        """
+
+        output, self._output = self._output, None
+        if not output:
+            return
+        send = self._pub_sock.send_multipart
+        for topic, bodies in output.items():
+            bodies.insert(0, topic)
+            send(bodies)
+
+    def dispatch_input(self, data):
+        """ Dispatches an encoded input message to the root at once """
+
+        if data.startswith(PROBE_PREFIX):
+            self.echo_probe(data)
+            return
+        context = None
+        start = perf_counter()
+        try:
+            message = msgpack.loads(data, encoding='utf-8')
+            logger.debug("Received message: %s", message)
+            path = message['path'].split('.')
+            kwargs = message['kwargs']
+            sign = message['sign']
+            pstats = Stats.instance().path(STATS_COMPONENT, message['path'])
+            context = message.get('trace')
+            if context is not None:
+                previous = trace.activate(context)
+                trace.hop(context, trace.LOCATION_RECEIVE)
+            pstats.dispatch(self._root, path, kwargs, sign, len(data))
+        except Exception:
+            # a malformed message is dropped,
+            # the rest of the batch is still dispatched
+            logger.exception('Exception in message handler')
+        self.busy += perf_counter() - start
+        if context is not None:
+            trace.activate(previous)
+            Tracer.instance().finish(context, trace.LOCATION_DONE)
+
+    def echo_probe(self, data, body=PROBE_BODY):
+        # subscriptions of an outer server reach the publisher,
+        # see LocationMessageManager.probe
+        self._pub_sock.send_multipart((data, body))
 
     def exception_handler(self, type, value, traceback):
         logger.exception('Exception in message handler')
@@ -98,8 +342,36 @@ class Gateway(object):
     def private_message(self, uid, msg):
         topic = '{}{}:{}'.format(PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
                                                 self._ident, str(uid))
-        self._pub_sock.send(topic.encode('utf-8'), zmq.SNDMORE)
-        self._pub_sock.send(msgpack.dumps(msg))
+        self._send_pub(topic, msg)
+
+    def multicast_message(self, uids, msg):
+        """
+        Sends the same private message to several users,
+        it is encoded and published once
+        """
+
+        topic = MULTICAST_MESSAGE_FROM_LOCATION_PREFIX + self._ident
+        self._send_pub(topic, msg, {'uids': [str(uid) for uid in uids],
+                                    'msg': msg})
+
+    def _send_pub(self, topic, msg, payload=None):
+        context = trace.stamp(msg, trace.LOCATION_PUBLISH)
+        if context is not None and payload is not None:
+            payload['trace'] = msg.pop('trace')
+        body = msgpack.dumps(msg if payload is None else payload)
+        output = self._output
+        if output is not None:
+            topic = topic.encode('utf-8')
+            bodies = output.get(topic)
+            if bodies is None:
+                output[topic] = [body]
+            else:
+                bodies.append(body)
+        else:
+            self._pub_sock.send(topic.encode('utf-8'), zmq.SNDMORE)
+            self._pub_sock.send(body)
+        pstats = Stats.instance().path(STATS_COMPONENT, msg['path'])
+        pstats.response_bytes.observe(len(body))
 
     def prs(self, uid):
         """ Returns private sender """
@@ -107,10 +379,31 @@ class Gateway(object):
         send = partial(self.private_message, uid)
         return Sender(send)
 
+    def mcs(self, uids):
+        """ Returns multicast sender """
+
+        send = partial(self.multicast_message, uids)
+        return Sender(send)
+
+    def area_message(self, x, y, msg, exclude=None):
+        """
+        Sends the message to users whose area of interest
+        (see sulaco.location_server.interest) covers the point
+        """
+
+        uids = self.interest.observers(x, y, exclude)
+        if uids:
+            self.multicast_message(uids, msg)
+
+    def aoi(self, x, y, exclude=None):
+        """ Returns area-of-interest sender """
+
+        send = partial(self.area_message, x, y, exclude=exclude)
+        return Sender(send)
+
     def public_message(self, msg):
         topic = PUBLIC_MESSAGE_FROM_LOCATION_PREFIX + self._ident
-        self._pub_sock.send(topic.encode('utf-8'), zmq.SNDMORE)
-        self._pub_sock.send(msgpack.dumps(msg))
+        self._send_pub(topic, msg)
 
     @property
     def pubs(self):
@@ -118,3 +411,150 @@ class Gateway(object):
 
         return Sender(self.public_message)
 
+    def use_publisher(self, pub_sock, subscribers=None):
+        """
+        Publishes through a PUB socket shared with other locations,
+        see MultiLocationGateway
+        """
+
+        self._pub_sock = pub_sock
+        self.subscribers = subscribers
+
+
+class MultiLocationGateway(object):
+    """
+    Hosts many locations in one process behind shared PUB and PULL
+    sockets. Every location is registered in the location manager
+    with the same addresses and publishes on its own topics, so
+    outer servers see ordinary locations. Input frames come in pairs
+    of location ident and message. All locations share one heartbeat.
+
+    Locations are added as set up Gateway instances
+    that aren't connected on their own.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._gateways = {}
+        self._context = zmq.Context()
+
+    def connect(self, pub_address, pull_address, migration_address=None):
+        context = self._context
+        self._pub_address = pub_address
+        self._pull_address = pull_address
+        self._migration_address = migration_address
+
+        self._push_to_man = context.socket(zmq.PUSH)
+        self._push_to_man.connect(self._config.location_manager.pull_address)
+
+        self._pub_sock = context.socket(zmq.PUB)
+        self._pub_sock.bind(pub_address)
+        self._subscribers = SubscriberCount(self._pub_sock)
+
+        self._pull_sock = context.socket(zmq.PULL)
+        self._pull_sock.bind(pull_address)
+        ZMQStream(self._pull_sock).on_recv(self._receive)
+
+        if migration_address is not None:
+            MigrationServer(context, migration_address,
+                            self._gateways.get, self._on_migrated)
+
+    def _registration_data(self, gateway):
+        data = gateway._registration_data(self._pub_address,
+                                          self._pull_address,
+                                          self._migration_address)
+        data['routed_input'] = True
+        return data
+
+    def add_location(self, gateway):
+        """
+        Returns False if the location manager refuses the location,
+        runs the IOLoop until the reply (use add_location_async while
+        the IOLoop is running)
+        """
+
+        return IOLoop.instance().run_sync(
+            partial(self.add_location_async, gateway))
+
+    @coroutine
+    def add_location_async(self, gateway):
+        """ Resolves to True when the location is registered """
+
+        ident = gateway.ident
+        assert ident not in self._gateways, 'location already exists'
+        data = self._registration_data(gateway)
+        connected = yield register_location(self._context, self._config,
+                                            ident, data)
+        if not connected:
+            return False
+        gateway.use_publisher(self._pub_sock, self._subscribers)
+        self._gateways[ident] = gateway
+        return True
+
+    @coroutine
+    def take_over(self, gateway, timeout=5):
+        """ Resolves to True when the running location is moved here """
+
+        ident = gateway.ident
+        assert ident not in self._gateways, 'location already exists'
+        gateway.use_publisher(self._pub_sock, self._subscribers)
+        self._gateways[ident] = gateway
+        data = self._registration_data(gateway)
+        moved = yield take_over(self._context, self._config, gateway,
+                                data, timeout)
+        if moved:
+            return True
+        del self._gateways[ident]
+        return False
+
+    def _on_migrated(self, gateway):
+        del self._gateways[gateway.ident]
+        self.on_migrated(gateway)
+
+    def on_migrated(self, gateway):
+        """ Called when a location moved out stops forwarding input """
+
+    def remove_location(self, ident):
+        gateway = self._gateways.pop(ident)
+        parts = (DISCONNECT_MESSAGE.encode('utf-8'), ident.encode('utf-8'))
+        self._push_to_man.send_multipart(parts)
+        return gateway
+
+    @property
+    def gateways(self):
+        return self._gateways.values()
+
+    @property
+    def idents(self):
+        return [ident for ident, gateway in self._gateways.items()
+                if not gateway.migrated]
+
+    def start(self, ioloop=None):
+        gateways = self._gateways
+        run_with_heartbeats(self._config, self._push_to_man,
+                            lambda: {ident: gateways[ident].load()
+                                     for ident in self.idents}, ioloop)
+
+    def _receive(self, parts):
+        if len(parts) % 2:
+            # frames are pairs of ident and message
+            logger.warning('Malformed batch of %s frames is dropped',
+                           len(parts))
+            return
+        gateways = self._gateways
+        with ExceptionStackContext(self.exception_handler):
+            for i in range(0, len(parts), 2):
+                try:
+                    ident = parts[i].decode('utf-8')
+                except UnicodeDecodeError:
+                    logger.warning('Malformed location ident: %r', parts[i])
+                    continue
+                gateway = gateways.get(ident)
+                if gateway is None:
+                    logger.warning('Message to unknown location: %s', ident)
+                    continue
+                gateway.input(parts[i + 1])
+
+    def exception_handler(self, type, value, traceback):
+        logger.exception('Exception in message handler')
+        return True
@@ -0,0 +1,148 @@
+from math import floor
+
+
+class InterestGrid(object):
+    """
+    Uniform grid index of entity positions for area-of-interest
+    publishing. Every entity is kept in a square cell of `cell_size`,
+    a move changes the index only when the entity crosses a cell border.
+    Observers are entities with an interest radius (usually users),
+    they get events whose position is within the radius.
+
+    A query scans cells around the point within the largest radius,
+    so `cell_size` should be close to a typical radius.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self._positions = {} # entity -> (x, y)
+        self._radii = {} # observer -> radius
+        self._cells = {} # cell -> set of entities
+        self._observer_cells = {} # cell -> set of observers
+        self._max_radius = 0
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, entity):
+        return entity in self._positions
+
+    def _cell(self, x, y):
+        size = self.cell_size
+        return (floor(x / size), floor(y / size))
+
+    def add(self, entity, x, y, radius=None):
+        assert entity not in self._positions, 'entity already exists'
+        self._positions[entity] = (x, y)
+        cell = self._cell(x, y)
+        _add(self._cells, cell, entity)
+        if radius is not None:
+            self._radii[entity] = radius
+            _add(self._observer_cells, cell, entity)
+            if radius > self._max_radius:
+                self._max_radius = radius
+
+    def remove(self, entity):
+        x, y = self._positions.pop(entity)
+        cell = self._cell(x, y)
+        _discard(self._cells, cell, entity)
+        radius = self._radii.pop(entity, None)
+        if radius is not None:
+            _discard(self._observer_cells, cell, entity)
+            if radius == self._max_radius:
+                self._max_radius = max(self._radii.values(), default=0)
+
+    def move(self, entity, x, y):
+        old_x, old_y = self._positions[entity]
+        self._positions[entity] = (x, y)
+        old_cell = self._cell(old_x, old_y)
+        cell = self._cell(x, y)
+        if cell == old_cell:
+            return
+        _discard(self._cells, old_cell, entity)
+        _add(self._cells, cell, entity)
+        if entity in self._radii:
+            _discard(self._observer_cells, old_cell, entity)
+            _add(self._observer_cells, cell, entity)
+
+    def set_radius(self, entity, radius):
+        """ Makes the entity an observer, None makes it a usual entity """
+
+        x, y = self._positions[entity]
+        self.remove(entity)
+        self.add(entity, x, y, radius)
+
+    def position(self, entity):
+        return self._positions[entity]
+
+    def observers(self, x, y, exclude=None):
+        """ Returns observers whose area of interest covers the point """
+
+        result = []
+        positions = self._positions
+        radii = self._radii
+        for observers in self._scan(self._observer_cells, x, y,
+                                    self._max_radius):
+            for entity in observers:
+                ox, oy = positions[entity]
+                dx = ox - x
+                dy = oy - y
+                radius = radii[entity]
+                if dx * dx + dy * dy <= radius * radius:
+                    result.append(entity)
+        if exclude is not None and exclude in radii:
+            try:
+                result.remove(exclude)
+            except ValueError:
+                pass
+        return result
+
+    def nearby(self, x, y, radius):
+        """ Returns entities within the radius """
+
+        result = []
+        positions = self._positions
+        limit = radius * radius
+        for entities in self._scan(self._cells, x, y, radius):
+            for entity in entities:
+                ex, ey = positions[entity]
+                dx = ex - x
+                dy = ey - y
+                if dx * dx + dy * dy <= limit:
+                    result.append(entity)
+        return result
+
+    def _scan(self, cells, x, y, radius):
+        if not cells:
+            return
+        size = self.cell_size
+        min_x = floor((x - radius) / size)
+        max_x = floor((x + radius) / size)
+        min_y = floor((y - radius) / size)
+        max_y = floor((y + radius) / size)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(cells):
+            # sparse grid, cheaper to check every non-empty cell
+            for (cx, cy), entities in cells.items():
+                if min_x <= cx <= max_x and min_y <= cy <= max_y:
+                    yield entities
+            return
+        get = cells.get
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                entities = get((cx, cy))
+                if entities is not None:
+                    yield entities
+
+
+def _add(cells, cell, entity):
+    entities = cells.get(cell)
+    if entities is None:
+        entities = cells[cell] = set()
+    entities.add(entity)
+
+
+def _discard(cells, cell, entity):
+    entities = cells[cell]
+    entities.discard(entity)
+    if not entities:
+        del cells[cell]
@@ -8,29 +8,62 @@ from zmq.eventloop import zmqstream
 from tornado.ioloop import IOLoop, PeriodicCallback
 
 from sulaco.utils import Config, UTCFormatter, ColorUTCFormatter
+from sulaco.utils.lag import LagMonitor
+from sulaco.utils.stats import Stats, serve_stats
 from zmq.eventloop.ioloop import install
 
 from sulaco import (
     GET_LOCATIONS_INFO,
     LOCATION_DISCONNECTED_PREFIX,
-    LOCATION_CONNECTED_PREFIX)
+    LOCATION_CONNECTED_PREFIX,
+    LOCATION_MOVED_PREFIX,
+    LOCATION_LOADS_PREFIX)
 from sulaco.location_server import (
     DISCONNECT_MESSAGE, HEARTBEAT_MESSAGE,
-    CONNECT_MESSAGE)
+    CONNECT_MESSAGE, MOVE_MESSAGE)
 
 
 logger = logging.getLogger('location_manager')
 
 
-def start_location_manager(config):
+def parse_heartbeat(parts):
+    """
+    Returns {loc_id: load} of a heartbeat, that is a body
+    of {loc_id: load}. Heartbeats of older gateways have only ids
+    of locations, their loads are None.
+    """
+
+    if len(parts) == 2:
+        try:
+            body = msgpack.loads(parts[1], encoding='utf-8')
+        except Exception:
+            body = None
+        if isinstance(body, dict):
+            return {loc_id: load if isinstance(load, dict) else None
+                    for loc_id, load in body.items()}
+    try:
+        return {loc_id.decode('utf-8'): None for loc_id in parts[1:]}
+    except UnicodeDecodeError:
+        logger.warning('Malformed heartbeat: %s', parts)
+        return {}
+
+
+def start_location_manager(config, stats_port=None):
     conf = config.location_manager
     locations = {}
     last_heartbeats = {}
+    loads = {} # reported with heartbeats
     ioloop = IOLoop.instance()
+    stats = Stats.instance()
+    stats.gauge('sulaco_locations', lambda: len(locations))
+    lag_monitor = LagMonitor.from_config(config.get('lag_monitor'))
+    LagMonitor.install(lag_monitor)
+    lag_monitor.start()
 
     def disconnect(loc_id):
         del locations[loc_id]
         del last_heartbeats[loc_id]
+        loads.pop(loc_id, None)
         msg = LOCATION_DISCONNECTED_PREFIX + loc_id
         pub_sock.send_multipart([msg.encode('utf-8'), msgpack.dumps(None)])
         logger.info("Location '%s' disconnected", loc_id)
@@ -40,6 +73,7 @@ def start_location_manager(config):
     def request(stream, parts):
         logger.debug("Parts of request message: %s", parts)
         msg = parts[0].decode('utf-8')
+        stats.incr('sulaco_locman_requests_total', message=msg)
         if msg == CONNECT_MESSAGE:
             loc_id, data = parts[1:]
             loc_id = loc_id.decode('utf-8')
@@ -53,29 +87,67 @@ def start_location_manager(config):
             locations[loc_id] = msgpack.loads(data, encoding='utf-8')
             last_heartbeats[loc_id] = ioloop.time()
             logger.info("Location '%s' connected", loc_id)
+        elif msg == MOVE_MESSAGE:
+            # the location is migrated to another process
+            loc_id, data = parts[1:]
+            loc_id = loc_id.decode('utf-8')
+            if loc_id not in locations:
+                stream.send(msgpack.dumps(False))
+                return
+            stream.send(msgpack.dumps(True))
+            topic = (LOCATION_MOVED_PREFIX + loc_id).encode('utf-8')
+            pub_sock.send(topic, zmq.SNDMORE)
+            pub_sock.send(data)
+            locations[loc_id] = msgpack.loads(data, encoding='utf-8')
+            last_heartbeats[loc_id] = ioloop.time()
+            logger.info("Location '%s' moved", loc_id)
         elif msg == GET_LOCATIONS_INFO:
-            stream.send(msgpack.dumps(locations))
+            if len(parts) == 1:
+                stream.send(msgpack.dumps(locations))
+                return
+            # a page of locations ordered by id after the given one
+            after = parts[1].decode('utf-8')
+            limit = msgpack.loads(parts[2])
+            ids = sorted(loc_id for loc_id in locations if loc_id > after)
+            page = ids[:limit]
+            next_id = page[-1] if len(ids) > limit else None
+            stream.send(msgpack.dumps({
+                'locations': {loc_id: locations[loc_id] for loc_id in page},
+                'next': next_id}))
         else:
             logger.warning('Unknown request message: %s', msg)
 
     def input(parts):
+        # a gateway that hosts several locations sends one message
+        # for all of them, a heartbeat has a load of every location
         logger.debug("Parts of input message: %s", parts)
-        msg, loc_id = parts
-        msg = msg.decode('utf-8')
-        loc_id = loc_id.decode('utf-8')
+        msg = parts[0].decode('utf-8')
+        stats.incr('sulaco_locman_inputs_total', message=msg)
         if msg == HEARTBEAT_MESSAGE:
-            if loc_id not in locations:
-                logger.warning('Unknown location: %s', loc_id)
-                return
-            last_heartbeats[loc_id] = ioloop.time()
+            for loc_id, load in parse_heartbeat(parts).items():
+                if loc_id not in locations:
+                    logger.warning('Unknown location: %s', loc_id)
+                    continue
+                last_heartbeats[loc_id] = ioloop.time()
+                if load is None:
+                    loads.pop(loc_id, None)
+                else:
+                    loads[loc_id] = load
         elif msg == DISCONNECT_MESSAGE:
-            if loc_id not in locations:
-                logger.warning('Unknown location: %s', loc_id)
-                return
-            disconnect(loc_id)
+            for loc_id in parts[1:]:
+                loc_id = loc_id.decode('utf-8')
+                if loc_id not in locations:
+                    logger.warning('Unknown location: %s', loc_id)
+                    continue
+                disconnect(loc_id)
         else:
             logger.warning('Unknown request message: %s', msg)
 
+    def publish_loads():
+        # outer servers place new users by the table
+        pub_sock.send_multipart([LOCATION_LOADS_PREFIX.encode('utf-8'),
+                                 msgpack.dumps(loads)])
+
 
     def heartbeats_checker():
         #TODO: func test for deleting of location by timeout (use SIGKILL)
@@ -101,7 +173,11 @@ def start_location_manager(config):
 
     period = conf.heartbeats_checker_period * 1000
     PeriodicCallback(heartbeats_checker, period).start()
+    period = conf.get('load_publish_period', 1) * 1000
+    PeriodicCallback(publish_loads, period).start()
 
+    if stats_port is not None:
+        serve_stats(stats_port)
     ioloop.start()
 
 
@@ -115,6 +191,9 @@ if __name__ == "__main__":
                         dest='debug', help='set debug level of logging')
     parser.add_argument('-lf', '--log-file', action='store', dest='log_file',
                         help='path to log file', type=str, default=None)
+    parser.add_argument('-sp', '--stats-port', action='store',
+                        dest='stats_port', help='port of stats endpoint',
+                        type=int, default=None)
     options = parser.parse_args()
 
     logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
@@ -127,5 +206,6 @@ if __name__ == "__main__":
         formatter = UTCFormatter()
     handler.setFormatter(formatter)
     logger.addHandler(handler)
-    start_location_manager(Config.load_yaml(options.config))
+    start_location_manager(Config.load_yaml(options.config),
+                           options.stats_port)
 
@@ -0,0 +1,309 @@
+"""
+Live migration of a location between gateway processes.
+
+The target process binds its sockets and asks the source (at the
+migration address that the source registered in the location manager):
+
+1. MIGRATE_REQUEST - the source stops dispatching input of the location,
+   buffers it and replies with the snapshot of the root's state
+   (root.snapshot()). The target restores it (root.restore(state)).
+2. MIGRATE_COMMIT - the source forwards the buffered input to the target
+   and keeps forwarding everything that still comes to it
+   for `forward_period` seconds. The location doesn't send heartbeats
+   from the source anymore. The source replies with the number
+   of subscribers of its publisher (outer servers).
+3. MOVE_MESSAGE to the location manager - it replaces addresses
+   of the location and publishes LOCATION_MOVED_PREFIX, outer servers
+   re-point input sockets and subscriptions of the location.
+   The target keeps the location after the commit and repeats
+   the message until the location manager accepts it (or registers
+   the location anew if it has expired meanwhile).
+
+Outer servers aren't subscribed to the target until they are
+re-pointed, so the target holds input and output of the location
+from the commit (see IncomingMigration) until every subscriber
+of the source confirms that it receives messages of the target
+(MOVE_CONFIRMED_PREFIX) or `timeout` seconds pass after the move.
+An outer server keeps input to the new address until a probe sent
+through the old one is echoed by the target and by the source, so
+the order of input is kept and nothing the source has published
+is lost (see LocationMessageManager.move_location).
+
+If the commit doesn't come in `timeout` seconds after the snapshot,
+the source dispatches the buffered input itself and continues to serve
+the location, so the pause users see is bounded by the timeout.
+"""
+
+import logging
+import msgpack
+import zmq
+
+from datetime import timedelta
+from zmq.eventloop.zmqstream import ZMQStream
+from tornado.concurrent import Future
+from tornado.gen import coroutine, sleep, with_timeout, TimeoutError
+from tornado.ioloop import IOLoop
+
+from sulaco import (GET_LOCATIONS_INFO, PROBE_FROM_LOCATION_PREFIX,
+                    MOVE_CONFIRMED_PREFIX, SOURCE_PROBE_ECHO)
+from sulaco.utils.rpc import request
+from sulaco.utils.stats import Stats
+from sulaco.location_server import (
+    MIGRATE_REQUEST, MIGRATE_COMMIT, MOVE_MESSAGE, CONNECT_MESSAGE)
+
+
+logger = logging.getLogger(__name__)
+
+PROBE_PREFIX = PROBE_FROM_LOCATION_PREFIX.encode('utf-8')
+MOVE_CONFIRMED = MOVE_CONFIRMED_PREFIX.encode('utf-8')
+SOURCE_PROBE_BODY = msgpack.dumps(SOURCE_PROBE_ECHO)
+
+
+class OutgoingMigration(object):
+    """ State of a location that is being moved out of the process """
+
+    def __init__(self, gateway, context, timeout, forward_period,
+                 on_migrated, ioloop=None):
+        self._gateway = gateway
+        self._context = context
+        self.timeout = timeout
+        self.forward_period = forward_period
+        self._on_migrated = on_migrated
+        self._ioloop = ioloop or IOLoop.instance()
+        self._buffer = []
+        self._forward = None
+        self._push = None
+        self._abort_timeout = None
+        self.committed = False
+
+    def start(self):
+        """ Pauses input and returns the encoded snapshot """
+
+        state = self._gateway.root.snapshot()
+        ioloop = self._ioloop
+        self._abort_timeout = ioloop.add_timeout(ioloop.time() + self.timeout,
+                                                 self.abort)
+        return msgpack.dumps(state)
+
+    def input(self, data):
+        if self._forward is None:
+            self._buffer.append(data)
+            return
+        if data.startswith(PROBE_PREFIX):
+            # the echo follows everything the source has published
+            self._gateway.echo_probe(data, SOURCE_PROBE_BODY)
+        self._forward(data)
+
+    def commit(self, target):
+        ioloop = self._ioloop
+        ioloop.remove_timeout(self._abort_timeout)
+        push = self._push = self._context.socket(zmq.PUSH)
+        push.connect(target['pull_address'])
+        if target.get('routed_input'):
+            ident = self._gateway.ident.encode('utf-8')
+            self._forward = lambda data: push.send_multipart((ident, data))
+        else:
+            self._forward = push.send
+        buffered, self._buffer = self._buffer, None
+        for data in buffered:
+            self._forward(data)
+        self.committed = True
+        Stats.instance().incr('sulaco_migrations_total', result='committed')
+        logger.info("Location '%s' is migrated to %s, %s buffered messages "
+                    "are forwarded", self._gateway.ident,
+                    target['pull_address'], len(buffered))
+        ioloop.add_timeout(ioloop.time() + self.forward_period, self._finish)
+        return {'subscribers': self._gateway.subscribers.count}
+
+    def _finish(self):
+        self._push.close()
+        self._on_migrated(self._gateway)
+
+    def abort(self):
+        logger.warning("Migration of location '%s' is aborted",
+                       self._gateway.ident)
+        Stats.instance().incr('sulaco_migrations_total', result='aborted')
+        buffered, self._buffer = self._buffer, None
+        self._gateway.finish_migration()
+        for data in buffered:
+            self._gateway.dispatch_input(data)
+
+
+class IncomingMigration(object):
+    """
+    State of a location that is being moved into the process:
+    input and output are held until outer servers confirm that
+    they receive messages of the location, probes are still echoed
+    """
+
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._held = []
+        self._confirmed = set()
+        self._expected = None
+        self._all_confirmed = Future()
+        gateway.begin_output()
+
+    def input(self, data):
+        if data.startswith(MOVE_CONFIRMED):
+            # repeated confirmations of a server are counted once
+            self._confirmed.add(data)
+            self._check_confirmed()
+        elif data.startswith(PROBE_PREFIX):
+            self._gateway.dispatch_input(data)
+        else:
+            self._held.append(data)
+
+    def wait_confirmed(self, subscribers):
+        """ Resolves when `subscribers` outer servers confirm the move """
+
+        self._expected = subscribers
+        self._check_confirmed()
+        return self._all_confirmed
+
+    def _check_confirmed(self):
+        if (self._expected is not None and
+                len(self._confirmed) >= self._expected and
+                not self._all_confirmed.done()):
+            self._all_confirmed.set_result(len(self._confirmed))
+
+    @property
+    def confirmed(self):
+        return len(self._confirmed)
+
+    def release(self):
+        """ Sends held output and dispatches held input """
+
+        gateway = self._gateway
+        gateway.incoming = None
+        gateway.flush_output()
+        for data in self._held:
+            gateway.input(data)
+        self._held = None
+
+
+class MigrationServer(object):
+    """
+    Serves migration requests for gateways of the process.
+    `get_gateway` returns a gateway by ident or None,
+    `on_migrated` is called with a gateway when it stops forwarding.
+    """
+
+    def __init__(self, context, address, get_gateway, on_migrated,
+                 timeout=5, forward_period=5, ioloop=None):
+        self._context = context
+        self._get_gateway = get_gateway
+        self._on_migrated = on_migrated
+        self.timeout = timeout
+        self.forward_period = forward_period
+        self._ioloop = ioloop
+        sock = context.socket(zmq.REP)
+        sock.bind(address)
+        ZMQStream(sock).on_recv_stream(self._on_request)
+
+    def _on_request(self, stream, parts):
+        try:
+            reply = self.handle(parts)
+        except Exception:
+            logger.exception('Migration request failed')
+            reply = None
+        stream.send(msgpack.dumps(reply))
+
+    def handle(self, parts):
+        command = parts[0].decode('utf-8')
+        ident = parts[1].decode('utf-8')
+        gateway = self._get_gateway(ident)
+        if gateway is None:
+            logger.warning('Migration of unknown location: %s', ident)
+            return None
+        if command == MIGRATE_REQUEST:
+            if gateway.migration is not None:
+                return None
+            migration = OutgoingMigration(gateway, self._context,
+                                          self.timeout, self.forward_period,
+                                          self._on_migrated, self._ioloop)
+            gateway.migration = migration
+            return migration.start()
+        if command == MIGRATE_COMMIT:
+            migration = gateway.migration
+            if migration is None or migration.committed:
+                return False
+            return migration.commit(msgpack.loads(parts[2],
+                                                  encoding='utf-8'))
+        logger.warning('Unknown migration command: %s', command)
+        return None
+
+
+@coroutine
+def take_over(context, config, gateway, data, timeout=5, retry_period=1):
+    """
+    Moves the location to this process, `data` is the registration data
+    with new addresses. The gateway should be set up and its input socket
+    bound. Resolves to False if the location isn't moved. After the commit
+    the location belongs to this process, so the new addresses are sent
+    to the location manager until it accepts them, then the location
+    is held until outer servers confirm the move.
+    """
+
+    ident = gateway.ident
+    rep_address = config.location_manager.rep_address
+    reply = yield request(context, rep_address, [GET_LOCATIONS_INFO], timeout)
+    if reply is None:
+        logger.error('Location manager is not available')
+        return False
+    source = msgpack.loads(reply[0], encoding='utf-8').get(ident)
+    if source is None or source.get('migration_address') is None:
+        logger.error("Location '%s' can't be migrated", ident)
+        return False
+    address = source['migration_address']
+
+    # a repeated request is refused by the source, so no retries
+    reply = yield request(context, address, [MIGRATE_REQUEST, ident],
+                          timeout, retries=0)
+    snapshot = None if reply is None else msgpack.loads(reply[0])
+    if snapshot is None:
+        logger.error("Location '%s' didn't send its snapshot", ident)
+        return False
+    gateway.root.restore(msgpack.loads(snapshot, encoding='utf-8'))
+
+    target = {'pull_address': data['pull_address'],
+              'routed_input': data.get('routed_input', False)}
+    # forwarded input may come before the reply
+    incoming = gateway.incoming = IncomingMigration(gateway)
+    reply = yield request(context, address,
+                          [MIGRATE_COMMIT, ident, msgpack.dumps(target)],
+                          timeout, retries=0)
+    reply = None if reply is None else msgpack.loads(reply[0],
+                                                     encoding='utf-8')
+    if not reply:
+        incoming.release()
+        logger.error("Location '%s' didn't commit the migration", ident)
+        return False
+    subscribers = reply['subscribers']
+
+    # the source forwards input now, outer servers are re-pointed
+    # when the location manager accepts new addresses
+    data = msgpack.dumps(data)
+    message = MOVE_MESSAGE
+    while True:
+        reply = yield request(context, rep_address, [message, ident, data],
+                              timeout)
+        if reply is not None and msgpack.loads(reply[0]):
+            break
+        if reply is not None and message == MOVE_MESSAGE:
+            # the location has expired without heartbeats of the source
+            message = CONNECT_MESSAGE
+            continue
+        logger.error("Location manager didn't accept location '%s', "
+                     "retrying", ident)
+        message = MOVE_MESSAGE
+        yield sleep(retry_period)
+
+    try:
+        yield with_timeout(timedelta(seconds=timeout),
+                           incoming.wait_confirmed(subscribers))
+    except TimeoutError:
+        logger.warning("%s of %s outer servers confirmed location '%s' "
+                       "in time", incoming.confirmed, subscribers, ident)
+    incoming.release()
+    return True
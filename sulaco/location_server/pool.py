@@ -0,0 +1,420 @@
+import signal
+import argparse
+import logging
+import importlib
+import multiprocessing
+import msgpack
+import zmq
+
+from time import process_time
+from collections import deque
+from zmq.eventloop.zmqstream import ZMQStream
+from zmq.eventloop.ioloop import install
+from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from sulaco.utils import Config, ColorUTCFormatter
+from sulaco.utils.stats import Stats, serve_stats
+from sulaco.location_server.gateway import Gateway, MultiLocationGateway
+
+
+logger = logging.getLogger(__name__)
+
+ADD_COMMAND = 'add'
+REMOVE_COMMAND = 'remove'
+MIGRATE_COMMAND = 'migrate'
+LOAD_REPORT = 'load'
+MIGRATED_REPORT = 'migrated'
+
+
+def import_object(name):
+    """ Imports 'package.module:attribute' """
+
+    module, attr = name.split(':', 1)
+    return getattr(importlib.import_module(module), attr)
+
+
+def plan_move(worker_locations, loads, threshold):
+    """
+    Chooses a location to move from the most loaded worker
+    to the least loaded one. `worker_locations` is a list of sets
+    of idents, `loads` maps idents to loads (busy fraction of a core).
+    Returns (ident, source, destination) or None if the difference
+    between the workers doesn't exceed the threshold or no location
+    makes it smaller.
+    """
+
+    if len(worker_locations) < 2:
+        return None
+    totals = [sum(loads.get(ident, 0) for ident in idents)
+              for idents in worker_locations]
+    src = max(range(len(totals)), key=totals.__getitem__)
+    dst = min(range(len(totals)), key=totals.__getitem__)
+    gap = totals[src] - totals[dst]
+    if gap <= threshold:
+        return None
+    # the move is useful while the location is lighter than the gap,
+    # half of the gap evens the workers out
+    candidates = [ident for ident in worker_locations[src]
+                  if 0 < loads.get(ident, 0) < gap]
+    if not candidates:
+        return None
+    ident = min(candidates, key=lambda i: abs(loads[i] - gap / 2))
+    return ident, src, dst
+
+
+class LocationPool(object):
+    """
+    Supervisor of worker processes that host locations
+    with MultiLocationGateway. Locations are assigned to workers
+    round-robin and then moved by measured load: workers report
+    their CPU time and how it is shared between the locations.
+    A location is moved by removing it in one worker and adding
+    in another, that is a usual disconnect and connect for the location
+    manager and outer servers. With `live_migration` the location
+    is migrated with its state instead (roots should support
+    snapshot and restore, see sulaco.location_server.migration).
+    Dead workers are restarted with their locations. Commands wait
+    in a queue of the worker until it connects to its control socket,
+    the queue is flushed on reports of the worker and every second.
+
+    `root_factory` is an import path of a callable that takes
+    a gateway and an ident and returns the location's root. If the root
+    has the close method, it is called when the location is removed.
+    """
+
+    def __init__(self, config_file, root_factory, idents, workers,
+                 host='tcp://127.0.0.1', base_port=9100,
+                 report_period=1, rebalance_period=10, threshold=0.2,
+                 smoothing=0.3, live_migration=False, debug=False):
+        self._config_file = config_file
+        self._root_factory = root_factory
+        self._idents = list(idents)
+        self._workers = workers
+        self._host = host
+        self._base_port = base_port
+        self.report_period = report_period
+        self.rebalance_period = rebalance_period
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.live_migration = live_migration
+        self._debug = debug
+        self._processes = [None] * workers
+        self._controls = [None] * workers
+        self._pending = [deque() for i in range(workers)] # commands
+        self.worker_locations = [set() for i in range(workers)]
+        self.loads = {} # ident -> smoothed load
+        self._migrations = {} # ident -> source worker
+        self._mp = multiprocessing.get_context('spawn')
+        stats = Stats.instance()
+        for index in range(workers):
+            stats.gauge('sulaco_pool_worker_load',
+                        lambda i=index: self.worker_load(i),
+                        worker=index)
+
+    def worker_load(self, index):
+        return sum(self.loads.get(ident, 0)
+                   for ident in self.worker_locations[index])
+
+    def worker_addresses(self, index):
+        """ Returns pub, pull and migration addresses """
+
+        port = self._base_port + index * 3
+        return tuple('{}:{}'.format(self._host, port + i) for i in range(3))
+
+    def start(self, ioloop=None):
+        ioloop = ioloop or IOLoop.instance()
+        self._context = zmq.Context()
+        reports = self._context.socket(zmq.PULL)
+        self._report_address = 'tcp://127.0.0.1:{}'.format(
+                    reports.bind_to_random_port('tcp://127.0.0.1'))
+        ZMQStream(reports).on_recv(self._on_report)
+
+        for index, ident in enumerate(self._idents):
+            self.worker_locations[index % self._workers].add(ident)
+        for index in range(self._workers):
+            self._spawn(index)
+
+        PeriodicCallback(self.rebalance,
+                         self.rebalance_period * 1000).start()
+        PeriodicCallback(self._check_workers, 1000).start()
+
+        def stop(signum, frame):
+            ioloop.stop()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            ioloop.start()
+        finally:
+            for process in self._processes:
+                process.terminate()
+            for process in self._processes:
+                process.join()
+
+    def _spawn(self, index):
+        control = self._controls[index]
+        if control is not None:
+            control.close(linger=0)
+        control = self._controls[index] = self._context.socket(zmq.PUSH)
+        control_address = 'tcp://127.0.0.1:{}'.format(
+                    control.bind_to_random_port('tcp://127.0.0.1'))
+        process = self._mp.Process(target=run_worker,
+                                   args=(self._config_file,
+                                         self._root_factory, index,
+                                         self.worker_addresses(index),
+                                         control_address,
+                                         self._report_address,
+                                         self.report_period, self._debug),
+                                   name='location-worker-{}'.format(index))
+        process.start()
+        self._processes[index] = process
+        # commands to the dead worker are replaced by its locations
+        self._pending[index].clear()
+        for ident in sorted(self.worker_locations[index]):
+            self._send(index, ADD_COMMAND, ident)
+        logger.info('Worker %s started with locations: %s', index,
+                    sorted(self.worker_locations[index]))
+
+    def _send(self, index, command, ident):
+        self._pending[index].append(msgpack.dumps([command, ident]))
+        self._flush(index)
+
+    def _flush(self, index):
+        """ Sends queued commands without blocking on a missing worker """
+
+        pending = self._pending[index]
+        control = self._controls[index]
+        while pending:
+            try:
+                control.send(pending[0], zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            pending.popleft()
+
+    def _check_workers(self):
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                logger.error('Worker %s exited with code %s, restarting',
+                             index, process.exitcode)
+                Stats.instance().incr('sulaco_pool_worker_restarts_total')
+                self._spawn(index)
+            else:
+                self._flush(index)
+
+    def _on_report(self, parts):
+        report = msgpack.loads(parts[0], encoding='utf-8')
+        # the worker is connected
+        self._flush(report[1])
+        if report[0] == MIGRATED_REPORT:
+            self._on_migrated(*report[1:])
+            return
+        kind, index, cpu, busy = report
+        assert kind == LOAD_REPORT, kind
+        # the worker's CPU time is shared in proportion
+        # to the time spent in handlers of every location
+        total_busy = sum(busy.values())
+        alpha = self.smoothing
+        for ident, seconds in busy.items():
+            if ident not in self.worker_locations[index]:
+                continue # moved meanwhile
+            load = cpu * seconds / total_busy if total_busy else 0
+            old = self.loads.get(ident)
+            if old is not None:
+                load = old + alpha * (load - old)
+            self.loads[ident] = load
+
+    def rebalance(self):
+        move = plan_move(self.worker_locations, self.loads, self.threshold)
+        if move is None:
+            return
+        ident, src, dst = move
+        logger.info("Location '%s' (load %.2f) is moved from worker %s "
+                    "to worker %s", ident, self.loads[ident], src, dst)
+        Stats.instance().incr('sulaco_pool_moves_total')
+        self.worker_locations[src].remove(ident)
+        self.worker_locations[dst].add(ident)
+        if self.live_migration:
+            self._migrations[ident] = src
+            self._send(dst, MIGRATE_COMMAND, ident)
+            return
+        self._send(src, REMOVE_COMMAND, ident)
+        self._send(dst, ADD_COMMAND, ident)
+
+    def _on_migrated(self, index, ident, success):
+        src = self._migrations.pop(ident, None)
+        if success or src is None:
+            return
+        # the location stays in the source worker
+        logger.error("Location '%s' isn't migrated to worker %s",
+                     ident, index)
+        self.worker_locations[index].discard(ident)
+        self.worker_locations[src].add(ident)
+
+
+def close_root(gateway):
+    close = getattr(gateway.root, 'close', None)
+    if close is not None:
+        close()
+
+
+@coroutine
+def add_location(host, make_gateway, ident, timeout, retry_period,
+                 ioloop=None):
+    """
+    Adds a new gateway of the location to the host and resolves to it,
+    or to None if the location manager refuses it for `timeout` seconds.
+    The location may still be registered by another worker: the one
+    it is removed from or the dead one that is restarted.
+    """
+    ioloop = ioloop or IOLoop.current()
+    deadline = ioloop.time() + timeout
+    while True:
+        gateway = make_gateway(ident)
+        connected = yield host.add_location_async(gateway)
+        if connected:
+            return gateway
+        close_root(gateway)
+        if ioloop.time() + retry_period > deadline:
+            return None
+        yield sleep(retry_period)
+
+
+def run_worker(config_file, root_factory, index, addresses,
+               control_address, report_address, report_period, debug,
+               retry_period=0.1):
+    install()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorUTCFormatter())
+    root_logger.addHandler(handler)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # stopped by supervisor
+
+    config = Config.load_yaml(config_file)
+    factory = import_object(root_factory)
+    host = MultiLocationGateway(config)
+    host.connect(*addresses)
+    context = zmq.Context.instance()
+    control = context.socket(zmq.PULL)
+    control.connect(control_address)
+    reports = context.socket(zmq.PUSH)
+    reports.connect(report_address)
+
+    # a dead worker's locations are kept by the location manager
+    # until their heartbeats are missed
+    conf = config.location_manager
+    register_timeout = (conf.max_heartbeat_silence +
+                        2 * conf.heartbeats_checker_period)
+
+    def make_gateway(ident):
+        gateway = Gateway(config, ident)
+        gateway.setup(factory(gateway, ident))
+        return gateway
+
+    @coroutine
+    def add(ident):
+        gateway = yield add_location(host, make_gateway, ident,
+                                     register_timeout, retry_period)
+        if gateway is not None:
+            logger.info("Location '%s' is added to worker %s", ident, index)
+        else:
+            logger.error("Location '%s' isn't added", ident)
+
+    @coroutine
+    def migrate(ident):
+        gateway = make_gateway(ident)
+        success = yield host.take_over(gateway)
+        if success:
+            logger.info("Location '%s' is migrated to worker %s",
+                        ident, index)
+        else:
+            close_root(gateway)
+        reports.send(msgpack.dumps([MIGRATED_REPORT, index,
+                                    ident, success]))
+
+    def on_migrated(gateway):
+        close_root(gateway)
+        logger.info("Location '%s' is migrated from worker %s",
+                    gateway.ident, index)
+    host.on_migrated = on_migrated
+
+    def on_command(parts):
+        command, ident = msgpack.loads(parts[0], encoding='utf-8')
+        if command == ADD_COMMAND:
+            add(ident)
+        elif command == MIGRATE_COMMAND:
+            migrate(ident)
+        elif command == REMOVE_COMMAND:
+            close_root(host.remove_location(ident))
+            logger.info("Location '%s' is removed from worker %s",
+                        ident, index)
+    ZMQStream(control).on_recv(on_command)
+
+    last_cpu = [process_time()]
+    def report():
+        cpu = process_time()
+        busy = {}
+        for gateway in host.gateways:
+            busy[gateway.ident] = gateway.busy
+            gateway.busy = 0
+        reports.send(msgpack.dumps([LOAD_REPORT, index,
+                                    (cpu - last_cpu[0]) / report_period,
+                                    busy]))
+        last_cpu[0] = cpu
+    PeriodicCallback(report, report_period * 1000).start()
+    host.start()
+
+
+if __name__ == '__main__':
+    install()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', action='store', dest='config',
+                        help='path to config file', type=str, required=True)
+    parser.add_argument('-r', '--root', action='store', dest='root',
+                        help='import path of root factory, module:name',
+                        type=str, required=True)
+    parser.add_argument('-l', '--locations', action='store',
+                        dest='locations', type=str, required=True,
+                        help='comma separated idents of locations')
+    parser.add_argument('-w', '--workers', action='store', dest='workers',
+                        help='number of worker processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('-a', '--address', action='store', dest='address',
+                        help='address of workers sockets', type=str,
+                        default='tcp://127.0.0.1')
+    parser.add_argument('-p', '--base-port', action='store',
+                        dest='base_port', type=int, default=9100,
+                        help='worker N binds ports from base + 3N '
+                             'to base + 3N + 2')
+    parser.add_argument('-t', '--threshold', action='store',
+                        dest='threshold', type=float, default=0.2,
+                        help='difference of worker loads (busy fraction '
+                             'of a core) that triggers a move')
+    parser.add_argument('--rebalance-period', action='store',
+                        dest='rebalance_period', type=float, default=10,
+                        help='seconds between moves of locations')
+    parser.add_argument('--live-migration', action='store_true',
+                        dest='live_migration',
+                        help='migrate locations with their state')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        dest='debug', help='set debug level of logging')
+    parser.add_argument('-sp', '--stats-port', action='store',
+                        dest='stats_port', help='port of stats endpoint',
+                        type=int, default=None)
+    options = parser.parse_args()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorUTCFormatter())
+    root_logger.addHandler(handler)
+
+    if options.stats_port is not None:
+        serve_stats(options.stats_port)
+    LocationPool(options.config, options.root,
+                 options.locations.split(','), options.workers,
+                 options.address, options.base_port,
+                 rebalance_period=options.rebalance_period,
+                 threshold=options.threshold,
+                 live_migration=options.live_migration,
+                 debug=options.debug).start()
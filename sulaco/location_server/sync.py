@@ -0,0 +1,204 @@
+"""
+Per-recipient state synchronization of replicated objects.
+
+A replicated object is a named dict of fields with a version that grows
+on every change. For every recipient (user) the location keeps
+the last version the client acknowledged and the last version
+that was sent. On flush a recipient gets one private message
+`<path>(objects=[...])` with an entry for every changed object:
+
+- delta {'name', 'base', 'version', 'set': {field: value}, 'unset': [field]}
+  has fields changed after the acknowledged version `base`;
+- snapshot {'name', 'version', 'state'} is sent to a recipient that
+  hasn't acknowledged anything yet or whose acknowledged version
+  is older than the kept history;
+- {'name', 'removed': True} when the object is removed.
+
+Deltas are relative to the acknowledged version and carry the current
+values, so a client can apply a delta when its own version of the object
+is not older than `base`. Otherwise it has missed an update and asks
+for snapshots with the resync message. Clients acknowledge applied
+versions with {name: version}.
+"""
+
+from collections import deque
+
+
+class _Replica(object):
+    __slots__ = ('state', 'version', 'log')
+
+    def __init__(self, state, history):
+        self.state = state
+        self.version = 1
+        self.log = deque(maxlen=history) # (version, changed fields)
+
+    def change(self, fields):
+        self.version += 1
+        self.log.append((self.version, fields))
+
+    def delta(self, base):
+        """ Returns fields changed after base or None if history is lost """
+
+        if base < self.version - len(self.log):
+            return None
+        changed = set()
+        for version, fields in reversed(self.log):
+            if version <= base:
+                break
+            changed.update(fields)
+        return changed
+
+
+class _Recipient(object):
+    __slots__ = ('names', 'acked', 'sent', 'removed')
+
+    def __init__(self, names):
+        self.names = names # None means all objects
+        self.acked = {} # name -> acknowledged version
+        self.sent = {} # name -> last sent version
+        self.removed = set()
+
+    def wants(self, name):
+        return self.names is None or name in self.names
+
+
+class StateSync(object):
+    """
+    Tracks replicated objects of a location and sends their changes
+    to every recipient through the gateway (see the module docstring).
+    `history` is the number of changes kept per object for deltas.
+    """
+
+    def __init__(self, gateway, path='sync', history=64):
+        self._gateway = gateway
+        self.path = path
+        self.history = history
+        self._objects = {}
+        self._recipients = {}
+
+    def __contains__(self, name):
+        return name in self._objects
+
+    def state(self, name):
+        return self._objects[name].state
+
+    def version(self, name):
+        return self._objects[name].version
+
+    def set(self, name, state):
+        """ Creates the object or replaces all its fields """
+
+        replica = self._objects.get(name)
+        if replica is None:
+            self._objects[name] = _Replica(dict(state), self.history)
+            return
+        old = replica.state
+        changed = [key for key, value in state.items()
+                   if key not in old or old[key] != value]
+        changed.extend(key for key in old if key not in state)
+        if changed:
+            replica.state = dict(state)
+            replica.change(changed)
+
+    def update(self, name, fields):
+        """ Changes some fields, `fields` is a dict """
+
+        replica = self._objects[name]
+        state = replica.state
+        changed = [key for key, value in fields.items()
+                   if key not in state or state[key] != value]
+        if changed:
+            state.update(fields)
+            replica.change(changed)
+
+    def unset(self, name, *fields):
+        replica = self._objects[name]
+        state = replica.state
+        changed = [key for key in fields if key in state]
+        if changed:
+            for key in changed:
+                del state[key]
+            replica.change(changed)
+
+    def remove(self, name):
+        del self._objects[name]
+        for recipient in self._recipients.values():
+            recipient.acked.pop(name, None)
+            if recipient.sent.pop(name, None) is not None:
+                recipient.removed.add(name)
+
+    def add_recipient(self, uid, names=None):
+        """ The recipient gets objects with the names or all objects """
+
+        self._recipients[uid] = _Recipient(None if names is None
+                                           else set(names))
+
+    def remove_recipient(self, uid):
+        self._recipients.pop(uid, None)
+
+    def ack(self, uid, versions):
+        recipient = self._recipients.get(uid)
+        if recipient is None:
+            return
+        objects = self._objects
+        acked = recipient.acked
+        for name, version in versions.items():
+            replica = objects.get(name)
+            if replica is None or version > replica.version:
+                continue
+            if version > acked.get(name, 0):
+                acked[name] = version
+
+    def resync(self, uid, names=None):
+        """ Sends snapshots on the next flush """
+
+        recipient = self._recipients.get(uid)
+        if recipient is None:
+            return
+        for name in list(recipient.sent if names is None else names):
+            recipient.acked.pop(name, None)
+            recipient.sent.pop(name, None)
+
+    def entries(self, uid):
+        """ Returns entries of changed objects and marks them as sent """
+
+        recipient = self._recipients[uid]
+        entries = [{'name': name, 'removed': True}
+                   for name in recipient.removed]
+        recipient.removed.clear()
+        acked = recipient.acked
+        sent = recipient.sent
+        for name, replica in self._objects.items():
+            version = replica.version
+            if sent.get(name) == version or not recipient.wants(name):
+                continue
+            sent[name] = version
+            base = acked.get(name)
+            changed = None if base is None else replica.delta(base)
+            if changed is None:
+                entries.append({'name': name, 'version': version,
+                                'state': replica.state})
+                continue
+            state = replica.state
+            entry = {'name': name, 'base': base, 'version': version}
+            values = {key: state[key] for key in changed if key in state}
+            if values:
+                entry['set'] = values
+            unset = [key for key in changed if key not in state]
+            if unset:
+                entry['unset'] = unset
+            entries.append(entry)
+        return entries
+
+    def flush(self):
+        """ Sends changes to all recipients, returns number of messages """
+
+        count = 0
+        for uid in self._recipients:
+            entries = self.entries(uid)
+            if entries:
+                self._gateway.private_message(uid, {
+                    'path': self.path,
+                    'kwargs': {'objects': entries}})
+                count += 1
+        return count
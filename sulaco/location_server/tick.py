@@ -0,0 +1,119 @@
+import logging
+
+from time import perf_counter
+from tornado.ioloop import IOLoop
+
+from sulaco.utils.stats import Stats
+
+
+logger = logging.getLogger(__name__)
+
+TICK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25)
+
+
+class TickScheduler(object):
+    """
+    Runs a location at a fixed rate. Input of the gateway is queued
+    and dispatched at the beginning of a tick, then systems
+    (callables that get the time since the previous tick) run in order.
+    Output produced during a tick is sent at the end of it,
+    one batch per topic (see Gateway.begin_output).
+
+    Ticks are scheduled on a fixed grid, so a slow tick doesn't shift
+    the following ones. A tick that ends after the start of the next one
+    is an overrun, missed ticks are skipped rather than run back to back.
+    While the location is being migrated out, input goes
+    to the migration and systems don't run.
+    """
+
+    def __init__(self, gateway, rate, systems=(), ioloop=None):
+        self._gateway = gateway
+        self.period = 1 / rate
+        self.systems = list(systems)
+        self._ioloop = ioloop or IOLoop.instance()
+        self._queue = []
+        self._deadline = None
+        self._last = None
+        self._timeout = None
+        self.ticks = 0
+        self.overruns = 0
+        stats = Stats.instance()
+        labels = {'location': gateway.ident}
+        self._duration = stats.histogram('sulaco_tick_seconds',
+                                         TICK_BUCKETS, **labels)
+        self._labels = labels
+        stats.gauge('sulaco_tick_queued_input',
+                    lambda: len(self._queue), **labels)
+
+    def add_system(self, system):
+        self.systems.append(system)
+
+    def queue(self, data):
+        self._queue.append(data)
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def start(self):
+        ioloop = self._ioloop
+        self._last = ioloop.time()
+        self._deadline = self._last + self.period
+        self._timeout = ioloop.add_timeout(self._deadline, self._run)
+
+    def stop(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _run(self):
+        ioloop = self._ioloop
+        now = ioloop.time()
+        dt, self._last = now - self._last, now
+        try:
+            self.tick(dt)
+        except Exception:
+            # the next tick is scheduled anyway
+            logger.exception("Exception in tick of location '%s'",
+                             self._gateway.ident)
+
+        period = self.period
+        self._deadline += period
+        now = ioloop.time()
+        if now > self._deadline:
+            missed = int((now - self._deadline) / period) + 1
+            self.overruns += 1
+            Stats.instance().incr('sulaco_tick_overruns_total',
+                                  **self._labels)
+            Stats.instance().incr('sulaco_tick_skipped_total', missed,
+                                  **self._labels)
+            logger.warning("Tick of location '%s' overran, %s ticks "
+                           "are skipped", self._gateway.ident, missed)
+            self._deadline += missed * period
+        self._timeout = ioloop.add_timeout(self._deadline, self._run)
+
+    def tick(self, dt):
+        gateway = self._gateway
+        if gateway.incoming is not None:
+            # the location is held until it's moved here
+            return
+        queue, self._queue = self._queue, []
+        migration = gateway.migration
+        if migration is not None:
+            for data in queue:
+                migration.input(data)
+            return
+        start = perf_counter()
+        gateway.begin_output()
+        try:
+            for data in queue:
+                gateway.dispatch_input(data)
+            for system in self.systems:
+                try:
+                    system(dt)
+                except Exception:
+                    logger.exception('Exception in tick system')
+        finally:
+            gateway.flush_output()
+        self.ticks += 1
+        self._duration.observe(perf_counter() - start)
@@ -1,44 +1,124 @@
+import sys
 import logging
 import zmq
 import msgpack
 
-from collections import defaultdict
+from time import monotonic, perf_counter
+from itertools import count
 from functools import partial
+from tornado.ioloop import IOLoop
 from tornado.stack_context import ExceptionStackContext
 
 from sulaco import (PUBLIC_MESSAGE_FROM_LOCATION_PREFIX,
-                    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX)
+                    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
+                    MULTICAST_MESSAGE_FROM_LOCATION_PREFIX)
 from sulaco.outer_server import (
     SEND_BY_UID_PREFIX, PUBLISH_TO_CHANNEL_PREFIX)
-from sulaco.utils import Sender
-from sulaco.utils.receiver import root_dispatch, SignError, USER_SIGN
+from sulaco.outer_server.outbound import OutboundLanes, NORMAL
+from sulaco.utils import Sender, trace
+from sulaco.utils.trace import Tracer
+from sulaco.utils.rate import TokenBucket
+from sulaco.utils.stats import Stats
+from sulaco.utils.receiver import USER_SIGN
 
 
 logger = logging.getLogger(__name__)
 
+STATS_COMPONENT = 'outer_server'
+
 
 class ConnectionHandler(object):
     """
-    Should be first in list of basic classes, if used as mixin
+    Should be first in list of basic classes, if used as mixin.
+    The resulting class may declare
+    `__slots__ = ConnectionHandler.connection_slots` to keep connection
+    objects compact (requires slots in the protocol class too).
+
+    A message is written at once if the protocol has nothing to flush,
+    otherwise it is queued in priority lanes (see OutboundLanes)
+    and written when the protocol reports it's sent (on_sent).
     """
     #TODO: check if connection is alive
 
-    def setup(self, connman, root):
+    __slots__ = ()
+    connection_slots = ('_connman', '_root', 'conn_id',
+                        '_rate_limit', 'rate_buckets', '_outbound')
+    outbound_policy = None # default priority and TTL by path
+    max_queued = 10000 # outbound messages waiting for a slow peer
+
+    def setup(self, connman, root, rate_limit=None):
         self._connman = connman
         self._root = root
-        self.s = Sender(self.send)
+        self.conn_id = None
+        self._rate_limit = rate_limit
+        self.rate_buckets = None
+        self._outbound = None # lanes created when the peer falls behind
+
+    @property
+    def s(self):
+        """ Returns connection's sender """
+
+        return Sender(self.send)
+
+    def sender(self, priority, ttl=None):
+        """ Returns connection's sender that tags messages """
+
+        return Sender(partial(self.send, priority=priority, ttl=ttl))
 
     def on_open(self, *args):
         super().on_open(*args)
         self._connman.add_connection(self)
 
-    def send(self, message):
-        super().send(message)
+    def send(self, message, priority=None, ttl=None):
+        fanout = self._connman.fanout
+        if fanout is not None and fanout.queues():
+            # keeps order with pending deliveries
+            fanout.defer(self, message, priority=priority, ttl=ttl)
+            return
+        if priority is None:
+            policy = self.outbound_policy
+            if policy is None:
+                priority = NORMAL
+            else:
+                priority, default_ttl = policy.classify(message['path'])
+                if ttl is None:
+                    ttl = default_ttl
+        if 'trace' in message:
+            # a broadcast message is recorded for its first recipient
+            Tracer.instance().finish(message.pop('trace'), trace.CLIENT_SEND)
+        lanes = self._outbound
+        if lanes is None:
+            if not self.writing():
+                self._write(message)
+                return
+            lanes = self._outbound = OutboundLanes(self.max_queued)
+        lanes.push(message, priority, ttl)
+
+    def _write(self, message):
+        size = super().send(message)
         logger.debug("Message sent: %s", message)
+        if size is not None:
+            pstats = Stats.instance().path(STATS_COMPONENT, message['path'])
+            pstats.response_bytes.observe(size)
+
+    def on_sent(self):
+        lanes = self._outbound
+        while lanes is not None and not self.writing():
+            if self.closed():
+                return
+            message = lanes.pop()
+            if message is None:
+                self._outbound = None
+                break
+            self._write(message)
+        super().on_sent()
 
     def on_message(self, message):
         super().on_message(message)
         logger.debug("Received message: %s", message)
+        rate_limit = self._rate_limit
+        if rate_limit is not None and not rate_limit.allow(self, message):
+            return
         path = message['path'].split('.')
         kwargs = message['kwargs']
         kwargs['conn'] = self
@@ -48,70 +128,215 @@ class ConnectionHandler(object):
             sign = USER_SIGN
         else:
             sign = None
+        pstats = Stats.instance().path(STATS_COMPONENT, message['path'])
+        # a trusted client may pass an id to trace the message
+        # regardless of sampling
+        tracer = Tracer.instance()
+        trace_id = message.get('trace') if tracer.client_ids else None
+        context = tracer.start(trace.OUTER_RECEIVE, trace_id)
         with ExceptionStackContext(self.exception_handler):
-            root_dispatch(self._root, path, kwargs, sign)
+            if context is None:
+                pstats.dispatch(self._root, path, kwargs, sign,
+                                self.frame_size)
+                return
+            previous = trace.activate(context)
+            try:
+                pstats.dispatch(self._root, path, kwargs, sign,
+                                self.frame_size)
+            finally:
+                trace.activate(previous)
+                tracer.finish(context, trace.OUTER_DONE)
 
     def exception_handler(self, type, value, traceback):
         logger.exception('Exception in message handler')
         return True
 
     def on_close(self):
+        if self._outbound is not None:
+            self._outbound.clear()
+            self._outbound = None
         super().on_close()
         self._connman.remove_connection(self)
         logger.debug("Connection removed")
         #TODO: func test that checks log
 
 
+def intern_key(key):
+    """ Shares one copy of equal string keys between indexes """
+
+    if type(key) is str:
+        return sys.intern(key)
+    return key
+
+
+class ConnectionRateLimit(object):
+    """
+    Token buckets of a connection: one for all messages and optionally
+    one per path prefix. A message has to fit into both of them.
+    Buckets are created on the first message of the connection.
+    Over-limit messages are dropped or the connection is closed,
+    depending on `action`.
+    """
+
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, rate=None, burst=None, action=DROP, paths=None):
+        assert action in (self.DROP, self.DISCONNECT), action
+        self.rate = rate
+        self.burst = burst or rate
+        self.action = action
+        self.paths = []
+        for prefix, limit in sorted((paths or {}).items(),
+                                    key=lambda i: -len(i[0])):
+            self.paths.append((prefix, limit['rate'],
+                               limit.get('burst') or limit['rate']))
+        self._stats = Stats.instance()
+
+    @classmethod
+    def from_config(cls, conf):
+        paths = None
+        if conf.get('paths') is not None:
+            paths = conf['paths'] # plain dict of dicts
+        return cls(conf.get('rate'), conf.get('burst'),
+                   conf.get('action', cls.DROP), paths)
+
+    def _prefix_index(self, path):
+        for i, (prefix, _, _) in enumerate(self.paths):
+            if path == prefix or path.startswith(prefix + '.'):
+                return i
+        return None
+
+    def allow(self, conn, message):
+        now = monotonic()
+        buckets = conn.rate_buckets
+        if buckets is None:
+            buckets = conn.rate_buckets = {}
+        if self.rate is not None:
+            bucket = buckets.get(None)
+            if bucket is None:
+                bucket = buckets[None] = TokenBucket(self.rate,
+                                                     self.burst, now)
+            if not bucket.consume(now):
+                return self._throttled(conn, message, '*')
+        if not self.paths:
+            return True
+        index = self._prefix_index(message['path'])
+        if index is None:
+            return True
+        bucket = buckets.get(index)
+        if bucket is None:
+            prefix, rate, burst = self.paths[index]
+            bucket = buckets[index] = TokenBucket(rate, burst, now)
+        if not bucket.consume(now):
+            return self._throttled(conn, message, self.paths[index][0])
+        return True
+
+    def _throttled(self, conn, message, limit):
+        self._stats.incr('sulaco_throttled_messages_total',
+                         limit=limit, action=self.action)
+        if self.action == self.DISCONNECT:
+            logger.warning('Rate limit exceeded (%s), connection closed',
+                                                                    limit)
+            conn.close()
+        else:
+            logger.debug('Rate limit exceeded (%s), message dropped: %s',
+                                                        limit, message)
+        return False
+
+
 class ConnectionManager(object):
+    """
+    Connections are indexed by small integer ids assigned on registration.
+    Sets of channels or connections exist only while they are non-empty.
+    With a `fanout` scheduler (see sulaco.outer_server.fanout) deliveries
+    to many connections are spread over several IOLoop iterations.
+    """
 
     def __init__(self, **kwargs):
-        self._connections = set()
+        self._fanout = kwargs.get('fanout')
+        self._ids = count(1)
+        self._connections = {}
 
         self._uid_to_connection = {}
         self._connection_to_uid = {}
 
-        self._channel_to_connections = defaultdict(set)
-        self._connection_to_channels = defaultdict(set)
+        self._channel_to_connections = {}
+        self._connection_to_channels = {}
+
+    @property
+    def fanout(self):
+        return self._fanout
 
     def add_connection(self, conn):
-        assert conn not in self._connections, 'connection already registered'
-        self._connections.add(conn)
+        assert conn.conn_id is None, 'connection already registered'
+        conn_id = next(self._ids)
+        conn.conn_id = conn_id
+        self._connections[conn_id] = conn
 
     def bind_connection_to_uid(self, conn, uid):
-        assert conn in self._connections, 'unknown connection'
+        conn_id = conn.conn_id
+        assert conn_id in self._connections, 'unknown connection'
         assert uid not in self._uid_to_connection, 'uid already exists'
-        self._connection_to_uid[conn] = uid
-        self._uid_to_connection[uid] = conn
+        uid = intern_key(uid)
+        self._connection_to_uid[conn_id] = uid
+        self._uid_to_connection[uid] = conn_id
 
     def add_connection_to_channel(self, conn, channel):
-        assert conn in self._connections, 'unknown connection'
-        error = 'connection already in channel'
-        assert channel not in self._connection_to_channels[conn], error
-        self._connection_to_channels[conn].add(channel)
-        self._channel_to_connections[channel].add(conn)
+        conn_id = conn.conn_id
+        assert conn_id in self._connections, 'unknown connection'
+        channel = intern_key(channel)
+        channels = self._connection_to_channels.get(conn_id)
+        if channels is None:
+            channels = self._connection_to_channels[conn_id] = set()
+        assert channel not in channels, 'connection already in channel'
+        channels.add(channel)
+        conn_ids = self._channel_to_connections.get(channel)
+        if conn_ids is None:
+            conn_ids = self._channel_to_connections[channel] = set()
+        conn_ids.add(conn_id)
 
     def remove_connection_from_channel(self, conn, channel):
-        self._connection_to_channels[conn].remove(channel)
-        self._channel_to_connections[channel].remove(conn)
-        if not self._channel_to_connections[channel]:
+        conn_id = conn.conn_id
+        channels = self._connection_to_channels[conn_id]
+        channels.remove(channel)
+        if not channels:
+            del self._connection_to_channels[conn_id]
+        self._discard_from_channel(conn_id, channel)
+
+    def _discard_from_channel(self, conn_id, channel):
+        conn_ids = self._channel_to_connections[channel]
+        conn_ids.remove(conn_id)
+        if not conn_ids:
             del self._channel_to_connections[channel]
 
     def remove_connection(self, conn):
-        self._connections.remove(conn)
-        uid = self._connection_to_uid.pop(conn, None)
+        conn_id = conn.conn_id
+        del self._connections[conn_id]
+        uid = self._connection_to_uid.pop(conn_id, None)
         if uid is not None:
             del self._uid_to_connection[uid]
-        channels = self._connection_to_channels.pop(conn, [])
+        channels = self._connection_to_channels.pop(conn_id, ())
         for channel in channels:
-            self._channel_to_connections[channel].remove(conn)
-            if not self._channel_to_connections[channel]:
-                del self._channel_to_connections[channel]
+            self._discard_from_channel(conn_id, channel)
+
+    def _deliver(self, connections, msg):
+        if self._fanout is None:
+            for conn in connections:
+                conn.send(msg)
+        else:
+            self._fanout.deliver(connections, msg)
 
     def send_by_uid(self, uid, msg):
-        conn = self._uid_to_connection.get(uid)
-        if conn is None:
+        conn_id = self._uid_to_connection.get(uid)
+        if conn_id is None:
             return False
-        conn.send(msg)
+        conn = self._connections[conn_id]
+        if self._fanout is None:
+            conn.send(msg)
+        else:
+            # keeps order with pending deliveries
+            self._fanout.deliver((conn,), msg)
         return True
 
     def us(self, uid):
@@ -121,10 +346,11 @@ class ConnectionManager(object):
         return Sender(send)
 
     def publish_to_channel(self, channel, msg, **kwargs):
-        if channel not in self._channel_to_connections:
+        conn_ids = self._channel_to_connections.get(channel)
+        if conn_ids is None:
             return
-        for conn in self._channel_to_connections[channel]:
-            conn.send(msg)
+        connections = self._connections
+        self._deliver([connections[i] for i in conn_ids], msg)
 
     def cs(self, channel, locally=True):
         """ Returns channel's sender """
@@ -133,8 +359,7 @@ class ConnectionManager(object):
         return Sender(send)
 
     def publish_to_all(self, msg):
-        for conn in self._connections:
-            conn.send(msg)
+        self._deliver(list(self._connections.values()), msg)
 
     @property
     def alls(self):
@@ -147,10 +372,13 @@ class ConnectionManager(object):
         return len(self._connections)
 
     def get_uid(self, conn):
-        return self._connection_to_uid.get(conn)
+        return self._connection_to_uid.get(conn.conn_id)
 
     def get_connection(self, uid):
-        return self._uid_to_connection.get(uid)
+        conn_id = self._uid_to_connection.get(uid)
+        if conn_id is None:
+            return None
+        return self._connections[conn_id]
 
 
 class DistributedConnectionManager(ConnectionManager):
@@ -176,11 +404,11 @@ class DistributedConnectionManager(ConnectionManager):
         self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, topic.encode('utf-8'))
 
     def remove_connection(self, conn):
-        uid = self._connection_to_uid.get(conn, None)
+        uid = self._connection_to_uid.get(conn.conn_id)
         if uid is not None:
             topic = SEND_BY_UID_PREFIX + str(uid)
             self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, topic.encode('utf-8'))
-        channels = self._connection_to_channels.get(conn, [])
+        channels = self._connection_to_channels.get(conn.conn_id, ())
         for channel in channels:
             topic = PUBLISH_TO_CHANNEL_PREFIX + str(channel)
             self._sub_socket.setsockopt(zmq.UNSUBSCRIBE, topic.encode('utf-8'))
@@ -204,49 +432,194 @@ class DistributedConnectionManager(ConnectionManager):
         self._pub_socket.send(msgpack.dumps(msg))
 
 
+class Handoff(object):
+    """ A switch of the user to another location that is in progress """
+
+    __slots__ = ('uid', 'target', 'started', 'on_fail', 'timeout')
+
+    def __init__(self, uid, target, on_fail=None):
+        self.uid = uid
+        self.target = target
+        self.started = perf_counter()
+        self.on_fail = on_fail
+        self.timeout = None
+
+
 class LocationConnectionManager(ConnectionManager):
+    """
+    A user switches locations with a handoff: begin_handoff subscribes
+    to the topics of the target while the user stays in the source.
+    The user is sent to the target only when the subscriptions are
+    confirmed (see LocationMessageManager.handoff), so nothing
+    the target publishes after the user enters is lost.
+    Until the target sends the first private message to the user
+    (the reply to enter) its other messages describe the location
+    before the user entered, they are dropped for the user.
+    complete_handoff leaves the source on the reply. If the reply
+    doesn't come in `handoff_timeout` seconds, fail_handoff drops
+    subscriptions to the target and the user stays in the source.
+    """
+
+    handoff_timeout = 2 # seconds
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._locs_sub_socket = kwargs['locations_sub_socket']
         self._uid_to_location = {}
-        self._location_to_uids = defaultdict(set)
+        self._location_to_uids = {}
+        self._handoffs = {}
+        self._location_to_handoffs = {}
+        self._switch_time = Stats.instance().histogram(
+                                        'sulaco_location_switch_seconds')
+
+    def _subscription(self, option, location, uid):
+        socket = self._locs_sub_socket
+        topic = '{}{}:{}'.format(PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
+                                                    location, str(uid))
+        socket.setsockopt(option, topic.encode('utf-8'))
+        topic = PUBLIC_MESSAGE_FROM_LOCATION_PREFIX + str(location)
+        socket.setsockopt(option, topic.encode('utf-8'))
+        topic = MULTICAST_MESSAGE_FROM_LOCATION_PREFIX + str(location)
+        socket.setsockopt(option, topic.encode('utf-8'))
 
-    def add_user_to_location(self, location, uid):
+    def _set_location(self, location, uid):
         assert uid in self._uid_to_connection
         assert uid not in self._uid_to_location
+        location = intern_key(location)
         self._uid_to_location[uid] = location
-        self._location_to_uids[location].add(uid)
-        topic = '{}{}:{}'.format(PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
-                                                    location, str(uid))
-        self._locs_sub_socket.setsockopt(zmq.SUBSCRIBE, topic.encode('utf-8'))
-        topic = PUBLIC_MESSAGE_FROM_LOCATION_PREFIX + str(location)
-        self._locs_sub_socket.setsockopt(zmq.SUBSCRIBE, topic.encode('utf-8'))
+        uids = self._location_to_uids.get(location)
+        if uids is None:
+            uids = self._location_to_uids[location] = set()
+        uids.add(uid)
+
+    def add_user_to_location(self, location, uid):
+        self._set_location(location, uid)
+        self._subscription(zmq.SUBSCRIBE, location, uid)
 
     def remove_user_from_location(self, location, uid):
         del self._uid_to_location[uid]
-        self._location_to_uids[location].remove(uid)
-        if not self._location_to_uids[location]:
+        uids = self._location_to_uids[location]
+        uids.remove(uid)
+        if not uids:
             del self._location_to_uids[location]
-        topic = '{}{}:{}'.format(PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
-                                                    location, str(uid))
-        self._locs_sub_socket.setsockopt(zmq.UNSUBSCRIBE,
-                                         topic.encode('utf-8'))
-        topic = PUBLIC_MESSAGE_FROM_LOCATION_PREFIX + str(location)
-        self._locs_sub_socket.setsockopt(zmq.UNSUBSCRIBE,
-                                         topic.encode('utf-8'))
+        self._subscription(zmq.UNSUBSCRIBE, location, uid)
+
+    def begin_handoff(self, location, uid, ioloop=None, on_fail=None):
+        """
+        A previous handoff of the user is aborted.
+        `on_fail` is called if the handoff fails.
+        """
+
+        assert uid in self._uid_to_connection
+        ioloop = ioloop or IOLoop.instance()
+        if uid in self._handoffs:
+            self._end_handoff(uid, ioloop)
+            Stats.instance().incr('sulaco_location_switches_total',
+                                  result='aborted')
+        handoff = self._handoffs[uid] = Handoff(uid, intern_key(location),
+                                                  on_fail)
+        uids = self._location_to_handoffs.get(location)
+        if uids is None:
+            uids = self._location_to_handoffs[location] = set()
+        uids.add(uid)
+        self._subscription(zmq.SUBSCRIBE, location, uid)
+        handoff.timeout = ioloop.add_timeout(
+                            ioloop.time() + self.handoff_timeout,
+                            partial(self._handoff_expired, uid, ioloop))
+        return handoff
+
+    def _end_handoff(self, uid, ioloop=None, unsubscribe=True):
+        """ Forgets the handoff """
+
+        handoff = self._handoffs.pop(uid)
+        (ioloop or IOLoop.instance()).remove_timeout(handoff.timeout)
+        uids = self._location_to_handoffs[handoff.target]
+        uids.remove(uid)
+        if not uids:
+            del self._location_to_handoffs[handoff.target]
+        if unsubscribe:
+            self._subscription(zmq.UNSUBSCRIBE, handoff.target, uid)
+        return handoff
+
+    def _handoff_expired(self, uid, ioloop):
+        logger.warning("Location '%s' didn't reply to user %s in time",
+                       self._handoffs[uid].target, uid)
+        self.fail_handoff(uid, 'timeout', ioloop)
+
+    def handoff(self, uid):
+        return self._handoffs.get(uid)
+
+    def fail_handoff(self, uid, result='failed', ioloop=None):
+        """ The user stays in the source """
+
+        handoff = self._end_handoff(uid, ioloop)
+        Stats.instance().incr('sulaco_location_switches_total',
+                              result=result)
+        if handoff.on_fail is not None:
+            try:
+                handoff.on_fail()
+            except Exception:
+                logger.exception('Exception in handoff failure handler')
+        return handoff
+
+    def complete_handoff(self, uid, result='completed', ioloop=None):
+        """ Moves the user to the target """
+
+        # subscriptions made by begin_handoff become the user's ones,
+        # resubscribing could lose messages
+        handoff = self._end_handoff(uid, ioloop, unsubscribe=False)
+        old = self._uid_to_location.get(uid)
+        if old is not None:
+            self.remove_user_from_location(old, uid)
+        self._set_location(handoff.target, uid)
+        stats = Stats.instance()
+        stats.incr('sulaco_location_switches_total', result=result)
+        self._switch_time.observe(perf_counter() - handoff.started)
+        return handoff
 
     def remove_connection(self, conn):
-        uid = self._connection_to_uid.get(conn, None)
+        uid = self._connection_to_uid.get(conn.conn_id)
         super().remove_connection(conn)
-        if uid is None or uid not in self._uid_to_location:
+        if uid is None:
             return
-        location = self._uid_to_location[uid]
-        self.remove_user_from_location(location, uid)
+        if uid in self._handoffs:
+            self._end_handoff(uid)
+        if uid in self._uid_to_location:
+            location = self._uid_to_location[uid]
+            self.remove_user_from_location(location, uid)
+
+    def has_location_users(self, location):
+        """ True if users are in the location or entering it """
+
+        return (location in self._location_to_uids or
+                location in self._location_to_handoffs)
+
+    def entering_users(self, location, uids):
+        """ Filters uids that are being handed off to the location """
+
+        handoffs = self._location_to_handoffs.get(location)
+        if handoffs is None:
+            return []
+        return [uid for uid in uids if uid in handoffs]
 
     def publish_to_location(self, location, msg):
-        for uid in self._location_to_uids[location]:
-            self._uid_to_connection[uid].send(msg)
+        uids = self._location_to_uids.get(location)
+        if uids is None:
+            return
+        handoffs = self._location_to_handoffs.get(location)
+        if handoffs is not None:
+            # users re-entering the location get its state with the reply
+            uids = uids - handoffs
+        connections = self._connections
+        uid_to_connection = self._uid_to_connection
+        self._deliver([connections[uid_to_connection[uid]] for uid in uids],
+                      msg)
+
+    def local_users(self, location, uids):
+        """ Filters uids that are in the location on this server """
+
+        uid_to_location = self._uid_to_location
+        return [uid for uid in uids if uid_to_location.get(uid) == location]
 
     def ls(self, location):
         """ Returns location's sender """
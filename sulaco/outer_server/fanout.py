@@ -0,0 +1,108 @@
+from time import perf_counter
+from collections import deque
+from tornado.ioloop import IOLoop
+
+from sulaco.utils.stats import Stats
+
+
+class FanoutScheduler(object):
+    """
+    Spreads deliveries to many connections over several IOLoop
+    iterations. Every iteration sends at most `batch_size` messages
+    and stops earlier when `time_budget` seconds are spent.
+
+    Deliveries are processed in FIFO order, and while any of them is
+    pending the new ones are queued too, even small ones. Connections
+    queue their direct sends with defer() meanwhile (see
+    ConnectionHandler.send), so every connection gets messages
+    in the order they were sent.
+    """
+
+    check_every = 64 # sends between clock checks
+
+    def __init__(self, threshold=1000, batch_size=2000, time_budget=0.005,
+                 ioloop=None):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self._ioloop = ioloop or IOLoop.instance()
+        self._jobs = deque()
+        self._scheduled = False
+        self._running = False
+        stats = Stats.instance()
+        self._latency = stats.histogram('sulaco_fanout_seconds')
+        stats.gauge('sulaco_fanout_pending_jobs', lambda: len(self._jobs))
+
+    @classmethod
+    def from_config(cls, conf, ioloop=None):
+        kwargs = {k: conf.get(k) for k in ('threshold', 'batch_size',
+                                           'time_budget')
+                  if conf.get(k) is not None}
+        return cls(ioloop=ioloop, **kwargs)
+
+    @property
+    def pending(self):
+        return len(self._jobs)
+
+    def queues(self):
+        """ True if a direct send should be deferred to keep the order """
+
+        return bool(self._jobs) and not self._running
+
+    def deliver(self, connections, msg):
+        """ connections should be a list, it is not copied """
+
+        if not self._jobs and len(connections) <= self.threshold:
+            for conn in connections:
+                conn.send(msg)
+            return
+        self._add_job(connections, msg, {})
+
+    def defer(self, conn, msg, **kwargs):
+        """ Sends the message after pending deliveries """
+
+        self._add_job((conn,), msg, kwargs)
+
+    def _add_job(self, connections, msg, kwargs):
+        self._jobs.append([connections, 0, msg, perf_counter(), kwargs])
+        if not self._scheduled:
+            self._scheduled = True
+            self._ioloop.add_callback(self._run)
+
+    def _run(self):
+        self._running = True
+        try:
+            self._process()
+        finally:
+            self._running = False
+        if self._jobs:
+            self._ioloop.add_callback(self._run)
+        else:
+            self._scheduled = False
+
+    def _process(self):
+        jobs = self._jobs
+        start = perf_counter()
+        deadline = start + self.time_budget
+        budget = self.batch_size
+        sent = 0
+        while jobs and sent < budget:
+            job = jobs[0]
+            connections, index, msg, published, kwargs = job
+            end = min(len(connections), index + budget - sent)
+            while index < end:
+                step_end = min(end, index + self.check_every)
+                for conn in connections[index:step_end]:
+                    if not conn.closed():
+                        conn.send(msg, **kwargs)
+                sent += step_end - index
+                index = step_end
+                if perf_counter() >= deadline:
+                    break
+            if index < len(connections):
+                job[1] = index
+                if perf_counter() >= deadline:
+                    break
+                continue
+            jobs.popleft()
+            self._latency.observe(perf_counter() - published)
@@ -1,9 +1,19 @@
 import argparse
+import threading
 import zmq
+
+from zmq.eventloop import zmqstream
+from zmq.eventloop.ioloop import install
+from tornado.ioloop import IOLoop
+
 from sulaco.utils import Config
+from sulaco.utils.stats import Stats, SIZE_BUCKETS, serve_stats
+
+
+CAPTURE_ADDRESS = 'inproc://message_broker_capture'
 
 
-def forward(config):
+def forward(config, stats_port=None):
     context = zmq.Context()
 
     sub = context.socket(zmq.SUB)
@@ -13,11 +23,44 @@ def forward(config):
     pub = context.socket(zmq.PUB)
     pub.bind(config.message_broker.pub_address)
 
-    zmq.device(zmq.FORWARDER, sub, pub)
+    if stats_port is None:
+        zmq.device(zmq.FORWARDER, sub, pub)
+        return
+
+    # The proxy copies every message to the capture socket.
+    # PUB drops copies instead of blocking the proxy
+    # if the stats loop falls behind.
+    capture = context.socket(zmq.PUB)
+    capture.bind(CAPTURE_ADDRESS)
+    capture_sub = context.socket(zmq.SUB)
+    capture_sub.connect(CAPTURE_ADDRESS)
+    capture_sub.setsockopt(zmq.SUBSCRIBE, b'')
+    zmqstream.ZMQStream(capture_sub).on_recv(count_message)
+    thread = threading.Thread(target=zmq.proxy, args=(sub, pub, capture))
+    thread.daemon = True
+    thread.start()
+    serve_stats(stats_port)
+    IOLoop.instance().start()
+
+
+def count_message(parts):
+    stats = Stats.instance()
+    topic = parts[0].split(b':', 1)[0].decode('utf-8')
+    size = sum(len(p) for p in parts)
+    stats.incr('sulaco_broker_messages_total', topic=topic)
+    stats.incr('sulaco_broker_bytes_total', size, topic=topic)
+    stats.histogram('sulaco_broker_message_bytes', SIZE_BUCKETS,
+                    topic=topic).observe(size)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', action='store', dest='config',
                         help='path to config file', type=str, required=True)
+    parser.add_argument('-sp', '--stats-port', action='store',
+                        dest='stats_port', help='port of stats endpoint',
+                        type=int, default=None)
     options = parser.parse_args()
-    forward(Config.load_yaml(options.config))
+    if options.stats_port is not None:
+        install()
+    forward(Config.load_yaml(options.config), options.stats_port)
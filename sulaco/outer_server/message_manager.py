@@ -3,23 +3,39 @@ import zmq
 import logging
 
 from abc import ABCMeta, abstractmethod
+from time import perf_counter
+from uuid import uuid4
+from functools import partial
 from zmq.eventloop import zmqstream
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.stack_context import ExceptionStackContext
 
 from sulaco import (
     PUBLIC_MESSAGE_FROM_LOCATION_PREFIX,
-    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX, GET_LOCATIONS_INFO,
-    LOCATION_CONNECTED_PREFIX, LOCATION_DISCONNECTED_PREFIX)
+    PRIVATE_MESSAGE_FROM_LOCATION_PREFIX,
+    MULTICAST_MESSAGE_FROM_LOCATION_PREFIX, GET_LOCATIONS_INFO,
+    LOCATION_CONNECTED_PREFIX, LOCATION_DISCONNECTED_PREFIX,
+    LOCATION_MOVED_PREFIX, LOCATION_LOADS_PREFIX,
+    PROBE_FROM_LOCATION_PREFIX, MOVE_CONFIRMED_PREFIX, SOURCE_PROBE_ECHO)
 from sulaco.outer_server import SEND_BY_UID_PREFIX, PUBLISH_TO_CHANNEL_PREFIX
-from sulaco.utils import InstanceError
-from sulaco.utils.receiver import INTERNAL_SIGN, root_dispatch
+from sulaco.utils import InstanceError, trace
+from sulaco.utils.rpc import request
+from sulaco.utils.stats import Stats, SIZE_BUCKETS
+from sulaco.utils.receiver import INTERNAL_SIGN
 from sulaco.outer_server.connection_manager import (
     DistributedConnectionManager,
     LocationConnectionManager)
+from sulaco.outer_server.placement import Placement
 
 
 logger = logging.getLogger(__name__)
 
+STATS_COMPONENT = 'message_manager'
+PRIVATE_LOCATION_KEYS = frozenset(('pub_address', 'pull_address',
+                                   'migration_address', 'routed_input'))
+LOCATION_STATS_COMPONENT = 'location_private'
+
 
 def message_handler(prefix):
     def wrapper(func):
@@ -28,12 +44,76 @@ def message_handler(prefix):
     return wrapper
 
 
+class BatchingPushSocket(object):
+    """
+    Coalesces frames sent during one IOLoop iteration into
+    one multipart message, a single frame is sent as is.
+    A batch is sent at once when it reaches `max_batch` frames.
+    """
+
+    def __init__(self, socket, max_batch=256, ioloop=None):
+        self._socket = socket
+        self.max_batch = max_batch
+        self._ioloop = ioloop or IOLoop.instance()
+        self._frames = []
+        self._scheduled = False
+        self._batch_size = Stats.instance().histogram(
+                                'sulaco_location_input_batch', SIZE_BUCKETS)
+
+    def send(self, data):
+        self.send_multipart((data,))
+
+    def send_multipart(self, parts):
+        """ Parts are kept together in a batch """
+
+        frames = self._frames
+        frames.extend(parts)
+        if len(frames) >= self.max_batch:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            self._ioloop.add_callback(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        frames = self._frames
+        if not frames:
+            return
+        self._frames = []
+        self._batch_size.observe(len(frames))
+        if len(frames) == 1:
+            self._socket.send(frames[0])
+        else:
+            self._socket.send_multipart(frames)
+
+    def close(self):
+        self.flush()
+        self._socket.close()
+
+
+class RoutedInput(object):
+    """
+    Input of a location hosted by a gateway with other locations,
+    every message is preceded by the location id
+    """
+
+    __slots__ = ('_socket', '_loc_id')
+
+    def __init__(self, socket, loc_id):
+        self._socket = socket
+        self._loc_id = loc_id.encode('utf-8')
+
+    def send(self, data):
+        self._socket.send_multipart((self._loc_id, data))
+
+
 class BasicMessageManager(object):
 
     def __init__(self, config):
         self._collect_handlers()
         self._config = config
         self._context = None
+        self._message_size = 0
 
     def connect(self):
         self._context = zmq.Context()
@@ -53,13 +133,30 @@ class BasicMessageManager(object):
             self._handlers[prefix] = item
 
     def _on_message(self, parts):
-        topic, body = parts
-        topic = topic.decode('utf-8')
-        msg = msgpack.loads(body, encoding='utf-8')
-        logger.debug("Received message - topic: %s, body: %s", topic, msg)
+        """ Several bodies after the topic come as a batch """
+
+        topic = parts[0].decode('utf-8')
         prefix, data = topic.split(':', 1)
-        with ExceptionStackContext(self.exception_handler):
-            self._handlers[prefix + ':'](data, msg)
+        prefix += ':'
+        handler = self._handlers[prefix]
+        pstats = Stats.instance().path(STATS_COMPONENT, prefix)
+        for body in parts[1:]:
+            msg = msgpack.loads(body, encoding='utf-8')
+            logger.debug("Received message - topic: %s, body: %s", topic, msg)
+            self._message_size = size = len(body)
+            # bodies of location manager events can be None
+            context = msg.get('trace') if isinstance(msg, dict) else None
+            if context is None:
+                with ExceptionStackContext(self.exception_handler):
+                    pstats.track(size, handler, data, msg)
+                continue
+            trace.hop(context, trace.OUTER_LOCATION_RECEIVE)
+            previous = trace.activate(context)
+            try:
+                with ExceptionStackContext(self.exception_handler):
+                    pstats.track(size, handler, data, msg)
+            finally:
+                trace.activate(previous)
 
     def exception_handler(self, type, value, traceback):
         logger.exception('Exception in message handler')
@@ -93,12 +190,117 @@ class MessageManager(BasicMessageManager):
         super().setup(connman, root)
 
 
+class DeferredInput(object):
+    """
+    Input of a location whose messages can't be received yet,
+    frames are kept until the subscriber is connected to the location
+    """
+
+    __slots__ = ('_input', '_frames')
+
+    def __init__(self, input_sock):
+        self._input = input_sock
+        self._frames = []
+
+    def send(self, data):
+        if self._frames is None:
+            self._input.send(data)
+        else:
+            self._frames.append(data)
+
+    def open(self):
+        frames, self._frames = self._frames, None
+        for data in frames:
+            self._input.send(data)
+
+    def send_now(self, data):
+        """ Sends the frame ahead of kept ones """
+
+        if isinstance(self._input, DeferredInput):
+            self._input.send_now(data)
+        else:
+            self._input.send(data)
+
+    @property
+    def pending(self):
+        return self._frames is not None
+
+
 class LocationMessageManager(BasicMessageManager):
+    """
+    Existing locations are fetched from the location manager page
+    by page after setup, while the server already accepts connections.
+    Every request is bounded by a timeout and retried, rounds
+    of requests are repeated with a growing period until
+    outer_server.bootstrap.max_attempts fail in a row. `ready` is
+    a future resolved with the number of locations when all of them
+    are known, or with None if bootstrap gives up (then only locations
+    connected later are known).
+
+    With outer_server.location_idle_timeout sockets of a location
+    are opened by location_input() when they are needed and closed
+    when the location has no local users for the timeout. Input is
+    kept until a probe shows that subscriptions reach the new
+    publisher, so replies of the location aren't lost. Without
+    the setting every location is connected at once.
+
+    A probe subscribes a new topic and sends it to the location
+    until the location echoes it. Subscriptions of a SUB socket reach
+    a publisher in order, so the echo means that all subscriptions
+    made before the probe are in effect.
+
+    `placement` chooses locations for new users by loads
+    that the location manager publishes (see Placement).
+    """
+
+    bootstrap_page_size = 100
+    bootstrap_timeout = 2 # seconds
+    bootstrap_retries = 2
+    bootstrap_retry_period = 1 # seconds
+    bootstrap_max_retry_period = 30 # seconds
+    bootstrap_max_attempts = 10
+    subscribe_timeout = 1 # seconds to wait for a new subscriber connection
+    move_timeout = 2 # seconds to wait for a moved location
+    probe_period = 0.1 # seconds between probes until the echo comes
 
     def __init__(self, config):
         super().__init__(config)
-        self.loc_input_sockets = {}
+        self.ready = None
+        self.time_to_ready = None
+        self._started = perf_counter()
+        self._bootstrapping = False
+        self._removed_early = set()
+        self._locations = {} # registry data of every location
+        self.loc_input_sockets = {} # connected locations
         self._loc_pub_addresses = {}
+        self._loc_pull_addresses = {}
+        # locations hosted by one gateway share addresses:
+        # pull address -> [socket, number of locations],
+        # pub address -> number of locations
+        self._input_sockets = {}
+        self._pub_address_refs = {}
+        self._pending_pub_addresses = {} # address -> deferred inputs
+        self._idle_since = {} # loc_id -> time without local users
+        # topics of probes are unique among outer servers
+        token = uuid4().hex[:12]
+        self._probe_prefix = '{}{}:'.format(PROBE_FROM_LOCATION_PREFIX,
+                                            token)
+        self._move_confirmation = (MOVE_CONFIRMED_PREFIX +
+                                   token).encode('utf-8')
+        self._probe_count = 0
+        # topic -> [input, callback, deadline, timeout, expected echoes]
+        self._probes = {}
+        self.idle_timeout = config.outer_server.get('location_idle_timeout')
+        self.placement = Placement.from_config(
+                                config.outer_server.get('placement'))
+        stats = Stats.instance()
+        stats.gauge('sulaco_locations_known', lambda: len(self._locations))
+        stats.gauge('sulaco_locations_connected',
+                    lambda: len(self.loc_input_sockets))
+        stats.gauge('sulaco_location_input_sockets',
+                    lambda: len(self._input_sockets))
+        stats.gauge('sulaco_location_pub_connections',
+                    lambda: len(self._pub_address_refs))
 
     def connect(self):
         super().connect()
@@ -109,30 +311,282 @@ class LocationMessageManager(BasicMessageManager):
         self._sub_to_locman.setsockopt(zmq.SUBSCRIBE, b'')
         zmqstream.ZMQStream(self._sub_to_locman).on_recv(self._on_message)
 
-        self._req_to_locman = self._context.socket(zmq.REQ)
-        self._req_to_locman.connect(self._config.location_manager.rep_address)
-
         # create socket for receiving of messages from locations
         self.sub_to_locs = self._context.socket(zmq.SUB)
         zmqstream.ZMQStream(self.sub_to_locs).on_recv(self._on_message)
 
     @message_handler(LOCATION_CONNECTED_PREFIX)
     def add_location(self, loc_id, data):
-        assert loc_id not in self.loc_input_sockets, 'location already exists'
-        push_sock = self._context.socket(zmq.PUSH)
-        push_sock.connect(data.pop('pull_address'))
-        self.loc_input_sockets[loc_id] = push_sock
-        self.sub_to_locs.connect(data['pub_address'])
-        self._loc_pub_addresses[loc_id] = data.pop('pub_address')
-        self._root.location_added(loc_id, data)
+        self._removed_early.discard(loc_id)
+        if self._bootstrapping and loc_id in self._locations:
+            # it's already fetched by bootstrap
+            self.move_location(loc_id, data)
+            return
+        assert loc_id not in self._locations, 'location already exists'
+        self._locations[loc_id] = data
+        self.placement.add(loc_id, data)
+        if self.idle_timeout is None:
+            self._connect_location(loc_id, data)
+        self._root.location_added(loc_id, public_data(data))
+
+    @message_handler(LOCATION_MOVED_PREFIX)
+    def move_location(self, loc_id, data):
+        """
+        The location is migrated to another process. Input to the new
+        address is kept until a probe sent through the old one
+        (the source forwards it) is echoed by the target and by
+        the source. Then all earlier input has reached the target,
+        messages of the target reach this server and all messages
+        of the source are received, so the target is sent
+        a confirmation (see sulaco.location_server.migration),
+        the kept input and the old addresses are released.
+        """
+
+        old = self._locations.get(loc_id)
+        if old is None:
+            self.add_location(loc_id, data)
+            return
+        self._locations[loc_id] = data
+        self.placement.add(loc_id, data)
+        input_sock = self.loc_input_sockets.get(loc_id)
+        if input_sock is None:
+            self._confirm_unused_move(loc_id, old)
+            return
+        pull_address = self._loc_pull_addresses[loc_id]
+        pub_address = self._loc_pub_addresses[loc_id]
+        self._connect_location(loc_id, data)
+        new_input = DeferredInput(self.loc_input_sockets[loc_id])
+        self.loc_input_sockets[loc_id] = new_input
+        self.probe(loc_id, partial(self._on_move_probed, loc_id, new_input,
+                                   pull_address, pub_address),
+                   self.move_timeout, input_sock, source=True)
+
+    def _on_move_probed(self, loc_id, new_input, pull_address, pub_address,
+                        reached):
+        if loc_id in self.loc_input_sockets:
+            # kept input goes on even if the location is moved again
+            if reached:
+                new_input.send_now(self._move_confirmation)
+            else:
+                logger.warning("Moved location '%s' isn't confirmed in time",
+                               loc_id)
+            new_input.open()
+        self._release_addresses(pull_address, pub_address)
+
+    def _confirm_unused_move(self, loc_id, old):
+        # the source counts this server among subscribers
+        # if another location shares the publisher
+        if old['pub_address'] not in self._pub_address_refs:
+            return
+        shared = self._input_sockets.get(old['pull_address'])
+        if shared is None:
+            return
+        input_sock = shared[0]
+        if old.get('routed_input', False):
+            input_sock = RoutedInput(input_sock, loc_id)
+        input_sock.send(self._move_confirmation)
+
+    def location_input(self, loc_id):
+        """
+        Returns the input socket of the location, connects to it
+        if necessary. None if the location is unknown.
+        """
+
+        input_sock = self.loc_input_sockets.get(loc_id)
+        if input_sock is not None:
+            return input_sock
+        data = self._locations.get(loc_id)
+        if data is None:
+            return None
+        self._connect_location(loc_id, data)
+        Stats.instance().incr('sulaco_location_connects_total')
+        return self.loc_input_sockets[loc_id]
+
+    def _connect_location(self, loc_id, data):
+        pull_address = data['pull_address']
+        shared = self._input_sockets.get(pull_address)
+        if shared is None:
+            push_sock = self._context.socket(zmq.PUSH)
+            push_sock.connect(pull_address)
+            max_batch = self._config.outer_server.get('location_input_batch')
+            if max_batch is not None:
+                push_sock = BatchingPushSocket(push_sock, max_batch)
+            shared = self._input_sockets[pull_address] = [push_sock, 0]
+        shared[1] += 1
+        input_sock = shared[0]
+        if data.get('routed_input', False):
+            input_sock = RoutedInput(input_sock, loc_id)
+        self._loc_pull_addresses[loc_id] = pull_address
+
+        pub_address = data['pub_address']
+        refs = self._pub_address_refs.get(pub_address, 0)
+        probe = not refs and self.idle_timeout is not None
+        if not refs:
+            self.sub_to_locs.connect(pub_address)
+            if probe:
+                self._pending_pub_addresses[pub_address] = []
+        pending = self._pending_pub_addresses.get(pub_address)
+        if pending is not None:
+            input_sock = DeferredInput(input_sock)
+            pending.append(input_sock)
+        self.loc_input_sockets[loc_id] = input_sock
+        self._pub_address_refs[pub_address] = refs + 1
+        self._loc_pub_addresses[loc_id] = pub_address
+        self._idle_since[loc_id] = IOLoop.instance().time()
+        if probe:
+            self.probe(loc_id, partial(self._on_publisher_probed,
+                                       pub_address), self.subscribe_timeout)
+
+    def probe(self, loc_id, callback, timeout, input_sock=None,
+              source=False):
+        """
+        Calls callback(True) when the location echoes a probe,
+        callback(False) if it doesn't in `timeout` seconds.
+        Probes are sent to `input_sock` after earlier input
+        or at once to the current input of the location.
+        With `source` the source of a migrated location
+        should echo the probe too.
+        """
+
+        self._probe_count += 1
+        topic = '{}{}'.format(self._probe_prefix, self._probe_count)
+        self.sub_to_locs.setsockopt(zmq.SUBSCRIBE, topic.encode('utf-8'))
+        deadline = IOLoop.instance().time() + timeout
+        echoes = {None, SOURCE_PROBE_ECHO} if source else {None}
+        self._probes[topic] = [input_sock or loc_id, callback,
+                               deadline, None, echoes]
+        self._send_probe(topic)
+
+    def _send_probe(self, topic):
+        probe = self._probes[topic]
+        input_sock, callback, deadline = probe[:3]
+        at_once = isinstance(input_sock, str)
+        if at_once:
+            input_sock = self.loc_input_sockets.get(input_sock)
+        ioloop = IOLoop.instance()
+        now = ioloop.time()
+        if input_sock is None or now >= deadline:
+            self._end_probe(topic)
+            callback(False)
+            return
+        if at_once and isinstance(input_sock, DeferredInput):
+            send = input_sock.send_now
+        else:
+            send = input_sock.send
+        try:
+            send(topic.encode('utf-8'))
+        except zmq.ZMQError:
+            # the socket is closed meanwhile
+            self._end_probe(topic)
+            callback(False)
+            return
+        probe[3] = ioloop.add_timeout(min(now + self.probe_period, deadline),
+                                      partial(self._send_probe, topic))
+
+    def _end_probe(self, topic):
+        probe = self._probes.pop(topic)
+        if probe[3] is not None:
+            IOLoop.instance().remove_timeout(probe[3])
+        self.sub_to_locs.setsockopt(zmq.UNSUBSCRIBE, topic.encode('utf-8'))
+        return probe
+
+    @message_handler(PROBE_FROM_LOCATION_PREFIX)
+    def location_probe(self, token, echo):
+        probe = self._probes.get(PROBE_FROM_LOCATION_PREFIX + token)
+        if probe is None:
+            # an echo of a repeated probe
+            return
+        echoes = probe[4]
+        echoes.discard(echo)
+        if not echoes:
+            self._end_probe(PROBE_FROM_LOCATION_PREFIX + token)
+            probe[1](True)
+
+    def _on_publisher_probed(self, pub_address, reached):
+        if not reached:
+            logger.warning('Subscriptions to %s are not confirmed in time',
+                           pub_address)
+        self._open_inputs(pub_address)
+
+    def handoff(self, loc_id, uid, enter, on_fail=None):
+        """
+        Switches the user to the location (see LocationConnectionManager).
+        `enter` is called to send the user to the location when
+        a probe confirms subscriptions to it, `on_fail` is called
+        if the handoff fails.
+        """
+
+        connman = self._connman
+        handoff = connman.begin_handoff(loc_id, uid, on_fail=on_fail)
+
+        def probed(reached):
+            if connman.handoff(uid) is not handoff:
+                # aborted or expired meanwhile
+                return
+            if reached:
+                enter()
+            else:
+                connman.fail_handoff(uid)
+
+        self.probe(loc_id, probed, connman.handoff_timeout)
+
+    def _open_inputs(self, pub_address):
+        inputs = self._pending_pub_addresses.pop(pub_address, None)
+        if inputs is None:
+            return
+        for input_sock in inputs:
+            input_sock.open()
+
+    def evict_idle(self):
+        """ Disconnects locations that have no local users for a while """
+
+        now = IOLoop.instance().time()
+        connman = self._connman
+        for loc_id in list(self.loc_input_sockets):
+            if connman.has_location_users(loc_id):
+                self._idle_since[loc_id] = now
+            elif now - self._idle_since[loc_id] >= self.idle_timeout:
+                self._disconnect_location(loc_id)
+                Stats.instance().incr('sulaco_location_evictions_total')
+                logger.debug("Location '%s' is disconnected as idle", loc_id)
+
+    def _disconnect_location(self, loc_id):
+        del self.loc_input_sockets[loc_id]
+        del self._idle_since[loc_id]
+        self._release_addresses(self._loc_pull_addresses.pop(loc_id),
+                                self._loc_pub_addresses.pop(loc_id))
 
     @message_handler(LOCATION_DISCONNECTED_PREFIX)
     def remove_location(self, loc_id, data):
-        sock = self.loc_input_sockets.pop(loc_id)
-        sock.close()
-        self.sub_to_locs.disconnect(self._loc_pub_addresses.pop(loc_id))
+        if loc_id not in self._locations:
+            if self._bootstrapping:
+                # it can still be in a page that is being fetched
+                self._removed_early.add(loc_id)
+            return
+        del self._locations[loc_id]
+        self.placement.remove(loc_id)
+        if loc_id in self.loc_input_sockets:
+            self._disconnect_location(loc_id)
         self._root.location_removed(loc_id)
 
+    @message_handler(LOCATION_LOADS_PREFIX)
+    def location_loads(self, _, loads):
+        self.placement.update(loads)
+
+    def _release_addresses(self, pull_address, pub_address):
+        shared = self._input_sockets[pull_address]
+        shared[1] -= 1
+        if not shared[1]:
+            del self._input_sockets[pull_address]
+            shared[0].close()
+
+        refs = self._pub_address_refs.pop(pub_address) - 1
+        if refs:
+            self._pub_address_refs[pub_address] = refs
+        else:
+            self.sub_to_locs.disconnect(pub_address)
+            self._pending_pub_addresses.pop(pub_address, None)
+
     @message_handler(PUBLIC_MESSAGE_FROM_LOCATION_PREFIX)
     def location_public(self, location, msg):
         path_prefix = self._config.outer_server.client_location_handler_path
@@ -142,15 +596,48 @@ class LocationMessageManager(BasicMessageManager):
     @message_handler(PRIVATE_MESSAGE_FROM_LOCATION_PREFIX)
     def location_private(self, location_uid, msg):
         location, uid = location_uid.split(':', 1)
-        path_prefix = (self._config.outer_server.
-                        location_handler_path.split('.'))
-        path = msg['path'].split('.')
-        path = path_prefix + path
+        path = self._location_path(msg)
         kwargs = msg['kwargs']
         if not 'location' in kwargs:
             kwargs['location'] = location
         kwargs['uid'] = uid
-        root_dispatch(self._root, path, kwargs, INTERNAL_SIGN)
+        pstats = Stats.instance().path(LOCATION_STATS_COMPONENT, msg['path'])
+        handoff = self._connman.handoff(uid)
+        if handoff is not None and handoff.target == location:
+            # the first message from the target completes the switch
+            self._connman.complete_handoff(uid)
+        return pstats.dispatch(self._root, path, kwargs,
+                               INTERNAL_SIGN, self._message_size)
+
+    @message_handler(MULTICAST_MESSAGE_FROM_LOCATION_PREFIX)
+    def location_multicast(self, location, data):
+        connman = self._connman
+        uids = connman.local_users(location, data['uids'])
+        entering = connman.entering_users(location, uids)
+        if entering:
+            # users re-entering the location get its state with the reply
+            uids = [uid for uid in uids if uid not in entering]
+        if not uids:
+            return
+        msg = data['msg']
+        path = self._location_path(msg)
+        pstats = Stats.instance().path(LOCATION_STATS_COMPONENT, msg['path'])
+        size = self._message_size
+        for uid in uids:
+            kwargs = dict(msg['kwargs'])
+            kwargs.setdefault('location', location)
+            kwargs['uid'] = uid
+            try:
+                pstats.dispatch(self._root, path, kwargs, INTERNAL_SIGN, size)
+            except Exception:
+                # other recipients still get the message
+                logger.exception('Exception in message handler')
+            size = 0 # the message is received once
+
+    def _location_path(self, msg):
+        path_prefix = (self._config.outer_server.
+                        location_handler_path.split('.'))
+        return path_prefix + msg['path'].split('.')
 
     def setup(self, connman, root):
         if not isinstance(connman, LocationConnectionManager):
@@ -158,15 +645,78 @@ class LocationMessageManager(BasicMessageManager):
         if not isinstance(root, LocationRoot):
             raise InstanceError('root', LocationRoot)
         super().setup(connman, root)
-
-        # connect to existing locations
-        req_sock = self._req_to_locman
-        del self._req_to_locman
-        req_sock.send(GET_LOCATIONS_INFO.encode('utf-8'))
-        locations = msgpack.loads(req_sock.recv(), encoding='utf-8')
-        req_sock.close()
-        for loc_id, data in locations.items():
-            self.add_location(loc_id, data)
+        self.ready = self.bootstrap()
+        if self.idle_timeout is not None:
+            period = max(self.idle_timeout / 4, 0.1) * 1000
+            PeriodicCallback(self.evict_idle, period).start()
+
+    @gen.coroutine
+    def bootstrap(self):
+        """ Connects to existing locations """
+
+        conf = self._config.outer_server.get('bootstrap')
+        conf = {} if conf is None else conf
+        page_size = conf.get('page_size', self.bootstrap_page_size)
+        timeout = conf.get('timeout', self.bootstrap_timeout)
+        retries = conf.get('retries', self.bootstrap_retries)
+        retry_period = conf.get('retry_period', self.bootstrap_retry_period)
+        max_retry_period = conf.get('max_retry_period',
+                                    self.bootstrap_max_retry_period)
+        max_attempts = conf.get('max_attempts', self.bootstrap_max_attempts)
+        address = self._config.location_manager.rep_address
+        stats = Stats.instance()
+
+        self._bootstrapping = True
+        after = ''
+        count = 0
+        failures = 0
+        while True:
+            reply = yield request(self._context, address,
+                                  [GET_LOCATIONS_INFO, after,
+                                   msgpack.dumps(page_size)],
+                                  timeout, retries)
+            if reply is None:
+                stats.incr('sulaco_bootstrap_failures_total')
+                failures += 1
+                if failures >= max_attempts:
+                    logger.error('Location manager is not available, '
+                                 'existing locations are not fetched '
+                                 'after %s attempts', failures)
+                    self._bootstrapping = False
+                    self._removed_early.clear()
+                    return None
+                period = min(retry_period * 2 ** (failures - 1),
+                             max_retry_period)
+                logger.error('Location manager is not available, '
+                             'retry in %s seconds', period)
+                yield gen.sleep(period)
+                continue
+            failures = 0
+            page = msgpack.loads(reply[0], encoding='utf-8')
+            for loc_id, data in page['locations'].items():
+                if (loc_id in self._locations or
+                        loc_id in self._removed_early):
+                    continue
+                self.add_location(loc_id, data)
+                count += 1
+            if page['next'] is None:
+                break
+            after = page['next']
+        self._bootstrapping = False
+        self._removed_early.clear()
+
+        self.time_to_ready = perf_counter() - self._started
+        stats.gauge('sulaco_time_to_ready_seconds',
+                    lambda: self.time_to_ready, component='outer_server')
+        logger.info('Connected to %s locations, ready in %.3f seconds',
+                    count, self.time_to_ready)
+        return count
+
+
+def public_data(data):
+    """ Registry data of a location without addresses """
+
+    return {k: v for k, v in data.items() if k not in PRIVATE_LOCATION_KEYS}
 
 
 class LocationRoot(object, metaclass=ABCMeta):
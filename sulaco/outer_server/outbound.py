@@ -0,0 +1,123 @@
+from time import monotonic
+from collections import deque
+
+from sulaco.utils.stats import Stats
+
+
+CONTROL = 0
+NORMAL = 1
+BULK = 2
+PRIORITY_NAMES = ('control', 'normal', 'bulk')
+
+# number of messages queued in all connections, per priority
+_queued = [0] * len(PRIORITY_NAMES)
+
+
+def _register_gauges():
+    stats = Stats.instance()
+    for priority, name in enumerate(PRIORITY_NAMES):
+        stats.gauge('sulaco_outbound_queued', lambda p=priority: _queued[p],
+                    priority=name)
+
+
+class OutboundLanes(object):
+    """
+    Messages of a connection that wait until the stream buffer is flushed,
+    one FIFO lane per priority. Higher priorities (lower numbers)
+    are drained first. Messages whose TTL has expired are dropped
+    instead of being written. When `max_queued` is exceeded,
+    the oldest message of the lowest non-empty priority is dropped.
+    """
+
+    __slots__ = ('_lanes', '_size', '_max_queued')
+
+    _gauges_registered = False
+
+    def __init__(self, max_queued=None):
+        if not OutboundLanes._gauges_registered:
+            OutboundLanes._gauges_registered = True
+            _register_gauges()
+        self._lanes = tuple(deque() for name in PRIORITY_NAMES)
+        self._size = 0
+        self._max_queued = max_queued
+
+    def __len__(self):
+        return self._size
+
+    def push(self, message, priority=NORMAL, ttl=None):
+        now = monotonic()
+        expires = None if ttl is None else now + ttl
+        self._lanes[priority].append((message, now, expires))
+        self._size += 1
+        _queued[priority] += 1
+        Stats.instance().incr('sulaco_outbound_queued_total',
+                              priority=PRIORITY_NAMES[priority])
+        if self._max_queued is not None and self._size > self._max_queued:
+            self._drop_lowest()
+
+    def _drop_lowest(self):
+        for priority in range(len(self._lanes) - 1, -1, -1):
+            lane = self._lanes[priority]
+            if lane:
+                lane.popleft()
+                self._size -= 1
+                _queued[priority] -= 1
+                Stats.instance().incr('sulaco_outbound_dropped_total',
+                                      priority=PRIORITY_NAMES[priority])
+                return
+
+    def pop(self):
+        """ Returns the next message to write or None """
+
+        now = monotonic()
+        stats = Stats.instance()
+        for priority, lane in enumerate(self._lanes):
+            name = PRIORITY_NAMES[priority]
+            while lane:
+                message, queued, expires = lane.popleft()
+                self._size -= 1
+                _queued[priority] -= 1
+                if expires is not None and expires <= now:
+                    stats.incr('sulaco_outbound_expired_total',
+                               priority=name)
+                    continue
+                stats.histogram('sulaco_outbound_queue_seconds',
+                                priority=name).observe(now - queued)
+                return message
+        return None
+
+    def clear(self):
+        for priority, lane in enumerate(self._lanes):
+            _queued[priority] -= len(lane)
+            lane.clear()
+        self._size = 0
+
+
+class OutboundPolicy(object):
+    """
+    Default priority and TTL of outbound messages by path prefix,
+    so messages that come from other processes are classified too.
+    The longest matching prefix wins.
+    """
+
+    def __init__(self, paths=None):
+        self.paths = []
+        for prefix, opts in sorted((paths or {}).items(),
+                                   key=lambda i: -len(i[0])):
+            priority = PRIORITY_NAMES.index(opts.get('priority', 'normal'))
+            self.paths.append((prefix, priority, opts.get('ttl')))
+
+    @classmethod
+    def from_config(cls, conf):
+        paths = None
+        if conf.get('paths') is not None:
+            paths = conf['paths'] # plain dict of dicts
+        return cls(paths)
+
+    def classify(self, path):
+        """ Returns (priority, ttl) """
+
+        for prefix, priority, ttl in self.paths:
+            if path == prefix or path.startswith(prefix + '.'):
+                return priority, ttl
+        return NORMAL, None
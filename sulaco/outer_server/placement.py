@@ -0,0 +1,98 @@
+import random
+
+
+class Placement(object):
+    """
+    Chooses the least loaded replica of a location type for new users.
+    The type of a location is 'type' in its registration data,
+    a location without it is the only replica of its own type.
+
+    Loads come from the location manager once in a period
+    (location_manager.load_publish_period), so users placed since
+    the load of a location has changed are counted here, otherwise
+    a burst of logins would go to the same location. The score of a replica is
+    users + queue * queue_weight + lag * lag_weight, equal scores
+    are chosen randomly.
+    """
+
+    queue_weight = 1 # users per input message queued for the next tick
+    lag_weight = 100 # users per second of IOLoop lag
+
+    def __init__(self, queue_weight=None, lag_weight=None):
+        if queue_weight is not None:
+            self.queue_weight = queue_weight
+        if lag_weight is not None:
+            self.lag_weight = lag_weight
+        self._replicas = {} # type -> set of loc ids
+        self._types = {} # loc_id -> type
+        self._loads = {}
+        self._placed = {} # loc_id -> users placed since the last load
+
+    @classmethod
+    def from_config(cls, conf):
+        if conf is None:
+            return cls()
+        return cls(conf.get('queue_weight'), conf.get('lag_weight'))
+
+    def add(self, loc_id, data):
+        self.remove(loc_id)
+        kind = data.get('type', loc_id)
+        self._types[loc_id] = kind
+        self._replicas.setdefault(kind, set()).add(loc_id)
+
+    def remove(self, loc_id):
+        kind = self._types.pop(loc_id, None)
+        if kind is None:
+            return
+        replicas = self._replicas[kind]
+        replicas.discard(loc_id)
+        if not replicas:
+            del self._replicas[kind]
+        self._loads.pop(loc_id, None)
+        self._placed.pop(loc_id, None)
+
+    def update(self, loads):
+        """
+        Replaces the load table, `loads` is {loc_id: load}.
+        Placed users are forgotten for locations with new counts
+        of users or queued messages, otherwise they aren't included
+        yet (lag changes with every heartbeat anyway).
+        """
+
+        placed = self._placed
+        previous = self._loads
+        for loc_id in list(placed):
+            if _counts(loads.get(loc_id)) != _counts(previous.get(loc_id)):
+                del placed[loc_id]
+        self._loads = loads
+
+    def replicas(self, kind):
+        return set(self._replicas.get(kind, ()))
+
+    def score(self, loc_id):
+        score = self._placed.get(loc_id, 0)
+        load = self._loads.get(loc_id)
+        if load is not None:
+            score += (load.get('users', 0) +
+                      load.get('queue', 0) * self.queue_weight +
+                      load.get('lag', 0) * self.lag_weight)
+        return score
+
+    def choose(self, kind):
+        """
+        Returns the least loaded replica and counts the placed user,
+        None if there are no replicas of the type
+        """
+
+        replicas = self._replicas.get(kind)
+        if not replicas:
+            return None
+        loc_id = min(replicas, key=lambda l: (self.score(l), random.random()))
+        self._placed[loc_id] = self._placed.get(loc_id, 0) + 1
+        return loc_id
+
+
+def _counts(load):
+    if load is None:
+        return None
+    return load.get('users', 0), load.get('queue', 0)
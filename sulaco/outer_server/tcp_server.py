@@ -1,19 +1,33 @@
+import zlib
 import msgpack
+import socket
+import struct
 import logging
 
+from time import perf_counter
 from abc import ABCMeta, abstractmethod
+from tornado.ioloop import IOLoop
+from tornado.netutil import add_accept_handler
 from tornado.tcpserver import TCPServer as BasicTCPServer
 
 from sulaco.outer_server.connection_manager import ConnectionHandler
 from sulaco.utils import SubclassError
+from sulaco.utils.rate import TokenBucket, KeyedTokenBuckets
+from sulaco.utils.stats import Stats
 
 
 logger = logging.getLogger(__name__)
 
+LINGER_RESET = struct.pack('ii', 1, 0)
+
+COMPRESSED_FRAME = b'z'
+EXTENSION_FRAME = b'x'
+
 
 class TCPServer(BasicTCPServer):
 
-    def setup(self, protocol, connman, root, max_conn=None):
+    def setup(self, protocol, connman, root, max_conn=None,
+                                    admission=None, rate_limit=None):
         if not issubclass(protocol, ABCProtocol):
             raise SubclassError('protocol', ABCProtocol)
         if not issubclass(protocol, ConnectionHandler):
@@ -22,19 +36,139 @@ class TCPServer(BasicTCPServer):
         self._connman = connman
         self._root = root
         self._max_conn = max_conn
+        self._admission = admission
+        self._rate_limit = rate_limit
+        self._paused = False
+        self._stats = Stats.instance()
+        self._stats.gauge('sulaco_connections',
+                          lambda: connman.connection_count)
 
     def handle_stream(self, stream, address):
-        conn = self._protocol(stream)
         max_conn = self._max_conn
-        if max_conn is not None and max_conn == self._connman.connection_count:
+        if max_conn is not None and max_conn <= self._connman.connection_count:
             logger.warning('Maximum of connection count was achieved')
+            self._reject(stream, 'rejected', 'max_conn')
             return
-        conn.setup(self._connman, self._root)
+        admission = self._admission
+        if admission is not None:
+            verdict = admission.check(address)
+            if verdict is not None:
+                kind, reason = verdict
+                self._reject(stream, kind, reason)
+                if reason == 'lag':
+                    self.pause_accepting()
+                return
+        self._stats.incr('sulaco_connections_accepted_total')
+        conn = self._protocol(stream)
+        conn.setup(self._connman, self._root, self._rate_limit)
         conn.on_open()
 
+    def _reject(self, stream, kind, reason):
+        self._stats.incr('sulaco_connections_{}_total'.format(kind),
+                                                        reason=reason)
+        # reset instead of graceful close, no TIME_WAIT on our side
+        try:
+            stream.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                     LINGER_RESET)
+        except (AttributeError, OSError):
+            pass
+        stream.close()
+
+    def pause_accepting(self):
+        """
+        Removes listening sockets from IOLoop, new connections wait
+        in the kernel backlog. Accepting is resumed when admission
+        control allows it again.
+        """
+
+        if self._paused:
+            return
+        self._paused = True
+        for fd in self._sockets:
+            self.io_loop.remove_handler(fd)
+        logger.warning('Accepting of connections is paused')
+        self._stats.incr('sulaco_accept_pauses_total')
+        self.io_loop.add_timeout(self.io_loop.time() +
+                            self._admission.resume_check_period,
+                            self._try_resume)
+
+    def _try_resume(self):
+        if self._admission.overloaded():
+            self.io_loop.add_timeout(self.io_loop.time() +
+                                self._admission.resume_check_period,
+                                self._try_resume)
+            return
+        self.resume_accepting()
+
+    def resume_accepting(self):
+        if not self._paused:
+            return
+        self._paused = False
+        for sock in self._sockets.values():
+            add_accept_handler(sock, self._handle_connection,
+                               io_loop=self.io_loop)
+        logger.info('Accepting of connections is resumed')
+
+
+class AdmissionControl(object):
+    """
+    Checks new connections before any protocol object is created.
+    Connections over the accept rates are rejected, connections
+    accepted while IOLoop lag is over `max_lag` are shed.
+    """
+
+    cleanup_period = 60 # seconds
+    resume_check_period = 0.1 # seconds
+
+    def __init__(self, rate=None, burst=None, ip_rate=None, ip_burst=None,
+                 max_lag=None, lag_monitor=None, ioloop=None):
+        self._ioloop = ioloop or IOLoop.instance()
+        now = self._ioloop.time()
+        self._bucket = None
+        if rate is not None:
+            self._bucket = TokenBucket(rate, burst or rate, now)
+        self._ip_buckets = None
+        if ip_rate is not None:
+            self._ip_buckets = KeyedTokenBuckets(ip_rate, ip_burst or ip_rate)
+        self._last_cleanup = now
+        assert max_lag is None or lag_monitor is not None
+        self._max_lag = max_lag
+        self._lag_monitor = lag_monitor
+
+    @classmethod
+    def from_config(cls, conf, lag_monitor=None, ioloop=None):
+        return cls(conf.get('rate'), conf.get('burst'),
+                   conf.get('ip_rate'), conf.get('ip_burst'),
+                   conf.get('max_lag'), lag_monitor, ioloop)
+
+    def overloaded(self):
+        return (self._max_lag is not None and
+                self._lag_monitor.lag > self._max_lag)
+
+    def check(self, address):
+        """ Returns None or a pair (kind, reason) """
+
+        if self.overloaded():
+            return 'shed', 'lag'
+        now = self._ioloop.time()
+        if self._bucket is not None and not self._bucket.consume(now):
+            return 'rejected', 'rate'
+        buckets = self._ip_buckets
+        if buckets is None:
+            return None
+        if now - self._last_cleanup > self.cleanup_period:
+            buckets.cleanup(now)
+            self._last_cleanup = now
+        if not buckets.consume(address[0], now):
+            return 'rejected', 'ip_rate'
+        return None
+
 
 class ABCProtocol(object, metaclass=ABCMeta):
 
+    __slots__ = ()
+    frame_size = 0 # size of the last received frame
+
     @abstractmethod
     def message_dumper(self):
         pass
@@ -47,6 +181,14 @@ class ABCProtocol(object, metaclass=ABCMeta):
     def send(self, message):
         pass
 
+    def writing(self):
+        """
+        True while written data isn't flushed, ConnectionHandler
+        queues messages by priority meanwhile (see OutboundLanes)
+        """
+
+        return False
+
     @abstractmethod
     def close(self):
         pass
@@ -69,26 +211,129 @@ class ABCProtocol(object, metaclass=ABCMeta):
 
 
 class SimpleProtocol(ABCProtocol):
+    """
+    Frame is a header of 10 ascii digits with the body length
+    and a msgpack body.
+
+    Compression extension: a peer may send an extension frame
+    ('x' and 9 digits in the header, msgpack body) with
+    {'compression': 'zlib'}. If `compression_threshold` is set,
+    the other side replies with {'compression': 'zlib', 'threshold': N,
+    'reply': True} and since then both sides may send compressed
+    frames ('z' and 9 digits in the header, zlib body).
+    Only bodies larger than the threshold are compressed,
+    so small messages stay cheap.
+    """
+
+    __slots__ = ('_stream', 'frame_size', '_compress')
     _header_bytes = 10
+    compression_threshold = None # bytes, None disables compression
+    compression_level = 6
+    max_decompressed_size = 16 * 1024 * 1024
 
     def __init__(self, stream):
         self._stream = stream
+        self.frame_size = 0
+        self._compress = None # threshold of the negotiated compression
         stream.set_close_callback(self.on_close)
 
     def _on_header(self, data):
-        content_size = int(data)
-        self._stream.read_bytes(content_size, self._on_body)
+        kind = data[:1]
+        if kind == COMPRESSED_FRAME:
+            callback = self._on_compressed_body
+        elif kind == EXTENSION_FRAME:
+            callback = self._on_extension_body
+        else:
+            self._stream.read_bytes(int(data), self._on_body)
+            return
+        self._stream.read_bytes(int(data[1:]), callback)
 
-    def _on_body(self, data):
+    def _read_header(self):
         if not self._stream.closed():
             self._stream.read_bytes(self._header_bytes, self._on_header)
+
+    def _on_body(self, data):
+        self._read_header()
+        self.frame_size = len(data)
         self.on_message(self.message_loader(data))
 
+    def _on_compressed_body(self, data):
+        if self._compress is None:
+            logger.warning('Compressed frame without negotiation')
+            self.close()
+            return
+        start = perf_counter()
+        dobj = zlib.decompressobj()
+        body = dobj.decompress(data, self.max_decompressed_size)
+        Stats.instance().incr('sulaco_compression_seconds_total',
+                              perf_counter() - start, op='decompress')
+        if dobj.unconsumed_tail:
+            logger.warning('Decompressed frame is too large')
+            self.close()
+            return
+        self._read_header()
+        self.frame_size = len(data)
+        self.on_message(self.message_loader(body))
+
+    def _on_extension_body(self, data):
+        try:
+            ext = msgpack.loads(data, encoding='utf-8')
+        except Exception:
+            ext = None
+        if not isinstance(ext, dict):
+            logger.warning('Malformed extension frame')
+            self.close()
+            return
+        self._read_header()
+        if ext.get('compression') != 'zlib':
+            return
+        if ext.get('reply'):
+            threshold = ext.get('threshold')
+            if (not isinstance(threshold, int) or
+                    isinstance(threshold, bool) or threshold < 0):
+                logger.warning('Wrong compression threshold: %r', threshold)
+                self.close()
+                return
+            self._compress = threshold
+        elif self.compression_threshold is not None:
+            self._compress = self.compression_threshold
+            self._send_frame(EXTENSION_FRAME, msgpack.dumps(
+                                            {'compression': 'zlib',
+                                             'threshold': self._compress,
+                                             'reply': True}))
+
+    def request_compression(self):
+        """ Offers the compression extension to the other side """
+
+        ext = msgpack.dumps({'compression': 'zlib'})
+        self._send_frame(EXTENSION_FRAME, ext)
+
+    def _send_frame(self, kind, body):
+        dlen = str(len(body)).encode('utf-8')
+        data = (kind + (self._header_bytes - len(kind) - len(dlen)) * b'0' +
+                dlen + body)
+        self._stream.write(data, self.on_sent)
+        return len(data)
+
+    def writing(self):
+        return self._stream.writing()
+
     def send(self, message):
         data = self.message_dumper(message)
-        dlen = str(len(data)).encode('utf-8')
-        data = (self._header_bytes - len(dlen)) * b'0' + dlen + data
-        self._stream.write(data, self.on_sent)
+        threshold = self._compress
+        if threshold is None or len(data) <= threshold:
+            return self._send_frame(b'', data)
+        start = perf_counter()
+        compressed = zlib.compress(data, self.compression_level)
+        stats = Stats.instance()
+        stats.incr('sulaco_compression_seconds_total',
+                   perf_counter() - start, op='compress')
+        stats.incr('sulaco_compression_input_bytes_total', len(data))
+        if len(compressed) >= len(data):
+            return self._send_frame(b'', data)
+        stats.incr('sulaco_compression_saved_bytes_total',
+                   len(data) - len(compressed))
+        return self._send_frame(COMPRESSED_FRAME, compressed)
 
     def connect(self, address):
         self._stream.connect(address, self.on_open)
@@ -0,0 +1,495 @@
+"""
+End-to-end load benchmark for a local cluster.
+
+Starts the message broker, the location manager, N outer servers
+(tests/server.py) and M locations (tests/location.py), then drives
+simulated clients from a single IOLoop.
+
+Usage:
+    python -m sulaco.tests.bench.cluster -s 2 -l 2 -cl 1000 -o run.json
+    python -m sulaco.tests.bench.cluster --compare base.json run.json
+
+Scenarios: echo, fanout, send_to_user, location.
+Output is json with throughput, latency percentiles (ms) and
+per-process CPU seconds and RSS for every scenario.
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+
+from time import sleep, perf_counter
+from functools import partial
+from collections import deque
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.concurrent import Future
+
+from sulaco.outer_server.tcp_server import SimpleProtocol
+from sulaco.utils import Sender
+
+
+TESTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(os.path.dirname(TESTS_DIR))
+SCENARIOS = ('echo', 'fanout', 'send_to_user', 'location')
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+class LoadClient(SimpleProtocol):
+    """ Non-blocking client, many instances share one IOLoop """
+
+    def __init__(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        super().__init__(IOStream(sock))
+        self.s = Sender(self.send)
+        self.listeners = {}
+        self._waiters = deque()
+        self._connected = None
+
+    def connect(self, port, host='127.0.0.1'):
+        self._connected = Future()
+        super().connect((host, port))
+        return self._connected
+
+    def expect(self, path_prefix, **kwargs_contain):
+        """ Returns future of the next matching message """
+
+        future = Future()
+        self._waiters.append((path_prefix, kwargs_contain, future))
+        return future
+
+    def on_open(self, *args):
+        super().on_open(*args)
+        self._connected.set_result(None)
+
+    def on_message(self, msg):
+        listener = self.listeners.get(msg['path'])
+        if listener is not None:
+            listener(msg)
+        for waiter in self._waiters:
+            path_prefix, kwargs_contain, future = waiter
+            if not msg['path'].startswith(path_prefix):
+                continue
+            kwargs = msg['kwargs']
+            if any(kwargs.get(k) != v for k, v in kwargs_contain.items()):
+                continue
+            self._waiters.remove(waiter)
+            future.set_result(msg)
+            return
+
+    def on_close(self):
+        # pending futures are abandoned, scenarios count them as timeouts
+        self._waiters.clear()
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.duplicates = 0
+        self._seen = set()
+        self.start = None
+        self.finish = None
+
+    def begin(self):
+        self.start = perf_counter()
+
+    def end(self):
+        self.finish = perf_counter()
+
+    def observe(self, sent_at):
+        self.latencies.append(perf_counter() - sent_at)
+
+    def observe_once(self, key, sent_at):
+        """ Counts a repeated delivery of the same message as duplicate """
+
+        if key in self._seen:
+            self.duplicates += 1
+            return
+        self._seen.add(key)
+        self.observe(sent_at)
+
+    def result(self):
+        lat = sorted(self.latencies)
+        elapsed = self.finish - self.start
+        res = {'messages': len(lat),
+               'errors': self.errors,
+               'duplicates': self.duplicates,
+               'seconds': round(elapsed, 4),
+               'throughput': round(len(lat) / elapsed, 1) if elapsed else 0}
+        for name, q in PERCENTILES:
+            if lat:
+                val = lat[min(len(lat) - 1, int(q * len(lat)))] * 1000
+                res[name + '_ms'] = round(val, 3)
+            else:
+                res[name + '_ms'] = None
+        return res
+
+
+def process_usage(pid):
+    """ CPU seconds and RSS bytes of a process, read from /proc """
+
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    rss = 0
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+                break
+    return cpu, rss
+
+
+class Cluster(object):
+
+    def __init__(self, config, servers, locations, base_port,
+                            loc_base_port, start_sleep, debug=False):
+        self.config = config
+        self.ports = [base_port + i for i in range(servers)]
+        self.locations = ['loc_{}'.format(i) for i in range(locations)]
+        self._loc_base_port = loc_base_port
+        self._start_sleep = start_sleep
+        self._debug = debug
+        self._processes = {}
+
+    def _spawn(self, name, script, *args, debug=False):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+                            filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+        args = [sys.executable, script, '-c', self.config] + list(args)
+        if debug:
+            args.append('--debug')
+        self._processes[name] = subprocess.Popen(args, env=env)
+
+    def start(self):
+        p = os.path.join(TESTS_DIR, '..', 'outer_server', 'message_broker.py')
+        self._spawn('broker', p)
+        p = os.path.join(TESTS_DIR, '..', 'location_server',
+                                        'location_manager.py')
+        self._spawn('location_manager', p, debug=self._debug)
+        for port in self.ports:
+            self._spawn('server_{}'.format(port),
+                        os.path.join(TESTS_DIR, 'server.py'),
+                        '-p', str(port), '-mc', str(10 ** 6),
+                        debug=self._debug)
+        sleep(self._start_sleep)
+        for i, ident in enumerate(self.locations):
+            port = self._loc_base_port + i * 2
+            self._spawn('location_{}'.format(ident),
+                        os.path.join(TESTS_DIR, 'location.py'),
+                        '-ident', ident,
+                        '-pub', 'tcp://127.0.0.1:{}'.format(port),
+                        '-pull', 'tcp://127.0.0.1:{}'.format(port + 1),
+                        debug=self._debug)
+        sleep(self._start_sleep)
+
+    def stop(self):
+        for p in self._processes.values():
+            p.terminate()
+        for p in self._processes.values():
+            p.wait()
+
+    def usage(self):
+        pids = {name: p.pid for name, p in self._processes.items()}
+        pids['bench_client'] = os.getpid()
+        return {name: process_usage(pid) for name, pid in pids.items()}
+
+
+def usage_delta(before, after):
+    return {name: {'cpu_seconds': round(after[name][0] - cpu, 3),
+                   'rss_bytes': after[name][1]}
+            for name, (cpu, _) in before.items()}
+
+
+class Benchmark(object):
+
+    def __init__(self, cluster, options):
+        self.cluster = cluster
+        self.options = options
+        self._uids = 0
+
+    @gen.coroutine
+    def connect_clients(self, count):
+        ports = self.cluster.ports
+        clients = [LoadClient() for i in range(count)]
+        yield [c.connect(ports[i % len(ports)])
+               for i, c in enumerate(clients)]
+        if self.options.compression:
+            for c in clients:
+                c.request_compression()
+        return clients
+
+    @gen.coroutine
+    def sign_in(self, clients, locations=None):
+        futures = []
+        for i, c in enumerate(clients):
+            self._uids += 1
+            c.uid = str(self._uids)
+            kwargs = dict(username='user' + c.uid)
+            if locations:
+                kwargs['loc'] = locations[i % len(locations)]
+                c.location = kwargs['loc']
+                futures.append(c.expect('location.init', ident=c.location))
+            else:
+                futures.append(c.expect('sign_id'))
+            c.s.sign_id(**kwargs)
+        yield futures
+
+    def close(self, clients):
+        for c in clients:
+            c.close()
+
+    def wait(self, future):
+        return gen.with_timeout(IOLoop.current().time() +
+                                self.options.timeout, future)
+
+    @gen.coroutine
+    def echo(self):
+        opts = self.options
+        clients = yield self.connect_clients(opts.clients)
+        rec = Recorder()
+
+        @gen.coroutine
+        def worker(client):
+            for i in range(opts.requests):
+                future = client.expect('echo')
+                sent_at = perf_counter()
+                client.s.echo(text=str(i))
+                try:
+                    yield self.wait(future)
+                except gen.TimeoutError:
+                    rec.errors += 1
+                    return
+                rec.observe(sent_at)
+
+        rec.begin()
+        yield [worker(c) for c in clients]
+        rec.end()
+        self.close(clients)
+        return rec
+
+    @gen.coroutine
+    def fanout(self):
+        opts = self.options
+        clients = yield self.connect_clients(opts.clients)
+        rec = Recorder()
+        expected = opts.clients * opts.publishes
+        done = Future()
+        channel = 'bench'
+
+        def on_message(client, msg):
+            text = msg['kwargs']['text']
+            rec.observe_once((client, text), float(text))
+            if len(rec.latencies) == expected and not done.done():
+                done.set_result(None)
+
+        for c in clients:
+            c.listeners['message_from_channel'] = partial(on_message, c)
+            c.s.channels.subscribe(channel=channel)
+        # subscriptions travel to the broker asynchronously
+        yield gen.sleep(opts.settle)
+        rec.begin()
+        publishers = clients[:len(self.cluster.ports)]
+        for i in range(opts.publishes):
+            publisher = publishers[i % len(publishers)]
+            publisher.s.channels.publish(channel=channel,
+                                         text=repr(perf_counter()))
+            yield gen.moment
+        try:
+            yield self.wait(done)
+        except gen.TimeoutError:
+            rec.errors = expected - len(rec.latencies)
+        rec.end()
+        self.close(clients)
+        return rec
+
+    @gen.coroutine
+    def send_to_user(self):
+        opts = self.options
+        clients = yield self.connect_clients(opts.clients)
+        yield self.sign_in(clients)
+        yield gen.sleep(opts.settle)
+        rec = Recorder()
+        expected = opts.clients * opts.requests
+        done = Future()
+
+        def on_message(client, msg):
+            kwargs = msg['kwargs']
+            rec.observe_once((client, kwargs['uid'], kwargs['text']),
+                             float(kwargs['text']))
+            if len(rec.latencies) == expected and not done.done():
+                done.set_result(None)
+
+        for c in clients:
+            c.listeners['message_from_user'] = partial(on_message, c)
+        # the receiver is connected to the next server, so messages
+        # go through the broker when several servers are running
+        receivers = clients[1:] + clients[:1]
+        rec.begin()
+        for i in range(opts.requests):
+            for c, receiver in zip(clients, receivers):
+                c.s.send_to_user(receiver=receiver.uid,
+                                 text=repr(perf_counter()))
+            yield gen.moment
+        try:
+            yield self.wait(done)
+        except gen.TimeoutError:
+            rec.errors = expected - len(rec.latencies)
+        rec.end()
+        self.close(clients)
+        return rec
+
+    @gen.coroutine
+    def location(self):
+        opts = self.options
+        locations = self.cluster.locations
+        if len(locations) < 2:
+            raise ValueError('location scenario needs 2 locations at least')
+        clients = yield self.connect_clients(opts.clients)
+        rec = Recorder()
+        rec.begin()
+        enter_start = perf_counter()
+        yield self.sign_in(clients, locations)
+        enter_seconds = perf_counter() - enter_start
+
+        @gen.coroutine
+        def worker(client):
+            idx = locations.index(client.location)
+            for i in range(opts.requests):
+                idx = (idx + 1) % len(locations)
+                target = locations[idx]
+                future = client.expect('location.init', ident=target)
+                sent_at = perf_counter()
+                client.s.location.move_to(target_location=target)
+                try:
+                    yield self.wait(future)
+                except gen.TimeoutError:
+                    rec.errors += 1
+                    return
+                rec.observe(sent_at)
+
+        yield [worker(c) for c in clients]
+        rec.end()
+        rec.enter_seconds = enter_seconds
+        self.close(clients)
+        return rec
+
+    @gen.coroutine
+    def run(self, scenarios):
+        results = {}
+        for name in scenarios:
+            before = self.cluster.usage()
+            rec = yield getattr(self, name)()
+            after = self.cluster.usage()
+            res = rec.result()
+            if hasattr(rec, 'enter_seconds'):
+                res['enter_seconds'] = round(rec.enter_seconds, 4)
+            res['processes'] = usage_delta(before, after)
+            results[name] = res
+            yield gen.sleep(self.options.settle)
+        return results
+
+
+def compare(base_file, new_file):
+    with open(base_file) as f:
+        base = json.load(f)['scenarios']
+    with open(new_file) as f:
+        new = json.load(f)['scenarios']
+    metrics = ['throughput'] + [n + '_ms' for n, _ in PERCENTILES]
+    for name in SCENARIOS:
+        if name not in base or name not in new:
+            continue
+        print(name)
+        for metric in metrics:
+            old_val, new_val = base[name][metric], new[name][metric]
+            if not old_val or new_val is None:
+                continue
+            change = (new_val - old_val) / old_val * 100
+            print('  {:<12} {:>12} {:>12} {:>+8.1f}%'.format(
+                                    metric, old_val, new_val, change))
+
+
+def main(options):
+    if options.compare:
+        compare(*options.compare)
+        return
+    cluster = Cluster(options.config, options.servers, options.locations,
+                      options.port, options.loc_port, options.start_sleep,
+                      options.debug)
+    scenarios = options.scenarios
+    if len(cluster.locations) < 2 and 'location' in scenarios:
+        scenarios = [s for s in scenarios if s != 'location']
+    cluster.start()
+    try:
+        bench = Benchmark(cluster, options)
+        results = IOLoop.current().run_sync(partial(bench.run, scenarios))
+    finally:
+        cluster.stop()
+    report = {'options': {'servers': options.servers,
+                          'locations': options.locations,
+                          'clients': options.clients,
+                          'requests': options.requests,
+                          'publishes': options.publishes},
+              'scenarios': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print(output)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', action='store', dest='config',
+                        help='path to config file', type=str,
+                        default=os.path.join(TESTS_DIR, 'config.yaml'))
+    parser.add_argument('-s', '--servers', help='number of outer servers',
+                        action='store', dest='servers', type=int, default=2)
+    parser.add_argument('-l', '--locations', help='number of locations',
+                        action='store', dest='locations', type=int, default=2)
+    parser.add_argument('-cl', '--clients', help='number of clients',
+                        action='store', dest='clients', type=int,
+                        default=1000)
+    parser.add_argument('-r', '--requests',
+                        help='requests per client in a scenario',
+                        action='store', dest='requests', type=int, default=20)
+    parser.add_argument('-pb', '--publishes',
+                        help='channel publishes in the fanout scenario',
+                        action='store', dest='publishes', type=int,
+                        default=20)
+    parser.add_argument('--scenarios', action='store', dest='scenarios',
+                        nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('-p', '--port', help='port of the first server',
+                        action='store', dest='port', type=int, default=7770)
+    parser.add_argument('-lp', '--loc-port',
+                        help='first port of location sockets',
+                        action='store', dest='loc_port', type=int,
+                        default=8770)
+    parser.add_argument('--compression', action='store_true',
+                        dest='compression',
+                        help='request compression extension from servers')
+    parser.add_argument('--timeout', help='seconds to wait for responses',
+                        action='store', dest='timeout', type=float,
+                        default=10)
+    parser.add_argument('--settle', help='seconds to wait for subscriptions',
+                        action='store', dest='settle', type=float, default=1)
+    parser.add_argument('--start-sleep', help='seconds to wait for startup',
+                        action='store', dest='start_sleep', type=float,
+                        default=1)
+    parser.add_argument('-o', '--output', help='path to json output',
+                        action='store', dest='output', type=str, default=None)
+    parser.add_argument('--compare', help='compare two json outputs',
+                        action='store', dest='compare', nargs=2,
+                        metavar=('BASE', 'NEW'), default=None)
+    parser.add_argument('-d', '--debug', action='store_true',
+                        dest='debug', help='set debug level of logging')
+    main(parser.parse_args())
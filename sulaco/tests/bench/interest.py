@@ -0,0 +1,89 @@
+"""
+Area-of-interest publishing with moving entities.
+
+Usage: python -m sulaco.tests.bench.interest [-n 5000] [--ticks 20]
+
+Every entity is a user with an interest radius. On every tick all
+entities make a random step and every entity publishes one event
+at its position. The benchmark reports index update and query times
+and how many messages are delivered compared with publishing
+every event to the whole location.
+"""
+
+import json
+import random
+import argparse
+
+from time import perf_counter
+
+from sulaco.location_server.interest import InterestGrid
+
+
+def run(count, ticks, world, radius, cell_size, step, seed=0):
+    rnd = random.Random(seed)
+    grid = InterestGrid(cell_size)
+    positions = []
+    for entity in range(count):
+        x, y = rnd.uniform(0, world), rnd.uniform(0, world)
+        positions.append([x, y])
+        grid.add(entity, x, y, radius)
+
+    move_time = 0
+    query_time = 0
+    delivered = 0
+    for tick in range(ticks):
+        start = perf_counter()
+        for entity, pos in enumerate(positions):
+            pos[0] = min(world, max(0, pos[0] + rnd.uniform(-step, step)))
+            pos[1] = min(world, max(0, pos[1] + rnd.uniform(-step, step)))
+            grid.move(entity, pos[0], pos[1])
+        move_time += perf_counter() - start
+
+        start = perf_counter()
+        for entity, (x, y) in enumerate(positions):
+            delivered += len(grid.observers(x, y, exclude=entity))
+        query_time += perf_counter() - start
+
+    events = count * ticks
+    broadcast = events * (count - 1)
+    return {'entities': count,
+            'ticks': ticks,
+            'move_us': round(move_time / events * 1e6, 3),
+            'query_us': round(query_time / events * 1e6, 3),
+            'tick_ms': round((move_time + query_time) / ticks * 1e3, 2),
+            'recipients_per_event': round(delivered / events, 1),
+            'delivered': delivered,
+            'broadcast': broadcast,
+            'reduction': round(broadcast / max(delivered, 1), 1)}
+
+
+def main(options):
+    result = run(options.count, options.ticks, options.world,
+                 options.radius, options.cell_size or options.radius,
+                 options.step)
+    if options.json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        print('{:<22} {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', help='number of entities',
+                        action='store', dest='count', type=int, default=5000)
+    parser.add_argument('--ticks', help='number of ticks', action='store',
+                        dest='ticks', type=int, default=20)
+    parser.add_argument('--world', help='side of the square world',
+                        action='store', dest='world', type=float,
+                        default=2000)
+    parser.add_argument('--radius', help='interest radius', action='store',
+                        dest='radius', type=float, default=100)
+    parser.add_argument('--cell-size', help='grid cell size, radius '
+                        'by default', action='store', dest='cell_size',
+                        type=float, default=None)
+    parser.add_argument('--step', help='max step per tick', action='store',
+                        dest='step', type=float, default=5)
+    parser.add_argument('--json', help='print results as json',
+                        action='store_true', dest='json')
+    main(parser.parse_args())
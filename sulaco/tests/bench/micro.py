@@ -0,0 +1,363 @@
+"""
+Microbenchmarks of the paths every message goes through.
+
+Usage:
+    python -m sulaco.tests.bench.micro                    # run all
+    python -m sulaco.tests.bench.micro -k dispatch        # filter by name
+    python -m sulaco.tests.bench.micro --save base.json   # save baseline
+    python -m sulaco.tests.bench.micro --baseline base.json -t 0.1
+
+With --baseline the exit status is 1 if any benchmark got slower than
+the baseline by more than the threshold (a fraction, 0.1 is 10%).
+"""
+
+import sys
+import json
+import random
+import argparse
+import msgpack
+
+from time import perf_counter
+
+from sulaco.utils import Config, Sender
+from sulaco.utils.receiver import (
+    root_dispatch, message_router, message_receiver, ProxyMixin, USER_SIGN)
+from sulaco.outer_server.tcp_server import SimpleProtocol
+from sulaco.outer_server.connection_manager import (
+    ConnectionHandler, ConnectionManager)
+from sulaco.location_server.interest import InterestGrid
+from sulaco.utils.timers import TimerWheel
+
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """ Registers a factory returning the function to measure """
+
+    def wrapper(factory):
+        BENCHMARKS.append((name, factory))
+        return factory
+    return wrapper
+
+
+### dispatch ###
+
+class Node(ProxyMixin):
+
+    @message_router()
+    def router(self, next_step, **kwargs):
+        yield from next_step(self)
+
+    @message_receiver()
+    def receiver(self, **kwargs):
+        pass
+
+    @message_receiver(USER_SIGN)
+    def signed(self, **kwargs):
+        pass
+
+    def proxy_method(self, path, sign, kwargs):
+        pass
+
+
+def dispatch_bench(path, sign=None):
+    root = Node()
+    path = path.split('.')
+    def run():
+        root_dispatch(root, path, {'a': 1}, sign)
+    return run
+
+
+@benchmark('dispatch.shallow')
+def _():
+    return dispatch_bench('receiver')
+
+
+@benchmark('dispatch.shallow_signed')
+def _():
+    return dispatch_bench('signed', USER_SIGN)
+
+
+@benchmark('dispatch.deep5')
+def _():
+    return dispatch_bench('router.router.router.router.receiver')
+
+
+@benchmark('dispatch.proxy')
+def _():
+    return dispatch_bench('router.router.unknown.method')
+
+
+### sender ###
+
+@benchmark('sender.construct')
+def _():
+    send = lambda msg: None
+    def run():
+        Sender(send).location.chat.message
+    return run
+
+
+@benchmark('sender.call')
+def _():
+    s = Sender(lambda msg: None)
+    def run():
+        s.location.chat.message(text='hello', uid=1)
+    return run
+
+
+### config ###
+
+@benchmark('config.attr')
+def _():
+    config = Config({'outer_server': {'location_handler_path': 'location'},
+                     'location': {'heartbeat_period': 1}}, True)
+    def run():
+        config.outer_server.location_handler_path
+    return run
+
+
+### protocol ###
+
+class NullStream(object):
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_bytes(self, num_bytes, callback):
+        pass
+
+    def write(self, data, callback=None):
+        pass
+
+    def writing(self):
+        return False
+
+    def closed(self):
+        return False
+
+
+class NullProtocol(SimpleProtocol):
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        pass
+
+
+MESSAGE = {'path': 'location.user_connected',
+           'kwargs': {'user': {'username': 'user1', 'uid': '1'}}}
+LARGE_MESSAGE = {'path': 'location.init',
+                 'kwargs': {'ident': 'loc_X',
+                            'users': [{'username': 'user' + str(i),
+                                       'uid': str(i)} for i in range(1000)]}}
+
+
+@benchmark('protocol.send')
+def _():
+    proto = NullProtocol(NullStream())
+    def run():
+        proto.send(MESSAGE)
+    return run
+
+
+@benchmark('protocol.receive')
+def _():
+    proto = NullProtocol(NullStream())
+    body = proto.message_dumper(MESSAGE)
+    header = str(len(body)).encode('utf-8').rjust(proto._header_bytes, b'0')
+    def run():
+        proto._on_header(header)
+        proto._on_body(body)
+    return run
+
+
+### msgpack ###
+
+def msgpack_bench(message):
+    def run():
+        msgpack.loads(msgpack.dumps(message), encoding='utf-8')
+    return run
+
+
+@benchmark('msgpack.small')
+def _():
+    return msgpack_bench(MESSAGE)
+
+
+@benchmark('msgpack.large')
+def _():
+    return msgpack_bench(LARGE_MESSAGE)
+
+
+### fan-out ###
+
+class NullConnection(ConnectionHandler, NullProtocol):
+    __slots__ = ConnectionHandler.connection_slots
+
+
+def fanout_bench(size):
+    connman = ConnectionManager()
+    stream = NullStream()
+    for i in range(size):
+        conn = NullConnection(stream)
+        conn.setup(connman, None)
+        conn.on_open()
+        connman.add_connection_to_channel(conn, 'chan')
+    def run():
+        connman.publish_to_channel('chan', MESSAGE)
+    return run
+
+
+for size in (10, 1000, 10000):
+    benchmark('fanout.channel_{}'.format(size))(
+                    lambda size=size: fanout_bench(size))
+
+
+### area of interest ###
+
+def interest_grid(count=5000, world=2000, radius=100):
+    rnd = random.Random(0)
+    grid = InterestGrid(radius)
+    for entity in range(count):
+        grid.add(entity, rnd.uniform(0, world), rnd.uniform(0, world),
+                 radius)
+    return grid
+
+
+@benchmark('interest.move100_5k')
+def _():
+    grid = interest_grid()
+    steps = [(1, 1), (-1, -1)] * 50
+    def run():
+        for entity, (dx, dy) in enumerate(steps):
+            x, y = grid.position(entity)
+            grid.move(entity, x + dx, y + dy)
+    return run
+
+
+@benchmark('interest.query_5k')
+def _():
+    grid = interest_grid()
+    def run():
+        grid.observers(1000, 1000)
+    return run
+
+
+### timers ###
+
+class WheelLoop(object):
+    """ The time of the wheel, ticks are run by the benchmark """
+
+    wheel = None
+
+    def time(self):
+        current = self.wheel._current
+        return 0 if current is None else current * self.wheel.resolution
+
+    def add_timeout(self, deadline, callback):
+        return None
+
+
+def timer_wheel():
+    loop = WheelLoop()
+    wheel = loop.wheel = TimerWheel(ioloop=loop, name='bench')
+    return wheel
+
+
+@benchmark('timers.schedule_cancel')
+def _():
+    wheel = timer_wheel()
+    def run():
+        wheel.call_later(30, None).cancel()
+    return run
+
+
+@benchmark('timers.tick_50k')
+def _():
+    # 50k re-armed timers, a cooldown of 1-60 seconds each
+    wheel = timer_wheel()
+    rnd = random.Random(0)
+    delays = [rnd.uniform(1, 60) for i in range(1000)]
+    def rearm(i):
+        wheel.call_later(delays[i % 1000], rearm, i + 1)
+    for i in range(50000):
+        rearm(i)
+    return wheel._tick
+
+
+### runner ###
+
+def measure(func, min_time, repeat):
+    """ Returns the best time of one call in nanoseconds """
+
+    loops = 1
+    while True:
+        start = perf_counter()
+        for i in range(loops):
+            func()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for i in range(repeat - 1):
+        start = perf_counter()
+        for i in range(loops):
+            func()
+        best = min(best, perf_counter() - start)
+    return best / loops * 1e9
+
+
+def main(options):
+    results = {}
+    for name, factory in BENCHMARKS:
+        if options.keyword and options.keyword not in name:
+            continue
+        results[name] = round(measure(factory(), options.min_time,
+                                      options.repeat), 1)
+    baseline = {}
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    for name, ns in results.items():
+        line = '{:<28} {:>14.1f} ns'.format(name, ns)
+        if name in baseline:
+            change = (ns - baseline[name]) / baseline[name]
+            line += ' {:>+8.1f}%'.format(change * 100)
+            if change > options.threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+    if options.save is not None:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--keyword', help='run matching benchmarks',
+                        action='store', dest='keyword', type=str,
+                        default=None)
+    parser.add_argument('--save', help='save results as baseline',
+                        action='store', dest='save', type=str, default=None)
+    parser.add_argument('--baseline', help='compare with saved baseline',
+                        action='store', dest='baseline', type=str,
+                        default=None)
+    parser.add_argument('-t', '--threshold',
+                        help='allowed slowdown as a fraction',
+                        action='store', dest='threshold', type=float,
+                        default=0.1)
+    parser.add_argument('--min-time', help='minimal seconds of one repeat',
+                        action='store', dest='min_time', type=float,
+                        default=0.2)
+    parser.add_argument('-r', '--repeat', help='number of repeats',
+                        action='store', dest='repeat', type=int, default=5)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,80 @@
+"""
+Memory footprint of idle connections in the connection registry.
+
+Usage: python -m sulaco.tests.bench.registry [-n 10000 100000 500000]
+
+Each connection is a protocol object registered in ConnectionManager and
+bound to a uid. All connections share one stub stream, so the numbers
+cover the registry and protocol objects only, not tornado's IOStream.
+"""
+
+import gc
+import json
+import argparse
+import tracemalloc
+
+from sulaco.outer_server.tcp_server import SimpleProtocol
+from sulaco.outer_server.connection_manager import (
+    ConnectionHandler, ConnectionManager)
+
+
+class Protocol(ConnectionHandler, SimpleProtocol):
+    __slots__ = ConnectionHandler.connection_slots
+
+
+class IdleStream(object):
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_bytes(self, num_bytes, callback):
+        pass
+
+    def closed(self):
+        return False
+
+
+def measure(count, channels=0):
+    stream = IdleStream()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    connman = ConnectionManager()
+    for i in range(count):
+        conn = Protocol(stream)
+        conn.setup(connman, None)
+        conn.on_open()
+        connman.bind_connection_to_uid(conn, 'user' + str(i))
+        for c in range(channels):
+            connman.add_connection_to_channel(conn, 'channel' + str(c))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+def main(options):
+    results = []
+    for count in options.counts:
+        per_conn = measure(count, options.channels)
+        results.append({'connections': count,
+                        'channels_per_connection': options.channels,
+                        'bytes_per_connection': round(per_conn, 1)})
+        if not options.json:
+            print('{:>8} connections: {:8.1f} bytes/connection'.format(
+                                                        count, per_conn))
+    if options.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--counts', help='connection counts',
+                        action='store', dest='counts', type=int, nargs='+',
+                        default=[10000, 100000, 500000])
+    parser.add_argument('-ch', '--channels',
+                        help='channels joined by every connection',
+                        action='store', dest='channels', type=int, default=0)
+    parser.add_argument('--json', action='store_true', dest='json',
+                        help='print results as json')
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+"""
+Outbound bytes of full state pushes and delta synchronization.
+
+Usage: python -m sulaco.tests.bench.sync [-n 200] [--ticks 50]
+
+A location has `n` users, every user sees all user objects.
+On every tick a fraction of the users move (x and y change) and
+every recipient gets either the full user list or the deltas
+of StateSync. Clients acknowledge every applied message, so the
+steady state is one delta per changed object.
+"""
+
+import json
+import random
+import argparse
+import msgpack
+
+from sulaco.location_server.sync import StateSync
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.bytes = 0
+        self.messages = 0
+        self.last = {}
+
+    def private_message(self, uid, msg):
+        self.bytes += len(msgpack.dumps(msg))
+        self.messages += 1
+        self.last[uid] = msg
+
+
+def user(uid, rnd):
+    return {'uid': uid, 'name': 'user_{}'.format(uid),
+            'x': rnd.randint(0, 1000), 'y': rnd.randint(0, 1000),
+            'hp': 100, 'level': rnd.randint(1, 50), 'state': 'idle'}
+
+
+def run(count, ticks, moving, seed=0):
+    rnd = random.Random(seed)
+    users = {str(uid): user(uid, rnd) for uid in range(count)}
+    full = Counter()
+    delta = Counter()
+    sync = StateSync(delta)
+    for uid, state in users.items():
+        sync.set(uid, state)
+        sync.add_recipient(uid)
+    sync.flush()
+    delta.bytes = delta.messages = 0
+
+    for tick in range(ticks):
+        for uid in rnd.sample(sorted(users), int(count * moving)):
+            state = users[uid]
+            state['x'] += rnd.randint(-5, 5)
+            state['y'] += rnd.randint(-5, 5)
+            sync.update(uid, {'x': state['x'], 'y': state['y']})
+        users_list = list(users.values())
+        for uid in users:
+            full.private_message(uid, {'path': 'users',
+                                       'kwargs': {'users': users_list}})
+        sync.flush()
+        for uid, msg in delta.last.items():
+            sync.ack(uid, {e['name']: e['version']
+                           for e in msg['kwargs']['objects']
+                           if 'version' in e})
+        delta.last.clear()
+
+    return {'users': count,
+            'ticks': ticks,
+            'moving': moving,
+            'full_bytes': full.bytes,
+            'delta_bytes': delta.bytes,
+            'full_bytes_per_message': full.bytes // max(full.messages, 1),
+            'delta_bytes_per_message': delta.bytes // max(delta.messages, 1),
+            'reduction': round(full.bytes / max(delta.bytes, 1), 1)}
+
+
+def main(options):
+    result = run(options.count, options.ticks, options.moving)
+    if options.json:
+        print(json.dumps(result, indent=2))
+        return
+    for key, value in result.items():
+        print('{:<24} {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', help='number of users',
+                        action='store', dest='count', type=int, default=200)
+    parser.add_argument('--ticks', help='number of ticks', action='store',
+                        dest='ticks', type=int, default=50)
+    parser.add_argument('--moving', help='fraction of users moving '
+                        'on every tick', action='store', dest='moving',
+                        type=float, default=0.1)
+    parser.add_argument('--json', help='print results as json',
+                        action='store_true', dest='json')
+    main(parser.parse_args())
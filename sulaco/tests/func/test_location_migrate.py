@@ -0,0 +1,31 @@
+from time import time
+from sulaco.tests.tools import BasicFuncTest
+
+
+class TestLocationMigrate(BasicFuncTest):
+
+    def runTest(self):
+        self.run_server(7770, 5)
+        c = self.client()
+        c.connect(7770)
+        self.run_location('loc_X', 'tcp://127.0.0.1:8770',
+                          'tcp://127.0.0.1:8771', 'tcp://127.0.0.1:8772')
+        c.recv(path_prefix='location_added',
+               kwargs_contain={'loc_id': 'loc_X'})
+        c.s.sign_id(username='user1', loc='loc_X')
+        c.recv(path_prefix='location.init')
+
+        source = self._locations['loc_X']
+        self.migrate_location('loc_X', 'tcp://127.0.0.1:8773',
+                              'tcp://127.0.0.1:8774', 'tcp://127.0.0.1:8775')
+        # input goes on without pauses across the cutover
+        count = 0
+        deadline = time() + self.server_start_sleep + 2
+        while time() < deadline:
+            c.s.location.ping(n=count)
+            count += 1
+        for n in range(count):
+            self.assertEqual({'n': n},
+                             c.recv(path_prefix='location.pong')['kwargs'])
+        # the source stops when it doesn't forward input anymore
+        self.assertEqual(0, source.wait(10))
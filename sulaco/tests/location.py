@@ -1,10 +1,17 @@
 import argparse
 import logging
 
+from functools import partial
+from tornado.ioloop import IOLoop
+
 from sulaco.utils import Config, ColorUTCFormatter
+from sulaco.utils.stats import serve_stats
+from sulaco.utils.watchdog import SlowHandlerWatchdog
+from sulaco.utils.trace import Tracer
+from sulaco.utils.lag import LagMonitor
 from zmq.eventloop.ioloop import install
 from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN, USER_SIGN
-from sulaco.location_server.gateway import Gateway
+from sulaco.location_server.gateway import Gateway, MultiLocationGateway
 
 
 class Root(object):
@@ -21,12 +28,25 @@ class Root(object):
         self._gateway.prs(uid).init(users=users, ident=self._ident)
         self._gateway.pubs.user_connected(user=user)
 
+    @message_receiver(USER_SIGN)
+    def ping(self, uid, n):
+        self._gateway.prs(uid).pong(n=n)
+
     @message_receiver(USER_SIGN)
     def move_to(self, uid, target_location):
         del self._users[uid]
         self._gateway.prs(uid).enter(location=target_location)
         self._gateway.pubs.user_disconnected(uid=uid)
 
+    def user_count(self):
+        return len(self._users)
+
+    def snapshot(self):
+        return {'users': self._users}
+
+    def restore(self, state):
+        self._users = state['users']
+
 
 def main(options):
     install()
@@ -37,14 +57,51 @@ def main(options):
     handler.setFormatter(ColorUTCFormatter())
     logger.addHandler(handler)
 
+    if options.slow_handler_ms is not None:
+        SlowHandlerWatchdog(options.slow_handler_ms / 1000).install()
+
     config = Config.load_yaml(options.config)
-    gateway = Gateway(config, options.ident)
-    root = Root(gateway, options.ident)
-    gateway.setup(root)
-    connected = gateway.connect(options.pub_address, options.pull_address)
-    if not connected:
-        return
-    gateway.start()
+    Tracer.install(Tracer.from_config(
+        config.get('trace'), 'location:{}'.format(options.ident)))
+    lag_monitor = LagMonitor.from_config(config.get('lag_monitor'))
+    LagMonitor.install(lag_monitor)
+    lag_monitor.start()
+    ioloop = IOLoop.instance()
+    tick_rate = config.location.get('tick_rate')
+    idents = options.ident.split(',')
+    if len(idents) > 1:
+        host = MultiLocationGateway(config)
+        host.connect(options.pub_address, options.pull_address,
+                     options.migration_address)
+        for ident in idents:
+            gateway = Gateway(config, ident)
+            gateway.setup(Root(gateway, ident))
+            if tick_rate:
+                gateway.enable_ticks(tick_rate)
+            if options.migrate:
+                connected = ioloop.run_sync(
+                                partial(host.take_over, gateway))
+            else:
+                connected = host.add_location(gateway)
+            if not connected:
+                logging.error("Location '%s' isn't connected", ident)
+    else:
+        host = gateway = Gateway(config, options.ident)
+        root = Root(gateway, options.ident)
+        gateway.setup(root)
+        if tick_rate:
+            gateway.enable_ticks(tick_rate)
+        addresses = (options.pub_address, options.pull_address,
+                     options.migration_address)
+        if options.migrate:
+            connected = ioloop.run_sync(partial(gateway.migrate, *addresses))
+        else:
+            connected = gateway.connect(*addresses)
+        if not connected:
+            return
+    if options.stats_port is not None:
+        serve_stats(options.stats_port)
+    host.start()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -55,11 +112,25 @@ if __name__ == '__main__':
                         help='address of zmq pull socket', action='store',
                         dest='pull_address', type=str, required=True)
     parser.add_argument('-ident', '--ident',
-                        help='ident of location that will be processing',
+                        help='ident of location that will be processing, '
+                             'several comma separated idents are hosted '
+                             'in one process',
                         action='store', dest='ident', type=str, required=True)
+    parser.add_argument('-ma', '--migration-address', action='store',
+                        dest='migration_address', type=str, default=None,
+                        help='address of zmq socket for migration requests')
+    parser.add_argument('--migrate', action='store_true', dest='migrate',
+                        help='take running locations over '
+                             'from their processes')
     parser.add_argument('-c', '--config', action='store', dest='config',
                         help='path to config file', type=str, required=True)
     parser.add_argument('-d', '--debug', action='store_true',
                         dest='debug', help='set debug level of logging')
+    parser.add_argument('-sp', '--stats-port', action='store',
+                        dest='stats_port', help='port of stats endpoint',
+                        type=int, default=None)
+    parser.add_argument('--slow-handler-ms', action='store',
+                        dest='slow_handler_ms', type=float, default=None,
+                        help='log handler steps that run longer')
     options = parser.parse_args()
     main(options)
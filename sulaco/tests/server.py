@@ -2,21 +2,29 @@ import argparse
 import logging
 import msgpack
 from random import choice
+from string import ascii_lowercase
 
 from tornado.ioloop import IOLoop
 
-from sulaco.outer_server.tcp_server import TCPServer, SimpleProtocol
+from sulaco.outer_server.tcp_server import (
+    TCPServer, SimpleProtocol, AdmissionControl)
 from sulaco.outer_server.connection_manager import (
-    DistributedConnectionManager,
+    DistributedConnectionManager, ConnectionRateLimit,
     ConnectionHandler, LocationConnectionManager)
 from sulaco.utils.receiver import (
     message_receiver, message_router, LoopbackMixin,
     ProxyMixin, USER_SIGN, INTERNAL_USER_SIGN, INTERNAL_SIGN)
-from sulaco.utils import Config, Sender, ColorUTCFormatter
+from sulaco.utils import Config, Sender, ColorUTCFormatter, trace
+from sulaco.utils.stats import serve_stats
+from sulaco.utils.watchdog import SlowHandlerWatchdog
+from sulaco.utils.lag import LagMonitor
+from sulaco.utils.trace import Tracer
 from zmq.eventloop.ioloop import install
 from sulaco.outer_server.message_manager import (
     MessageManager, LocationMessageManager)
 from sulaco.outer_server.message_manager import LocationRoot
+from sulaco.outer_server.fanout import FanoutScheduler
+from sulaco.outer_server.outbound import OutboundPolicy
 
 
 class Root(LocationRoot, LoopbackMixin):
@@ -36,10 +44,17 @@ class Root(LocationRoot, LoopbackMixin):
 
     @message_receiver()
     def sign_id(self, username, conn, loc=None, **kwargs):
-        uid = username[-1]
+        # uid is the numeric suffix of the username (user1, user42)
+        uid = username.lstrip(ascii_lowercase)
+        if not uid.isdigit():
+            raise ValueError("Username '{}' should end with a number"
+                             .format(username))
         assert uid not in self._users
         self._connman.bind_connection_to_uid(conn, uid)
-        loc = loc or choice(self._config.user.start_locations)
+        if loc is None:
+            # start locations are types, a replica is chosen by load
+            kind = choice(self._config.user.start_locations)
+            loc = self._msgman.placement.choose(kind) or kind
         self._users[uid] = User(username, uid, None, conn)
         conn.s.sign_id(uid=uid)
         self.lbs.location.enter(uid=uid, location=loc)
@@ -59,9 +74,9 @@ class Root(LocationRoot, LoopbackMixin):
             loc_name = location or user.location
         else:
             loc_name = user.location
-        socket = self._msgman.loc_input_sockets.get(loc_name)
+        socket = self._msgman.location_input(loc_name)
         yield from next_step(Location(loc_name, user, socket,
-                                self._connman, self._config))
+                                self._msgman, self._config))
 
     def location_added(self, loc_id, data):
         self._connman.alls.location_added(loc_id=loc_id)
@@ -110,30 +125,39 @@ class User(object):
 
 class Location(ProxyMixin):
 
-    def __init__(self, name, user, loc_input, connman, config):
+    def __init__(self, name, user, loc_input, msgman, config):
         self._name = name
         self._user = user
         self._loc_input = loc_input
-        self._connman = connman
+        self._msgman = msgman
         self._config = config
         self.s = Sender(self.send)
 
     def send(self, msg, sign=INTERNAL_SIGN):
         msg['kwargs']['uid'] = self._user.uid
         msg['sign'] = sign
+        trace.stamp(msg, trace.LOCATION_SEND)
         self._loc_input.send(msgpack.dumps(msg))
 
     @message_receiver(INTERNAL_SIGN)
     def enter(self, **kwargs):
         if self._loc_input is None:
             return
-        connman = self._connman
         user = self._user
-        if user.location is not None and user.location != self._name:
-            connman.remove_user_from_location(user.location, user.uid)
-        user.location = self._name
-        connman.add_user_to_location(self._name, user.uid)
-        self.s.enter(user=user.to_dict())
+        previous = user.location
+
+        def enter():
+            user.location = self._name
+            self.s.enter(user=user.to_dict())
+
+        def failed():
+            logging.warning("User %s didn't enter location '%s'",
+                            user.uid, self._name)
+            if user.location == self._name:
+                user.location = previous
+
+        # the user leaves the previous location when the new one replies
+        self._msgman.handoff(self._name, user.uid, enter, failed)
 
     def proxy_method(self, path, sign, kwargs):
         del kwargs['uid']
@@ -149,7 +173,7 @@ class Location(ProxyMixin):
 
 
 class Protocol(ConnectionHandler, SimpleProtocol):
-    pass
+    __slots__ = ConnectionHandler.connection_slots
 
 
 class ConnManager(LocationConnectionManager, DistributedConnectionManager):
@@ -168,17 +192,48 @@ def main(options):
     handler.setFormatter(ColorUTCFormatter())
     logger.addHandler(handler)
 
+    if options.slow_handler_ms is not None:
+        SlowHandlerWatchdog(options.slow_handler_ms / 1000).install()
+
     config = Config.load_yaml(options.config)
+    Tracer.install(Tracer.from_config(
+        config.get('trace'), 'outer_server:{}'.format(options.port)))
+    lag_monitor = LagMonitor.from_config(config.get('lag_monitor'))
+    LagMonitor.install(lag_monitor)
+    lag_monitor.start()
     msgman = MsgManager(config)
     msgman.connect()
+    fanout = None
+    fanout_conf = config.outer_server.get('fanout')
+    if fanout_conf is not None:
+        fanout = FanoutScheduler.from_config(fanout_conf)
     connman = ConnManager(pub_socket=msgman.pub_to_broker,
                           sub_socket=msgman.sub_to_broker,
-                          locations_sub_socket=msgman.sub_to_locs)
+                          locations_sub_socket=msgman.sub_to_locs,
+                          fanout=fanout)
     root = Root(config, connman, msgman)
     msgman.setup(connman, root)
+    admission = None
+    admission_conf = config.outer_server.get('admission')
+    if admission_conf is not None:
+        admission = AdmissionControl.from_config(admission_conf, lag_monitor)
+    rate_limit = None
+    rate_limit_conf = config.outer_server.get('rate_limit')
+    if rate_limit_conf is not None:
+        rate_limit = ConnectionRateLimit.from_config(rate_limit_conf)
+    Protocol.compression_threshold = config.outer_server.get(
+                                                'compression_threshold')
+    outbound_conf = config.outer_server.get('outbound')
+    if outbound_conf is not None:
+        Protocol.outbound_policy = OutboundPolicy.from_config(outbound_conf)
+        Protocol.max_queued = outbound_conf.get('max_queued',
+                                                Protocol.max_queued)
     server = TCPServer()
-    server.setup(Protocol, connman, root, options.max_conn)
+    server.setup(Protocol, connman, root, options.max_conn,
+                 admission, rate_limit)
     server.listen(options.port)
+    if options.stats_port is not None:
+        serve_stats(options.stats_port)
     IOLoop.instance().start()
 
 
@@ -193,5 +248,11 @@ if __name__ == '__main__':
                         help='path to config file', type=str, required=True)
     parser.add_argument('-d', '--debug', action='store_true',
                         dest='debug', help='set debug level of logging')
+    parser.add_argument('-sp', '--stats-port', action='store',
+                        dest='stats_port', help='port of stats endpoint',
+                        type=int, default=None)
+    parser.add_argument('--slow-handler-ms', action='store',
+                        dest='slow_handler_ms', type=float, default=None,
+                        help='log handler steps that run longer')
     options = parser.parse_args()
     main(options)
@@ -124,6 +124,7 @@ class BasicFuncTest(testing.AsyncTestCase):
         self._servers = []
         self._clients = []
         self._locations = {}
+        self._migrated = [] # processes of locations moved out
 
         # setup broker
         p = path.join(self.dirname, '..', 'outer_server', 'message_broker.py')
@@ -140,7 +141,7 @@ class BasicFuncTest(testing.AsyncTestCase):
         for s in self._servers:
             s.terminate()
             s.wait()
-        for l in self._locations.values():
+        for l in list(self._locations.values()) + self._migrated:
             l.terminate()
             l.wait()
         self._broker.terminate()
@@ -166,24 +167,39 @@ class BasicFuncTest(testing.AsyncTestCase):
             self._servers.append(s)
         sleep(self.server_start_sleep)
 
-    def run_location(self, ident, pub, pull):
-        self.run_locations((ident, pub, pull))
+    def run_location(self, ident, pub, pull, migration=None):
+        self.run_locations((ident, pub, pull, migration))
 
     def run_locations(self, *infos):
-        for ident, pub, pull in infos:
+        for ident, pub, pull, *migration in infos:
             assert ident not in self._locations
-            p = path.join(self.dirname, 'location.py')
-            args = ['python', p,
-                    '-pub', pub,
-                    '-pull', pull,
-                    '-ident', ident,
-                    '-c', self.config]
-            if self.debug:
-                args.append('--debug')
-            l = subprocess.Popen(args)
-            self._locations[ident] = l
+            self._locations[ident] = self._location_process(
+                                        ident, pub, pull, *migration)
         sleep(self.server_start_sleep)
 
+    def migrate_location(self, ident, pub, pull, migration=None):
+        """ Starts a process that takes the running location over """
+
+        self._migrated.append(self._locations.pop(ident))
+        self._locations[ident] = self._location_process(
+                                        ident, pub, pull, migration, True)
+
+    def _location_process(self, ident, pub, pull, migration=None,
+                          migrate=False):
+        p = path.join(self.dirname, 'location.py')
+        args = ['python', p,
+                '-pub', pub,
+                '-pull', pull,
+                '-ident', ident,
+                '-c', self.config]
+        if migration is not None:
+            args.extend(('-ma', migration))
+        if migrate:
+            args.append('--migrate')
+        if self.debug:
+            args.append('--debug')
+        return subprocess.Popen(args)
+
     def shutdown_location(self, ident):
         self._locations.pop(ident).terminate()
 
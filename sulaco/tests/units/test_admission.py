@@ -0,0 +1,84 @@
+import unittest
+from unittest.mock import Mock
+from sulaco.utils.rate import TokenBucket, KeyedTokenBuckets
+from sulaco.outer_server.tcp_server import (
+    TCPServer, SimpleProtocol, AdmissionControl)
+from sulaco.outer_server.connection_manager import (
+    ConnectionManager, ConnectionHandler)
+
+
+class Protocol(ConnectionHandler, SimpleProtocol):
+    __slots__ = ConnectionHandler.connection_slots
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_consume(self):
+        bucket = TokenBucket(10, 2, now=0)
+        self.assertTrue(bucket.consume(0))
+        self.assertTrue(bucket.consume(0))
+        self.assertFalse(bucket.consume(0))
+        self.assertTrue(bucket.consume(0.1))
+        self.assertFalse(bucket.consume(0.1))
+        self.assertTrue(bucket.is_full(10))
+
+    def test_keyed_cleanup(self):
+        buckets = KeyedTokenBuckets(1, 1)
+        self.assertTrue(buckets.consume('a', 0))
+        self.assertFalse(buckets.consume('a', 0.5))
+        self.assertTrue(buckets.consume('b', 0.5))
+        buckets.cleanup(1.2)
+        self.assertEqual(1, len(buckets))
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = Mock()
+        self.ioloop.time.return_value = 0
+        self.lag_monitor = Mock(lag=0)
+        self.admission = AdmissionControl(ip_rate=1, rate=10, burst=2,
+                                          max_lag=0.1,
+                                          lag_monitor=self.lag_monitor,
+                                          ioloop=self.ioloop)
+
+    def test_check(self):
+        admission = self.admission
+        self.assertIsNone(admission.check(('1.1.1.1', 1)))
+        self.assertEqual(('rejected', 'ip_rate'),
+                         admission.check(('1.1.1.1', 2)))
+        self.assertEqual(('rejected', 'rate'),
+                         admission.check(('2.2.2.2', 1)))
+        self.ioloop.time.return_value = 1
+        self.lag_monitor.lag = 0.5
+        self.assertEqual(('shed', 'lag'), admission.check(('3.3.3.3', 1)))
+
+    def test_handle_stream(self):
+        connman = ConnectionManager()
+        server = TCPServer(io_loop=self.ioloop)
+        server.setup(Protocol, connman, None, 1, self.admission)
+        server.handle_stream(Mock(), ('1.1.1.1', 1))
+        self.assertEqual(1, connman.connection_count)
+        stream = Mock()
+        server.handle_stream(stream, ('2.2.2.2', 1))
+        stream.close.assert_called_once_with()
+        self.assertEqual(1, connman.connection_count)
+
+    def test_pause_accepting(self):
+        server = TCPServer(io_loop=self.ioloop)
+        server.setup(Protocol, ConnectionManager(), None, None,
+                     self.admission)
+        server._sockets = {10: Mock()}
+        self.lag_monitor.lag = 0.5
+        stream = Mock()
+        server.handle_stream(stream, ('1.1.1.1', 1))
+        stream.close.assert_called_once_with()
+        self.ioloop.remove_handler.assert_called_once_with(10)
+        self.lag_monitor.lag = 0
+        server._try_resume()
+        self.assertFalse(server._paused)
+        self.ioloop.add_handler.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
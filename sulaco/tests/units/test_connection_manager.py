@@ -1,14 +1,17 @@
 import unittest
 import zmq
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
 from sulaco.outer_server.tcp_server import SimpleProtocol
 from sulaco.outer_server.connection_manager import (
-    DistributedConnectionManager,
-    LocationConnectionManager, ConnectionHandler)
+    DistributedConnectionManager, ConnectionManager,
+    LocationConnectionManager, ConnectionHandler, ConnectionRateLimit)
+from sulaco.outer_server.outbound import (
+    OutboundLanes, OutboundPolicy, CONTROL, NORMAL, BULK)
+from sulaco.utils.receiver import message_receiver, message_router
 
 
 class Protocol(ConnectionHandler, SimpleProtocol):
-    pass
+    __slots__ = ConnectionHandler.connection_slots
 
 
 class TestDistributedConnectionManager(unittest.TestCase):
@@ -27,8 +30,8 @@ class TestDistributedConnectionManager(unittest.TestCase):
         conn.on_open()
         connman = self.connman
         connman.bind_connection_to_uid(conn, 111)
-        self.assertEqual({conn: 111}, connman._connection_to_uid)
-        self.assertEqual({111: conn}, connman._uid_to_connection)
+        self.assertEqual({conn.conn_id: 111}, connman._connection_to_uid)
+        self.assertEqual({111: conn.conn_id}, connman._uid_to_connection)
         connman._sub_socket.setsockopt.assert_called_with(zmq.SUBSCRIBE,
                                                           b'send_by_uid:111')
 
@@ -37,8 +40,10 @@ class TestDistributedConnectionManager(unittest.TestCase):
         conn.on_open()
         connman = self.connman
         connman.add_connection_to_channel(conn, 'chan')
-        self.assertEqual({'chan': {conn,}}, connman._channel_to_connections)
-        self.assertEqual({conn: {'chan',}}, connman._connection_to_channels)
+        self.assertEqual({'chan': {conn.conn_id,}},
+                         connman._channel_to_connections)
+        self.assertEqual({conn.conn_id: {'chan',}},
+                         connman._connection_to_channels)
         connman._sub_socket.setsockopt.assert_called_with(zmq.SUBSCRIBE,
                                                 b'publish_to_channel:chan')
 
@@ -49,10 +54,31 @@ class TestDistributedConnectionManager(unittest.TestCase):
         connman.add_connection_to_channel(conn, 'chan')
         connman.remove_connection_from_channel(conn, 'chan')
         self.assertEqual({}, connman._channel_to_connections)
-        self.assertEqual({conn: set()}, connman._connection_to_channels)
+        self.assertEqual({}, connman._connection_to_channels)
         connman._sub_socket.setsockopt.assert_called_with(zmq.UNSUBSCRIBE,
                                                 b'publish_to_channel:chan')
 
+    def test_lookups_do_not_create_entries(self):
+        conn = self.get_connection()
+        conn.on_open()
+        connman = self.connman
+        connman.publish_to_channel('unknown', {})
+        with self.assertRaises(KeyError):
+            connman.remove_connection_from_channel(conn, 'unknown')
+        self.assertEqual({}, connman._channel_to_connections)
+        self.assertEqual({}, connman._connection_to_channels)
+
+    def test_connection_ids(self):
+        conn1 = self.get_connection()
+        conn1.on_open()
+        conn2 = self.get_connection()
+        conn2.on_open()
+        self.assertEqual((1, 2), (conn1.conn_id, conn2.conn_id))
+        self.assertEqual({1: conn1, 2: conn2}, self.connman._connections)
+        self.connman.bind_connection_to_uid(conn2, 'user')
+        self.assertIs(conn2, self.connman.get_connection('user'))
+        self.assertEqual('user', self.connman.get_uid(conn2))
+
     def test_remove_connection(self):
         conn = self.get_connection()
         conn.on_open()
@@ -60,7 +86,7 @@ class TestDistributedConnectionManager(unittest.TestCase):
         connman.bind_connection_to_uid(conn, 222)
         connman.add_connection_to_channel(conn, 'ccc')
         connman.remove_connection(conn)
-        self.assertEqual(set(), connman._connections)
+        self.assertEqual({}, connman._connections)
         self.assertEqual({}, connman._connection_to_uid)
         self.assertEqual({}, connman._uid_to_connection)
         self.assertEqual({}, connman._channel_to_connections)
@@ -99,9 +125,12 @@ class TestLocationDistributedConnectionManager(unittest.TestCase):
         connman.add_user_to_location('fooloc', 111)
         self.assertEqual({111:'fooloc'}, connman._uid_to_location)
         self.assertEqual({'fooloc': {111}}, connman._location_to_uids)
+        connman.publish_to_location('unknown', {})
+        self.assertNotIn('unknown', connman._location_to_uids)
         self.assertEqual([
             call(zmq.SUBSCRIBE, b'private_message_from_location:fooloc:111'),
-            call(zmq.SUBSCRIBE, b'public_message_from_location:fooloc')],
+            call(zmq.SUBSCRIBE, b'public_message_from_location:fooloc'),
+            call(zmq.SUBSCRIBE, b'multicast_message_from_location:fooloc')],
         connman._locs_sub_socket.setsockopt.call_args_list)
 
     def test_remove_connection(self):
@@ -112,7 +141,7 @@ class TestLocationDistributedConnectionManager(unittest.TestCase):
         connman.add_user_to_location('megaloc', 222)
         connman.add_connection_to_channel(conn, 'ccc')
         connman.remove_connection(conn)
-        self.assertEqual(set(), connman._connections)
+        self.assertEqual({}, connman._connections)
         self.assertEqual({}, connman._connection_to_uid)
         self.assertEqual({}, connman._uid_to_connection)
         self.assertEqual({}, connman._channel_to_connections)
@@ -128,10 +157,177 @@ class TestLocationDistributedConnectionManager(unittest.TestCase):
         self.assertEqual([
             call(zmq.SUBSCRIBE, b'private_message_from_location:megaloc:222'),
             call(zmq.SUBSCRIBE, b'public_message_from_location:megaloc'),
+            call(zmq.SUBSCRIBE, b'multicast_message_from_location:megaloc'),
             call(zmq.UNSUBSCRIBE, b'private_message_from_location:megaloc:222'),
-            call(zmq.UNSUBSCRIBE, b'public_message_from_location:megaloc')],
+            call(zmq.UNSUBSCRIBE, b'public_message_from_location:megaloc'),
+            call(zmq.UNSUBSCRIBE,
+                 b'multicast_message_from_location:megaloc')],
         connman._locs_sub_socket.setsockopt.call_args_list)
 
+    @patch.object(Protocol, 'send', return_value=None)
+    def test_reenter_handoff(self, send):
+        conn = self.get_connection()
+        conn.on_open()
+        connman = self.connman
+        connman.bind_connection_to_uid(conn, '1')
+        connman.add_user_to_location('a', '1')
+        ioloop = Mock()
+        ioloop.time.return_value = 0
+        first = connman.begin_handoff('a', '1', ioloop)
+        connman.begin_handoff('a', '1', ioloop)
+        ioloop.remove_timeout.assert_called_once_with(first.timeout)
+        # the state before the user entered comes with the reply
+        connman.publish_to_location('a', {'path': 'a'})
+        connman.complete_handoff('1', ioloop=ioloop)
+        self.assertFalse(send.called)
+        self.assertEqual({'1': 'a'}, connman._uid_to_location)
+        connman.publish_to_location('a', {'path': 'b'})
+        self.assertEqual([call({'path': 'b'})], send.call_args_list)
+
+    @patch.object(Protocol, 'send', return_value=None)
+    def test_handoff(self, send):
+        conn = self.get_connection()
+        conn.on_open()
+        connman = self.connman
+        connman.bind_connection_to_uid(conn, '1')
+        connman.add_user_to_location('a', '1')
+        sub = connman._locs_sub_socket.setsockopt
+        sub.reset_mock()
+        ioloop = Mock()
+        ioloop.time.return_value = 0
+        connman.begin_handoff('b', '1', ioloop)
+        self.assertEqual(['1'], connman.entering_users('b', ['1', '2']))
+        connman.publish_to_location('b', {'path': 'b'})
+        connman.publish_to_location('a', {'path': 'a'})
+        self.assertEqual([call({'path': 'a'})], send.call_args_list)
+        handoff = connman.complete_handoff('1', ioloop=ioloop)
+        self.assertEqual('b', handoff.target)
+        ioloop.remove_timeout.assert_called_once_with(handoff.timeout)
+        connman.publish_to_location('b', {'path': 'c'})
+        self.assertEqual([call({'path': 'a'}), call({'path': 'c'})],
+                         send.call_args_list)
+        self.assertEqual({'1': 'b'}, connman._uid_to_location)
+        self.assertIsNone(connman.handoff('1'))
+        self.assertEqual([], connman.entering_users('b', ['1']))
+        self.assertEqual([
+            call(zmq.SUBSCRIBE, b'private_message_from_location:b:1'),
+            call(zmq.SUBSCRIBE, b'public_message_from_location:b'),
+            call(zmq.SUBSCRIBE, b'multicast_message_from_location:b'),
+            call(zmq.UNSUBSCRIBE, b'private_message_from_location:a:1'),
+            call(zmq.UNSUBSCRIBE, b'public_message_from_location:a'),
+            call(zmq.UNSUBSCRIBE, b'multicast_message_from_location:a')],
+        sub.call_args_list)
+
+    @patch.object(Protocol, 'send', return_value=None)
+    def test_handoff_timeout(self, send):
+        conn = self.get_connection()
+        conn.on_open()
+        connman = self.connman
+        connman.bind_connection_to_uid(conn, '1')
+        connman.add_user_to_location('a', '1')
+        sub = connman._locs_sub_socket.setsockopt
+        sub.reset_mock()
+        ioloop = Mock()
+        ioloop.time.return_value = 0
+        on_fail = Mock()
+        connman.begin_handoff('b', '1', ioloop, on_fail)
+        expired = ioloop.add_timeout.call_args[0][1]
+        expired()
+        on_fail.assert_called_once_with()
+        self.assertIsNone(connman.handoff('1'))
+        self.assertEqual({'1': 'a'}, connman._uid_to_location)
+        self.assertEqual([
+            call(zmq.SUBSCRIBE, b'private_message_from_location:b:1'),
+            call(zmq.SUBSCRIBE, b'public_message_from_location:b'),
+            call(zmq.SUBSCRIBE, b'multicast_message_from_location:b'),
+            call(zmq.UNSUBSCRIBE, b'private_message_from_location:b:1'),
+            call(zmq.UNSUBSCRIBE, b'public_message_from_location:b'),
+            call(zmq.UNSUBSCRIBE, b'multicast_message_from_location:b')],
+        sub.call_args_list)
+        connman.publish_to_location('a', {'path': 'a'})
+        self.assertEqual([call({'path': 'a'})], send.call_args_list)
+
+
+class Root(object):
+
+    def __init__(self):
+        self.received = []
+
+    @message_receiver()
+    def echo(self, **kwargs):
+        self.received.append('echo')
+
+    @message_router()
+    def channels(self, next_step, **kwargs):
+        yield from next_step(self)
+
+    @message_receiver()
+    def publish(self, **kwargs):
+        self.received.append('publish')
+
+
+class TestConnectionRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Root()
+        self.connman = ConnectionManager()
+
+    def get_connection(self, rate_limit):
+        conn = Protocol(Mock())
+        conn.setup(self.connman, self.root, rate_limit)
+        conn.on_open()
+        return conn
+
+    @patch('sulaco.outer_server.connection_manager.monotonic')
+    def test_drop(self, monotonic):
+        monotonic.return_value = 0
+        rate_limit = ConnectionRateLimit(rate=10, burst=3, paths={
+                                'channels.publish': {'rate': 1}})
+        conn = self.get_connection(rate_limit)
+        for path in ('channels.publish', 'channels.publish', 'echo', 'echo'):
+            conn.on_message({'path': path, 'kwargs': {}})
+        self.assertEqual(['publish', 'echo'], self.root.received)
+        monotonic.return_value = 1
+        conn.on_message({'path': 'channels.publish', 'kwargs': {}})
+        self.assertEqual(['publish', 'echo', 'publish'], self.root.received)
+        conn._stream.close.assert_not_called()
+
+    @patch('sulaco.outer_server.connection_manager.monotonic')
+    def test_disconnect(self, monotonic):
+        monotonic.return_value = 0
+        rate_limit = ConnectionRateLimit(rate=1, action='disconnect')
+        conn = self.get_connection(rate_limit)
+        conn.on_message({'path': 'echo', 'kwargs': {}})
+        conn.on_message({'path': 'echo', 'kwargs': {}})
+        self.assertEqual(['echo'], self.root.received)
+        conn._stream.close.assert_called_once_with()
+
+
+class TestOutboundPolicy(unittest.TestCase):
+
+    def test_classify(self):
+        policy = OutboundPolicy({'location': {'priority': 'bulk'},
+                                 'location.moved': {'priority': 'control',
+                                                    'ttl': 0.5}})
+        self.assertEqual((CONTROL, 0.5), policy.classify('location.moved'))
+        self.assertEqual((BULK, None), policy.classify('location.init'))
+        self.assertEqual((NORMAL, None), policy.classify('locations'))
+
+    def test_send(self):
+        class PolicyProtocol(Protocol):
+            __slots__ = ()
+            outbound_policy = OutboundPolicy(
+                            {'echo': {'priority': 'bulk', 'ttl': 5}})
+        conn = PolicyProtocol(Mock())
+        conn.setup(ConnectionManager(), None)
+        # the stream is busy, messages are queued by priority
+        with patch.object(SimpleProtocol, 'writing', return_value=True), \
+             patch.object(OutboundLanes, 'push') as push:
+            conn.s.echo(text='hi')
+            conn.sender(CONTROL).echo(text='hi')
+        self.assertEqual([BULK, 5], list(push.call_args_list[0][0][1:]))
+        self.assertEqual([CONTROL, None], list(push.call_args_list[1][0][1:]))
+
 
 if __name__ == '__main__':
     unittest.main()
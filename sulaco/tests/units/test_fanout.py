@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import Mock
+from sulaco.outer_server.fanout import FanoutScheduler
+from sulaco.outer_server.connection_manager import (
+    ConnectionManager, ConnectionHandler)
+
+
+class Connection(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.conn_id = None
+
+    def send(self, msg):
+        self.log.append((self, msg))
+
+    def writing(self):
+        return False
+
+    def closed(self):
+        return False
+
+
+class Handler(ConnectionHandler, Connection):
+    """ Direct sends go through ConnectionHandler.send """
+
+    def __init__(self, log, connman):
+        Connection.__init__(self, log)
+        self.setup(connman, None)
+
+
+class TestFanoutScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = Mock()
+        self.fanout = FanoutScheduler(threshold=2, batch_size=3,
+                                      time_budget=10, ioloop=self.ioloop)
+        self.connman = ConnectionManager(fanout=self.fanout)
+        self.log = []
+        self.conns = [Connection(self.log) for i in range(5)]
+        for conn in self.conns:
+            self.connman.add_connection(conn)
+            self.connman.add_connection_to_channel(conn, 'chan')
+        self.connman.bind_connection_to_uid(self.conns[0], 'uid')
+
+    def run_iteration(self):
+        callback, = self.ioloop.add_callback.call_args[0]
+        self.ioloop.add_callback.reset_mock()
+        callback()
+
+    def test_small_delivery(self):
+        self.connman.send_by_uid('uid', 'direct')
+        self.assertEqual([(self.conns[0], 'direct')], self.log)
+        self.ioloop.add_callback.assert_not_called()
+
+    def test_budget_and_order(self):
+        self.connman.publish_to_channel('chan', 'first')
+        self.connman.send_by_uid('uid', 'second')
+        self.assertEqual([], self.log)
+        self.run_iteration()
+        self.assertEqual(3, len(self.log))
+        self.run_iteration()
+        self.assertEqual(6, len(self.log))
+        self.assertFalse(self.ioloop.add_callback.called)
+        self.assertEqual(0, self.fanout.pending)
+        msgs = [msg for conn, msg in self.log if conn is self.conns[0]]
+        self.assertEqual(['first', 'second'], msgs)
+        self.assertEqual(set(self.conns),
+                         {conn for conn, msg in self.log if msg == 'first'})
+
+    def test_direct_send_order(self):
+        handler = Handler(self.log, self.connman)
+        self.connman.add_connection(handler)
+        self.connman.add_connection_to_channel(handler, 'chan')
+        self.connman.publish_to_channel('chan', 'first')
+        handler.s.reply()
+        self.assertEqual([], self.log)
+        for i in range(3):
+            self.run_iteration()
+        msgs = [msg for conn, msg in self.log if conn is handler]
+        self.assertEqual(['first', 'reply'], [m if isinstance(m, str)
+                                              else m['path'] for m in msgs])
+        handler.s.reply()
+        self.assertEqual(8, len(self.log))
+
+
+if __name__ == '__main__':
+    unittest.main()
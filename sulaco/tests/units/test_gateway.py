@@ -0,0 +1,118 @@
+import unittest
+import msgpack
+from unittest.mock import Mock, patch
+from tornado import gen
+from sulaco.location_server.gateway import Gateway, MultiLocationGateway
+from sulaco.location_server.interest import InterestGrid
+from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN
+
+
+class Root(object):
+
+    def __init__(self):
+        self.received = []
+
+    @message_receiver(INTERNAL_SIGN)
+    def move(self, uid):
+        if uid == 'fail':
+            raise ValueError(uid)
+        self.received.append(uid)
+
+
+class TestGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Root()
+        self.gateway = Gateway(None, 'loc')
+        self.gateway.setup(self.root)
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def test_receive_batch(self):
+        self.gateway._receive([self.frame('1')])
+        self.gateway._receive([self.frame('2'), self.frame('fail'),
+                               self.frame('3')])
+        self.assertEqual(['1', '2', '3'], self.root.received)
+
+    @patch('sulaco.location_server.gateway.register_location')
+    def test_refused(self, register_location):
+        register_location.return_value = gen.maybe_future(False)
+        self.gateway._bind = Mock()
+        self.assertIs(False, self.gateway.connect('pub', 'pull'))
+        self.assertFalse(self.gateway._bind.called)
+
+    def test_area_message(self):
+        self.gateway.interest = InterestGrid(10)
+        self.gateway.interest.add('1', 0, 0, 10)
+        self.gateway.interest.add('2', 50, 50, 10)
+        self.gateway._pub_sock = Mock()
+        self.gateway.aoi(5, 5).moved(x=5, y=5)
+        self.gateway.aoi(100, 100).moved(x=100, y=100)
+        self.gateway._pub_sock.send.assert_any_call(
+                                b'multicast_message_from_location:loc', 2)
+        body = self.gateway._pub_sock.send.call_args_list[-1][0][0]
+        self.assertEqual(['1'], msgpack.loads(body, encoding='utf-8')['uids'])
+        self.assertEqual(2, self.gateway._pub_sock.send.call_count)
+
+    def test_load(self):
+        self.assertEqual({'users': 0, 'queue': 0}, self.gateway.load())
+        self.gateway.interest = InterestGrid(10)
+        self.gateway.interest.add('1', 0, 0)
+        self.assertEqual(1, self.gateway.load()['users'])
+        self.root.user_count = lambda: 5
+        self.gateway.enable_ticks(10, ioloop=Mock(**{'time.return_value': 0}))
+        self.gateway.input(self.frame('1'))
+        self.assertEqual({'users': 5, 'queue': 1}, self.gateway.load())
+
+    def test_probe(self):
+        self.gateway._pub_sock = Mock()
+        self.gateway.enable_ticks(10, ioloop=Mock(**{'time.return_value': 0}))
+        self.gateway.input(b'probe_from_location:server:1')
+        # echoed at once, not on the next tick
+        self.gateway._pub_sock.send_multipart.assert_called_once_with(
+                    (b'probe_from_location:server:1', msgpack.dumps(None)))
+        self.assertEqual(0, self.gateway.ticks.queued)
+
+
+class TestMultiLocationGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.host = MultiLocationGateway(None)
+        self.roots = {}
+        for ident in ('loc_a', 'loc_b'):
+            gateway = Gateway(None, ident)
+            self.roots[ident] = Root()
+            gateway.setup(self.roots[ident])
+            self.host._gateways[ident] = gateway
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def test_receive(self):
+        self.host._receive([b'loc_a', self.frame('1'),
+                            b'unknown', self.frame('2'),
+                            b'loc_b', self.frame('3'),
+                            b'loc_a', self.frame('4')])
+        self.assertEqual(['1', '4'], self.roots['loc_a'].received)
+        self.assertEqual(['3'], self.roots['loc_b'].received)
+
+    def test_malformed_batch(self):
+        self.host._receive([b'loc_a', self.frame('1'), b'loc_b'])
+        self.host._receive([b'\xff', self.frame('2'),
+                            b'loc_b', self.frame('3')])
+        self.assertEqual([], self.roots['loc_a'].received)
+        self.assertEqual(['3'], self.roots['loc_b'].received)
+
+    def test_remove_location(self):
+        self.host._push_to_man = Mock()
+        self.host.remove_location('loc_a')
+        self.assertEqual(['loc_b'], self.host.idents)
+        self.host._push_to_man.send_multipart.assert_called_once_with(
+                            (b'location_disconnect_message', b'loc_a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import random
+import unittest
+from sulaco.location_server.interest import InterestGrid
+
+
+class TestInterestGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = InterestGrid(10)
+
+    def brute_observers(self, positions, radii, x, y):
+        return sorted(e for e, r in radii.items()
+                      if (positions[e][0] - x) ** 2 +
+                         (positions[e][1] - y) ** 2 <= r * r)
+
+    def test_random_moves(self):
+        rnd = random.Random(1)
+        grid = self.grid
+        positions = {}
+        radii = {}
+        for entity in range(200):
+            x, y = rnd.uniform(-50, 50), rnd.uniform(-50, 50)
+            radius = rnd.choice((None, 5, 15))
+            grid.add(entity, x, y, radius)
+            positions[entity] = (x, y)
+            if radius is not None:
+                radii[entity] = radius
+        for i in range(20):
+            for entity in positions:
+                x, y = positions[entity]
+                x += rnd.uniform(-7, 7)
+                y += rnd.uniform(-7, 7)
+                grid.move(entity, x, y)
+                positions[entity] = (x, y)
+            x, y = rnd.uniform(-50, 50), rnd.uniform(-50, 50)
+            self.assertEqual(self.brute_observers(positions, radii, x, y),
+                             sorted(grid.observers(x, y)))
+            self.assertEqual(sorted(e for e, (ex, ey) in positions.items()
+                                    if (ex - x) ** 2 + (ey - y) ** 2 <= 100),
+                             sorted(grid.nearby(x, y, 10)))
+
+    def test_remove_and_radius(self):
+        grid = self.grid
+        grid.add('a', 0, 0, 30)
+        grid.add('b', 25, 0, 5)
+        grid.add('npc', 1, 1)
+        self.assertEqual(['a'], grid.observers(15, 0))
+        self.assertEqual(['b'], grid.observers(25, 0, exclude='a'))
+        grid.remove('a')
+        self.assertEqual([], grid.observers(15, 0))
+        self.assertEqual(5, grid._max_radius)
+        grid.set_radius('npc', 20)
+        self.assertEqual(['npc'], grid.observers(15, 0))
+        self.assertEqual({}, {c: e for c, e in grid._cells.items()
+                              if not e})
+        self.assertEqual(2, len(grid))
+
+
+if __name__ == '__main__':
+    unittest.main()
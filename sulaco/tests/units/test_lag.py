@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import Mock
+from sulaco.utils.lag import LagMonitor
+from sulaco.utils.stats import Stats
+
+
+class IOLoop(object):
+
+    def __init__(self):
+        self.now = 0
+        self.timeouts = []
+
+    def time(self):
+        return self.now
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return deadline
+
+    def remove_timeout(self, timeout):
+        self.timeouts = [t for t in self.timeouts if t[0] != timeout]
+
+    def fire(self, delay):
+        """ Runs the next timeout `delay` seconds late """
+
+        deadline, callback = self.timeouts.pop(0)
+        self.now = deadline + delay
+        callback()
+
+
+class TestLagMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = IOLoop()
+        self.monitor = LagMonitor(0.1, self.ioloop)
+        self.monitor.start()
+        self.monitor.start()
+
+    def test_lag(self):
+        self.assertEqual(1, len(self.ioloop.timeouts))
+        self.ioloop.fire(0.05)
+        self.assertAlmostEqual(0.05, self.monitor.lag)
+        self.ioloop.fire(0.2)
+        self.ioloop.fire(0)
+        self.assertEqual(0, self.monitor.lag)
+        self.assertAlmostEqual(0.2, self.monitor.take_peak())
+        self.assertEqual(0, self.monitor.take_peak())
+        self.ioloop.fire(0.05)
+        self.assertAlmostEqual(0.05, self.monitor.take_peak())
+        # no probes since the previous call
+        self.assertEqual(0, self.monitor.take_peak())
+        hist = Stats.instance().histogram('sulaco_ioloop_lag_seconds')
+        self.assertAlmostEqual(0.2, hist.max)
+        self.monitor.stop()
+        self.assertFalse(self.monitor.started)
+        self.assertEqual([], self.ioloop.timeouts)
+
+    def test_threshold(self):
+        exceeded = Mock()
+        recovered = Mock()
+        failing = Mock(side_effect=ValueError)
+        self.monitor.add_threshold(0.1, exceeded, recovered)
+        self.monitor.add_threshold(0.5, failing)
+        self.ioloop.fire(0.05)
+        self.assertFalse(exceeded.called)
+        self.ioloop.fire(0.2)
+        self.ioloop.fire(0.3)
+        exceeded.assert_called_once_with(0.2)
+        self.assertFalse(recovered.called)
+        self.ioloop.fire(1)
+        self.assertEqual(1, failing.call_count)
+        self.ioloop.fire(0)
+        recovered.assert_called_once_with(0)
+        self.assertEqual(1, exceeded.call_count)
+        self.assertTrue(self.monitor.started)
@@ -0,0 +1,25 @@
+import unittest
+import msgpack
+from sulaco.location_server.location_manager import parse_heartbeat
+
+
+class TestParseHeartbeat(unittest.TestCase):
+
+    def test_loads(self):
+        load = {'users': 1, 'queue': 0}
+        parts = [b'heartbeat', msgpack.dumps({'a': load, 'b': load})]
+        self.assertEqual({'a': load, 'b': load}, parse_heartbeat(parts))
+        # ids and loads that look like each other
+        parts = [b'heartbeat', msgpack.dumps({'\u00c1': {}, '1': None})]
+        self.assertEqual({'\u00c1': {}, '1': None}, parse_heartbeat(parts))
+
+    def test_without_loads(self):
+        self.assertEqual({'a': None}, parse_heartbeat([b'heartbeat', b'a']))
+        self.assertEqual({'loc_1': None, 'loc_2': None},
+                         parse_heartbeat([b'heartbeat', b'loc_1', b'loc_2']))
+
+    def test_malformed(self):
+        self.assertEqual({}, parse_heartbeat([b'heartbeat', b'\xc1']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,478 @@
+import zmq
+import unittest
+import msgpack
+from unittest.mock import Mock, patch
+from tornado import gen
+from sulaco.outer_server.message_manager import (
+    LocationMessageManager, BatchingPushSocket, RoutedInput)
+from sulaco.outer_server.connection_manager import LocationConnectionManager
+from sulaco.utils import Config
+from sulaco.utils.receiver import (
+    message_receiver, message_router, INTERNAL_SIGN)
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.conn_id = None
+
+
+class Location(object):
+
+    def __init__(self):
+        self.received = []
+
+    @message_receiver(INTERNAL_SIGN)
+    def init(self, uid, location, text):
+        if text == 'fail' and uid == '1':
+            raise ValueError(uid)
+        self.received.append((uid, location, text))
+
+
+class Root(object):
+
+    def __init__(self):
+        self.loc = Location()
+
+    @message_router(INTERNAL_SIGN)
+    def location(self, next_step, **kwargs):
+        yield from next_step(self.loc)
+
+
+class TestLocationMulticast(unittest.TestCase):
+
+    def setUp(self):
+        config = Config({'outer_server': {'location_handler_path':
+                                          'location'}}, True)
+        self.msgman = LocationMessageManager(config)
+        self.connman = LocationConnectionManager(
+                                        locations_sub_socket=Mock())
+        self.root = Root()
+        self.msgman._connman = self.connman
+        self.msgman._root = self.root
+        for uid, location in (('1', 'loc'), ('2', 'loc'), ('3', 'other')):
+            conn = Connection()
+            self.connman.add_connection(conn)
+            self.connman.bind_connection_to_uid(conn, uid)
+            self.connman.add_user_to_location(location, uid)
+
+    def multicast(self, uids, text):
+        body = msgpack.dumps({'uids': uids,
+                              'msg': {'path': 'init',
+                                      'kwargs': {'text': text}}})
+        self.msgman._on_message([b'multicast_message_from_location:loc',
+                                 body])
+
+    def test_local_subset(self):
+        self.multicast(['1', '2', '3', '4'], 'hi')
+        self.assertEqual([('1', 'loc', 'hi'), ('2', 'loc', 'hi')],
+                         self.root.loc.received)
+
+    def test_failing_recipient(self):
+        self.multicast(['1', '2'], 'fail')
+        self.assertEqual([('2', 'loc', 'fail')], self.root.loc.received)
+
+    def test_handoff(self):
+        ioloop = Mock()
+        ioloop.time.return_value = 0
+        self.connman.begin_handoff('other', '2', ioloop)
+        body = msgpack.dumps({'uids': ['2', '3'],
+                              'msg': {'path': 'init',
+                                      'kwargs': {'text': 'hi'}}})
+        self.msgman._on_message([b'multicast_message_from_location:other',
+                                 body])
+        self.assertEqual([('3', 'other', 'hi')], self.root.loc.received)
+        body = msgpack.dumps({'path': 'init', 'kwargs': {'text': 'enter'}})
+        self.msgman._on_message([b'private_message_from_location:other:2',
+                                 body])
+        # the multicast came before the user entered
+        self.assertEqual([('3', 'other', 'hi'), ('2', 'other', 'enter')],
+                         self.root.loc.received)
+        self.assertEqual(['2'], self.connman.local_users('other', ['2']))
+
+    def test_batch(self):
+        bodies = [msgpack.dumps({'path': 'init', 'kwargs': {'text': text}})
+                  for text in ('a', 'fail', 'b')]
+        self.msgman._on_message([b'private_message_from_location:loc:1']
+                                + bodies)
+        self.assertEqual([('1', 'loc', 'a'), ('1', 'loc', 'b')],
+                         self.root.loc.received)
+
+
+class TestSharedLocationSockets(unittest.TestCase):
+
+    def setUp(self):
+        config = Config({'outer_server': {}}, True)
+        self.msgman = LocationMessageManager(config)
+        self.msgman._context = Mock()
+        self.msgman.sub_to_locs = Mock()
+        self.msgman._root = Mock()
+
+    def add(self, loc_id):
+        self.msgman.add_location(loc_id, {'pub_address': 'pub',
+                                          'pull_address': 'pull',
+                                          'routed_input': True})
+
+    def test_add_remove(self):
+        msgman = self.msgman
+        self.add('loc_a')
+        self.add('loc_b')
+        msgman._root.location_added.assert_called_with('loc_b', {})
+        self.assertEqual(1, msgman._context.socket.call_count)
+        msgman.sub_to_locs.connect.assert_called_once_with('pub')
+        socket = msgman._context.socket.return_value
+        msgman.loc_input_sockets['loc_b'].send(b'data')
+        socket.send_multipart.assert_called_once_with((b'loc_b', b'data'))
+        self.assertIsInstance(msgman.loc_input_sockets['loc_a'], RoutedInput)
+        msgman.remove_location('loc_a', None)
+        self.assertFalse(socket.close.called)
+        self.assertFalse(msgman.sub_to_locs.disconnect.called)
+        msgman.remove_location('loc_b', None)
+        self.assertTrue(socket.close.called)
+        msgman.sub_to_locs.disconnect.assert_called_once_with('pub')
+        self.assertEqual({}, msgman._input_sockets)
+        self.assertEqual({}, msgman._pub_address_refs)
+
+    @patch('sulaco.outer_server.message_manager.IOLoop')
+    def test_move(self, ioloop):
+        ioloop.instance.return_value.time.return_value = 0
+        msgman = self.msgman
+        self.add('loc_a')
+        old_socket = msgman._context.socket.return_value
+        new_socket = msgman._context.socket.return_value = Mock()
+        msgman.loc_input_sockets['loc_a'].send(b'before')
+        msgman.move_location('loc_a', {'pub_address': 'pub2',
+                                       'pull_address': 'pull2',
+                                       'migration_address': 'migr'})
+        msgman.sub_to_locs.connect.assert_called_with('pub2')
+        # the probe follows earlier input through the source
+        (_, probe), = old_socket.send_multipart.call_args_list[-1][0]
+        self.assertTrue(probe.startswith(b'probe_from_location:'))
+        msgman.loc_input_sockets['loc_a'].send(b'after')
+        self.assertFalse(new_socket.send.called)
+        self.assertFalse(old_socket.close.called)
+        msgman._on_message([probe, msgpack.dumps(None)])
+        self.assertFalse(new_socket.send.called)
+        # the echo of the source follows its earlier messages
+        msgman._on_message([probe, msgpack.dumps('source')])
+        confirmation, data = [c[0][0] for c in new_socket.send.call_args_list]
+        self.assertTrue(confirmation.startswith(b'move_confirmed:'))
+        self.assertEqual(b'after', data)
+        self.assertTrue(old_socket.close.called)
+        msgman.sub_to_locs.disconnect.assert_called_once_with('pub')
+        self.assertEqual(1, msgman._root.location_added.call_count)
+
+    @patch('sulaco.outer_server.message_manager.IOLoop')
+    def test_move_not_confirmed(self, ioloop):
+        time = ioloop.instance.return_value.time
+        time.return_value = 0
+        msgman = self.msgman
+        self.add('loc_a')
+        old_socket = msgman._context.socket.return_value
+        new_socket = msgman._context.socket.return_value = Mock()
+        msgman.move_location('loc_a', {'pub_address': 'pub2',
+                                       'pull_address': 'pull2'})
+        msgman.loc_input_sockets['loc_a'].send(b'data')
+        time.return_value = msgman.move_timeout
+        ioloop.instance.return_value.add_timeout.call_args[0][1]()
+        new_socket.send.assert_called_once_with(b'data')
+        self.assertTrue(old_socket.close.called)
+
+    @patch('sulaco.outer_server.message_manager.IOLoop')
+    def test_unused_move(self, ioloop):
+        ioloop.instance.return_value.time.return_value = 0
+        msgman = self.msgman
+        msgman.idle_timeout = 10
+        self.add('loc_a')
+        self.add('loc_b')
+        msgman._connect_location('loc_a', msgman._locations['loc_a'])
+        socket = msgman._context.socket.return_value
+        msgman.move_location('loc_b', {'pub_address': 'pub2',
+                                       'pull_address': 'pull2'})
+        # the source counts this server because of loc_a
+        (ident, confirmation), = socket.send_multipart.call_args[0]
+        self.assertEqual(b'loc_b', ident)
+        self.assertTrue(confirmation.startswith(b'move_confirmed:'))
+        self.assertNotIn('loc_b', msgman.loc_input_sockets)
+
+    def test_placement(self):
+        msgman = self.msgman
+        self.add('loc_a')
+        self.add('loc_b')
+        msgman.add_location('loc_c', {'pub_address': 'pub',
+                                      'pull_address': 'pull',
+                                      'routed_input': True,
+                                      'type': 'loc_b'})
+        loads = {'loc_b': {'users': 5, 'queue': 0, 'lag': 0},
+                 'loc_c': {'users': 1, 'queue': 0, 'lag': 0}}
+        msgman._on_message([b'location_loads:', msgpack.dumps(loads)])
+        self.assertEqual('loc_c', msgman.placement.choose('loc_b'))
+        msgman.remove_location('loc_c', None)
+        self.assertEqual('loc_b', msgman.placement.choose('loc_b'))
+
+
+@patch('sulaco.outer_server.message_manager.IOLoop')
+class TestLazyLocationSockets(unittest.TestCase):
+
+    def setUp(self):
+        config = Config({'outer_server': {'location_idle_timeout': 10}}, True)
+        self.msgman = LocationMessageManager(config)
+        self.msgman._context = Mock()
+        self.msgman.sub_to_locs = Mock()
+        self.msgman._root = Mock()
+        self.msgman._connman = Mock()
+        self.msgman.add_location('loc', {'pub_address': 'pub',
+                                         'pull_address': 'pull',
+                                         'name': 'Loc'})
+
+    def test_connect(self, ioloop):
+        msgman = self.msgman
+        msgman._root.location_added.assert_called_once_with('loc',
+                                                            {'name': 'Loc'})
+        self.assertFalse(msgman._context.socket.called)
+        self.assertIsNone(msgman.location_input('unknown'))
+        ioloop.instance.return_value.time.return_value = 0
+        input_sock = msgman.location_input('loc')
+        self.assertIs(input_sock, msgman.location_input('loc'))
+        msgman.sub_to_locs.connect.assert_called_once_with('pub')
+        socket = msgman._context.socket.return_value
+        input_sock.send(b'enter')
+        probe, = [c[0][0] for c in socket.send.call_args_list]
+        self.assertTrue(probe.startswith(b'probe_from_location:'))
+        msgman.sub_to_locs.setsockopt.assert_called_once_with(zmq.SUBSCRIBE,
+                                                              probe)
+        # the echo shows that subscriptions reach the publisher
+        msgman._on_message([probe, msgpack.dumps(None)])
+        self.assertEqual(b'enter', socket.send.call_args[0][0])
+        msgman.sub_to_locs.setsockopt.assert_called_with(zmq.UNSUBSCRIBE,
+                                                         probe)
+        input_sock.send(b'move')
+        self.assertEqual(3, socket.send.call_count)
+        self.assertEqual({}, msgman._probes)
+
+    def test_probe_timeout(self, ioloop):
+        msgman = self.msgman
+        time = ioloop.instance.return_value.time
+        time.return_value = 0
+        input_sock = msgman.location_input('loc')
+        input_sock.send(b'enter')
+        socket = msgman._context.socket.return_value
+        add_timeout = ioloop.instance.return_value.add_timeout
+        deadline, resend = add_timeout.call_args[0]
+        self.assertEqual(msgman.probe_period, deadline)
+        time.return_value = deadline
+        resend()
+        self.assertEqual(2, socket.send.call_count)
+        time.return_value = msgman.subscribe_timeout
+        add_timeout.call_args[0][1]()
+        # input isn't kept forever
+        self.assertEqual(b'enter', socket.send.call_args[0][0])
+        self.assertEqual({}, msgman._probes)
+
+    def test_evict(self, ioloop):
+        msgman = self.msgman
+        time = ioloop.instance.return_value.time
+        time.return_value = 0
+        msgman.location_input('loc')
+        msgman._connman.has_location_users.return_value = True
+        time.return_value = 20
+        msgman.evict_idle()
+        self.assertIn('loc', msgman.loc_input_sockets)
+        msgman._connman.has_location_users.return_value = False
+        time.return_value = 29
+        msgman.evict_idle()
+        self.assertIn('loc', msgman.loc_input_sockets)
+        time.return_value = 30
+        msgman.evict_idle()
+        self.assertEqual({}, msgman.loc_input_sockets)
+        self.assertEqual({}, msgman._input_sockets)
+        msgman.sub_to_locs.disconnect.assert_called_once_with('pub')
+        msgman._context.socket.return_value.close.assert_called_once_with()
+        self.assertIn('loc', msgman._locations)
+        msgman.remove_location('loc', None)
+        msgman._root.location_removed.assert_called_once_with('loc')
+
+
+class Publisher(object):
+    """ A location publisher that gets subscriptions with a delay """
+
+    def __init__(self, msgman):
+        self.msgman = msgman
+        self.pending = []
+        self.topics = []
+
+    def setsockopt(self, option, topic):
+        self.pending.append((option, topic))
+
+    def propagate(self):
+        for option, topic in self.pending:
+            if option == zmq.SUBSCRIBE:
+                self.topics.append(topic)
+            else:
+                self.topics.remove(topic)
+        self.pending = []
+
+    def publish(self, topic, body):
+        if any(topic.startswith(t) for t in self.topics):
+            self.msgman._on_message([topic, msgpack.dumps(body)])
+
+
+@patch('sulaco.outer_server.connection_manager.IOLoop')
+@patch('sulaco.outer_server.message_manager.IOLoop')
+class TestHandoff(unittest.TestCase):
+
+    def setUp(self):
+        config = Config({'outer_server': {
+                            'location_handler_path': 'location',
+                            'client_location_handler_path': 'location'}},
+                        True)
+        self.msgman = LocationMessageManager(config)
+        self.pub = Publisher(self.msgman)
+        self.msgman.sub_to_locs = self.pub
+        self.connman = LocationConnectionManager(locations_sub_socket=self.pub)
+        self.root = Root()
+        self.msgman._connman = self.connman
+        self.msgman._root = self.root
+        self.input = Mock()
+        self.input.send.side_effect = self.receive
+        self.msgman.loc_input_sockets['b'] = self.input
+        self.conn = Mock(conn_id=None)
+        self.connman.add_connection(self.conn)
+        self.connman.bind_connection_to_uid(self.conn, '1')
+        self.connman.add_user_to_location('a', '1')
+        self.pub.propagate()
+
+    def receive(self, data):
+        if data.startswith(b'probe_from_location:'):
+            self.pub.publish(data, None)
+
+    def enter(self):
+        self.pub.publish(b'private_message_from_location:b:1',
+                         {'path': 'init', 'kwargs': {'text': 'enter'}})
+        self.pub.publish(b'public_message_from_location:b',
+                         {'path': 'init', 'kwargs': {'text': 'entered'}})
+
+    def test_propagation(self, ioloop, connman_ioloop):
+        ioloop.instance.return_value.time.return_value = 0
+        connman_ioloop.instance.return_value.time.return_value = 0
+        failed = Mock()
+        self.msgman.handoff('b', '1', self.enter, failed)
+        # the first probe is lost while subscriptions propagate
+        self.assertEqual(1, self.input.send.call_count)
+        self.assertEqual([], self.root.loc.received)
+        self.pub.propagate()
+        self.pub.publish(b'public_message_from_location:b',
+                         {'path': 'init', 'kwargs': {'text': 'before'}})
+        retry = ioloop.instance.return_value.add_timeout.call_args[0][1]
+        retry()
+        self.assertEqual([('1', 'b', 'enter')], self.root.loc.received)
+        self.conn.send.assert_called_once_with(
+            {'path': 'location.init', 'kwargs': {'text': 'entered'}})
+        self.assertEqual({'1': 'b'}, self.connman._uid_to_location)
+        self.assertEqual({}, self.msgman._probes)
+        self.assertFalse(failed.called)
+
+    def test_not_confirmed(self, ioloop, connman_ioloop):
+        time = ioloop.instance.return_value.time
+        time.return_value = 0
+        connman_ioloop.instance.return_value.time.return_value = 0
+        enter = Mock()
+        failed = Mock()
+        self.msgman.handoff('b', '1', enter, failed)
+        time.return_value = self.connman.handoff_timeout
+        ioloop.instance.return_value.add_timeout.call_args[0][1]()
+        self.assertFalse(enter.called)
+        failed.assert_called_once_with()
+        self.assertIsNone(self.connman.handoff('1'))
+        self.assertEqual({'1': 'a'}, self.connman._uid_to_location)
+
+
+class TestBootstrap(unittest.TestCase):
+
+    def setUp(self):
+        config = Config({'outer_server': {'bootstrap': {'page_size': 2}},
+                         'location_manager': {'rep_address': 'rep'}}, True)
+        self.msgman = LocationMessageManager(config)
+        self.msgman._context = Mock()
+        self.msgman.sub_to_locs = Mock()
+        self.msgman._root = Mock()
+
+    def data(self, pub):
+        return {'pub_address': pub, 'pull_address': 'pull'}
+
+    @patch('sulaco.outer_server.message_manager.request')
+    def test_pages(self, request):
+        msgman = self.msgman
+        def reply(context, address, parts, timeout, retries):
+            after = parts[1]
+            if after == '':
+                # a location is removed and another one is added
+                # while the page is being fetched
+                msgman.remove_location('loc_b', None)
+                msgman.add_location('loc_c', self.data('pub_c'))
+                page = {'locations': {'loc_a': self.data('pub_a'),
+                                      'loc_b': self.data('pub_b')},
+                        'next': 'loc_b'}
+            else:
+                self.assertEqual('loc_b', after)
+                page = {'locations': {'loc_c': self.data('pub_c')},
+                        'next': None}
+            return gen.maybe_future([msgpack.dumps(page)])
+        request.side_effect = reply
+        msgman.ready = msgman.bootstrap()
+        self.assertEqual(1, msgman.ready.result())
+        self.assertEqual(['loc_a', 'loc_c'], sorted(msgman.loc_input_sockets))
+        self.assertEqual('pub_c', msgman._loc_pub_addresses['loc_c'])
+        self.assertIsNotNone(msgman.time_to_ready)
+        self.assertEqual(['loc_c', 'loc_a'],
+                         [c[0][0] for c in
+                          msgman._root.location_added.call_args_list])
+        self.assertEqual(2, request.call_count)
+
+    @patch('sulaco.outer_server.message_manager.gen.sleep')
+    @patch('sulaco.outer_server.message_manager.request')
+    def test_give_up(self, request, sleep):
+        msgman = self.msgman
+        msgman.bootstrap_max_attempts = 5
+        msgman.bootstrap_max_retry_period = 3
+        request.return_value = gen.maybe_future(None)
+        sleep.return_value = gen.maybe_future(None)
+        with self.assertLogs('sulaco.outer_server.message_manager') as logs:
+            msgman.ready = msgman.bootstrap()
+        self.assertIsNone(msgman.ready.result())
+        self.assertEqual(5, request.call_count)
+        self.assertEqual([1, 2, 3, 3], [c[0][0] for c in sleep.call_args_list])
+        self.assertIn('after 5 attempts', logs.output[-1])
+        self.assertFalse(msgman._bootstrapping)
+        self.assertIsNone(msgman.time_to_ready)
+
+
+class TestBatchingPushSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = Mock()
+        self.ioloop = Mock()
+        self.push = BatchingPushSocket(self.socket, 3, self.ioloop)
+
+    def test_batch(self):
+        self.push.send(b'a')
+        self.push.send(b'b')
+        self.assertFalse(self.socket.send_multipart.called)
+        self.ioloop.add_callback.assert_called_once_with(self.push.flush)
+        self.push.flush()
+        self.socket.send_multipart.assert_called_once_with([b'a', b'b'])
+        self.push.send(b'c')
+        self.push.flush()
+        self.socket.send.assert_called_once_with(b'c')
+
+    def test_max_batch(self):
+        for data in (b'a', b'b', b'c', b'd'):
+            self.push.send(data)
+        self.socket.send_multipart.assert_called_once_with([b'a', b'b', b'c'])
+        self.push.close()
+        self.socket.send.assert_called_once_with(b'd')
+        self.assertTrue(self.socket.close.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import zmq
+import unittest
+import msgpack
+from unittest.mock import Mock, patch, call
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from sulaco.location_server import MOVE_MESSAGE, CONNECT_MESSAGE
+from sulaco.location_server.gateway import Gateway
+from sulaco.location_server.migration import (
+    MigrationServer, IncomingMigration, take_over)
+from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN
+
+
+class Root(object):
+
+    def __init__(self, gateway=None):
+        self.received = []
+        self.gateway = gateway
+
+    @message_receiver(INTERNAL_SIGN)
+    def move(self, uid):
+        self.received.append(uid)
+        if self.gateway is not None:
+            self.gateway.prs(uid).moved()
+
+    def snapshot(self):
+        return {'received': self.received}
+
+    def restore(self, state):
+        self.received = state['received']
+
+
+class TestOutgoingMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Root()
+        self.gateway = Gateway(None, 'loc')
+        self.gateway.setup(self.root)
+        self.gateway.subscribers = Mock(count=2)
+        self.context = Mock()
+        self.ioloop = Mock()
+        self.ioloop.time.return_value = 0
+        self.migrated = []
+        self.server = MigrationServer.__new__(MigrationServer)
+        self.server._context = self.context
+        self.server._get_gateway = {'loc': self.gateway}.get
+        self.server._on_migrated = self.migrated.append
+        self.server.timeout = 5
+        self.server.forward_period = 5
+        self.server._ioloop = self.ioloop
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def handle(self, *parts):
+        return self.server.handle([p if isinstance(p, bytes)
+                                   else p.encode('utf-8') for p in parts])
+
+    def test_commit(self):
+        self.gateway.input(self.frame('1'))
+        snapshot = self.handle('migrate', 'loc')
+        self.assertEqual({'received': ['1']},
+                         msgpack.loads(snapshot, encoding='utf-8'))
+        self.assertIsNone(self.handle('migrate', 'loc'))
+        self.gateway.input(self.frame('2'))
+        self.assertEqual(['1'], self.root.received)
+        target = msgpack.dumps({'pull_address': 'tcp://target',
+                                'routed_input': True})
+        self.assertEqual({'subscribers': 2},
+                         self.handle('commit', 'loc', target))
+        self.assertTrue(self.gateway.migrated)
+        self.assertFalse(self.handle('commit', 'loc', target))
+        push = self.context.socket.return_value
+        push.connect.assert_called_once_with('tcp://target')
+        self.gateway.input(self.frame('3'))
+        self.gateway._pub_sock = Mock()
+        self.gateway.input(b'probe_from_location:x:1')
+        self.assertEqual([((b'loc', self.frame('2')),),
+                          ((b'loc', self.frame('3')),),
+                          ((b'loc', b'probe_from_location:x:1'),)],
+                         [c[0] for c in push.send_multipart.call_args_list])
+        self.gateway._pub_sock.send_multipart.assert_called_once_with(
+            (b'probe_from_location:x:1', msgpack.dumps('source')))
+        self.assertEqual(['1'], self.root.received)
+        finish = self.ioloop.add_timeout.call_args[0][1]
+        finish()
+        self.assertEqual([self.gateway], self.migrated)
+
+    def test_abort(self):
+        self.handle('migrate', 'loc')
+        self.gateway.input(self.frame('1'))
+        abort = self.ioloop.add_timeout.call_args[0][1]
+        abort()
+        self.assertEqual(['1'], self.root.received)
+        self.assertIsNone(self.gateway.migration)
+        self.gateway.input(self.frame('2'))
+        self.assertEqual(['1', '2'], self.root.received)
+
+    def test_unknown_location(self):
+        self.assertIsNone(self.handle('migrate', 'other'))
+
+
+class TestIncomingMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = Gateway(None, 'loc')
+        self.root = Root(self.gateway)
+        self.gateway.setup(self.root)
+        self.gateway._pub_sock = Mock()
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def test_hold(self):
+        gateway = self.gateway
+        incoming = gateway.incoming = IncomingMigration(gateway)
+        gateway.input(self.frame('1'))
+        gateway.prs('2').moved()
+        gateway.input(b'probe_from_location:x:1')
+        pub = gateway._pub_sock
+        pub.send_multipart.assert_called_once_with(
+            (b'probe_from_location:x:1', msgpack.dumps(None)))
+        self.assertEqual([], self.root.received)
+        confirmed = incoming.wait_confirmed(2)
+        gateway.input(b'move_confirmed:a')
+        gateway.input(b'move_confirmed:a')
+        self.assertFalse(confirmed.done())
+        gateway.input(b'move_confirmed:b')
+        self.assertTrue(confirmed.done())
+        incoming.release()
+        self.assertIsNone(gateway.incoming)
+        self.assertEqual(['1'], self.root.received)
+        self.assertEqual([
+            (b'probe_from_location:x:1', msgpack.dumps(None)),
+            [b'private_message_from_location:loc:2',
+             msgpack.dumps({'kwargs': {}, 'path': 'moved'})]],
+            [c[0][0] for c in pub.send_multipart.call_args_list])
+        # the output held before the release goes first
+        topic = b'private_message_from_location:loc:1'
+        self.assertEqual([call(topic, zmq.SNDMORE),
+                          call(msgpack.dumps({'kwargs': {},
+                                              'path': 'moved'}))],
+                         pub.send.call_args_list)
+        # a late confirmation is dropped
+        gateway.input(b'move_confirmed:c')
+        self.assertEqual(['1'], self.root.received)
+
+
+class TestTakeOver(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = Gateway(None, 'loc')
+        self.root = Root(self.gateway)
+        self.gateway.setup(self.root)
+        self.gateway._pub_sock = Mock()
+        self.config = Mock()
+        self.config.location_manager.rep_address = 'tcp://manager'
+        self.requests = []
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def take_over(self, *replies, on_request=None, timeout=5):
+        replies = list(replies)
+        @coroutine
+        def request(context, address, parts, timeout, retries=2):
+            self.requests.append(parts[0])
+            if on_request is not None:
+                on_request(parts[0])
+            reply = replies.pop(0)
+            return None if reply is None else [msgpack.dumps(reply)]
+        with patch('sulaco.location_server.migration.request', request):
+            return IOLoop.current().run_sync(
+                lambda: take_over(None, self.config, self.gateway,
+                                  {'pull_address': 'tcp://target'},
+                                  timeout, retry_period=0))
+
+    def test_retry_move(self):
+        source = {'loc': {'migration_address': 'tcp://source'}}
+        snapshot = msgpack.dumps({'received': ['1']})
+        self.assertTrue(self.take_over(source, snapshot, {'subscribers': 0},
+                                       None, False, False, True))
+        self.assertEqual(['1'], self.root.received)
+        self.assertEqual([MOVE_MESSAGE, MOVE_MESSAGE, CONNECT_MESSAGE,
+                          MOVE_MESSAGE], self.requests[3:])
+
+    def test_cutover(self):
+        gateway = self.gateway
+        pub = gateway._pub_sock
+        def on_request(command):
+            if command == 'commit':
+                # the source forwards input before its reply comes
+                gateway.input(self.frame('2'))
+            elif command == MOVE_MESSAGE:
+                gateway.input(self.frame('3'))
+                IOLoop.current().add_callback(confirm)
+        def confirm():
+            # replies of the target would be lost before the confirmation
+            self.assertEqual(['1'], self.root.received)
+            self.assertFalse(pub.send.called)
+            gateway.input(b'move_confirmed:a')
+        source = {'loc': {'migration_address': 'tcp://source'}}
+        snapshot = msgpack.dumps({'received': ['1']})
+        self.assertTrue(self.take_over(source, snapshot, {'subscribers': 1},
+                                       True, on_request=on_request))
+        self.assertEqual(['1', '2', '3'], self.root.received)
+        self.assertEqual(4, pub.send.call_count)
+        self.assertIsNone(gateway.incoming)
+
+    def test_not_confirmed(self):
+        source = {'loc': {'migration_address': 'tcp://source'}}
+        snapshot = msgpack.dumps({'received': []})
+        def on_request(command):
+            if command == 'commit':
+                self.gateway.input(self.frame('1'))
+        self.assertTrue(self.take_over(source, snapshot, {'subscribers': 1},
+                                       True, on_request=on_request,
+                                       timeout=0.01))
+        self.assertEqual(['1'], self.root.received)
+
+    def test_no_commit(self):
+        source = {'loc': {'migration_address': 'tcp://source'}}
+        snapshot = msgpack.dumps({'received': []})
+        self.assertFalse(self.take_over(source, snapshot, False))
+        self.assertFalse(self.take_over({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
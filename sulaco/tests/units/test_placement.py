@@ -0,0 +1,61 @@
+import unittest
+from sulaco.outer_server.placement import Placement
+
+
+class TestPlacement(unittest.TestCase):
+
+    def setUp(self):
+        self.placement = Placement()
+        self.placement.add('town_1', {'type': 'town'})
+        self.placement.add('town_2', {'type': 'town'})
+        self.placement.add('dungeon', {})
+
+    def test_types(self):
+        self.assertEqual({'town_1', 'town_2'},
+                         self.placement.replicas('town'))
+        self.assertEqual('dungeon', self.placement.choose('dungeon'))
+        self.assertIsNone(self.placement.choose('forest'))
+        self.placement.remove('dungeon')
+        self.assertIsNone(self.placement.choose('dungeon'))
+
+    def test_least_loaded(self):
+        placement = self.placement
+        placement.update({'town_1': {'users': 10, 'queue': 0, 'lag': 0},
+                          'town_2': {'users': 3, 'queue': 2, 'lag': 0.05}})
+        # 3 + 2 + 0.05 * 100 = 10
+        self.assertEqual(10, placement.score('town_2'))
+        chosen = [placement.choose('town') for i in range(6)]
+        # users placed before the next table are counted
+        self.assertEqual(3, chosen.count('town_1'))
+        self.assertEqual(3, chosen.count('town_2'))
+        placement.update({'town_1': {'users': 13}, 'town_2': {'users': 20}})
+        self.assertEqual('town_1', placement.choose('town'))
+
+    def test_unchanged_load(self):
+        placement = self.placement
+        loads = {'town_1': {'users': 1}, 'town_2': {'users': 1}}
+        placement.update(loads)
+        self.assertEqual(2, len({placement.choose('town') for i in range(2)}))
+        placement.update(dict(loads, town_2={'users': 2}))
+        # the user placed to town_1 isn't reported yet
+        self.assertEqual(2, placement.score('town_1'))
+        self.assertEqual(2, placement.score('town_2'))
+
+    def test_lag_only(self):
+        placement = self.placement
+        placement.update({'town_1': {'users': 1, 'queue': 0, 'lag': 0},
+                          'town_2': {'users': 1, 'queue': 0, 'lag': 0}})
+        placement.choose('dungeon')
+        placed = {placement.choose('town') for i in range(2)}
+        self.assertEqual({'town_1', 'town_2'}, placed)
+        placement.update({'town_1': {'users': 1, 'queue': 0,
+                                     'lag': 0.001, 'max_lag': 0.002},
+                          'town_2': {'users': 2, 'queue': 0, 'lag': 0}})
+        self.assertAlmostEqual(2.1, placement.score('town_1'))
+        self.assertEqual(2, placement.score('town_2'))
+        self.assertEqual(1, placement.score('dungeon'))
+
+    def test_move(self):
+        self.placement.add('town_2', {'type': 'castle'})
+        self.assertEqual({'town_1'}, self.placement.replicas('town'))
+        self.assertEqual('town_2', self.placement.choose('castle'))
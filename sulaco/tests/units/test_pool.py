@@ -0,0 +1,125 @@
+import zmq
+import unittest
+import msgpack
+from unittest.mock import Mock, call
+from functools import partial
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from sulaco.location_server.pool import (
+    plan_move, LocationPool, add_location, LOAD_REPORT, MIGRATED_REPORT,
+    ADD_COMMAND, REMOVE_COMMAND)
+
+
+class TestPlanMove(unittest.TestCase):
+
+    def test_balanced(self):
+        workers = [{'a'}, {'b'}]
+        self.assertIsNone(plan_move(workers, {'a': 0.5, 'b': 0.4}, 0.2))
+
+    def test_move(self):
+        workers = [{'a', 'b', 'c'}, {'d'}]
+        loads = {'a': 0.7, 'b': 0.3, 'c': 0.2, 'd': 0.1}
+        self.assertEqual(('a', 0, 1), plan_move(workers, loads, 0.2))
+
+    def test_single_heavy_location(self):
+        workers = [{'a'}, {'b'}]
+        self.assertIsNone(plan_move(workers, {'a': 0.9, 'b': 0.1}, 0.2))
+
+
+class TestLocationPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = LocationPool('config.yaml', 'module:Root',
+                                 ['a', 'b', 'c'], 2, smoothing=0.5)
+        self.pool.worker_locations = [{'a', 'b'}, {'c'}]
+
+    def report(self, index, cpu, busy):
+        self.pool._on_report([msgpack.dumps([LOAD_REPORT, index,
+                                             cpu, busy])])
+
+    def test_report(self):
+        loads = self.pool.loads
+        self.report(0, 0.8, {'a': 3, 'b': 1})
+        self.assertAlmostEqual(0.6, loads['a'])
+        self.assertAlmostEqual(0.2, loads['b'])
+        self.report(0, 0.8, {'a': 1, 'b': 3})
+        self.assertAlmostEqual(0.4, loads['a'])
+        self.assertAlmostEqual(0.4, loads['b'])
+        self.report(1, 0.1, {'c': 0, 'a': 1})
+        self.assertEqual(0, self.pool.loads['c'])
+        self.assertAlmostEqual(0.8, self.pool.worker_load(0))
+
+    def test_failed_migration(self):
+        pool = self.pool
+        pool.live_migration = True
+        pool._controls = [Mock(), Mock()]
+        pool.loads = {'a': 0.3, 'b': 0.1, 'c': 0.05}
+        pool.rebalance()
+        self.assertEqual([{'a'}, {'b', 'c'}], pool.worker_locations)
+        self.assertFalse(pool._controls[0].send.called)
+        pool._on_report([msgpack.dumps([MIGRATED_REPORT, 1, 'b', False])])
+        self.assertEqual([{'a', 'b'}, {'c'}], pool.worker_locations)
+
+    def test_pending_commands(self):
+        pool = self.pool
+        control = Mock()
+        control.send.side_effect = zmq.Again
+        pool._controls = [Mock(), control]
+        pool._send(1, ADD_COMMAND, 'c')
+        pool._send(1, REMOVE_COMMAND, 'c')
+        self.assertEqual(2, len(pool._pending[1]))
+        control.send.side_effect = None
+        self.report(1, 0.1, {'c': 1})
+        self.assertEqual([call(msgpack.dumps([ADD_COMMAND, 'c']), zmq.NOBLOCK),
+                          call(msgpack.dumps([REMOVE_COMMAND, 'c']),
+                               zmq.NOBLOCK)], control.send.call_args_list[2:])
+        self.assertEqual(0, len(pool._pending[1]))
+
+
+class Host(object):
+    """Refuses a location until its registration by a dead worker expires"""
+
+    def __init__(self, ioloop, silence):
+        self.expires = ioloop.time() + silence
+        self.ioloop = ioloop
+        self.attempts = 0
+
+    def add_location_async(self, gateway):
+        self.attempts += 1
+        future = Future()
+        future.set_result(self.ioloop.time() > self.expires)
+        return future
+
+
+class TestAddLocation(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = IOLoop()
+        self.gateways = []
+        self.addCleanup(self.ioloop.close)
+
+    def make_gateway(self, ident):
+        self.gateways.append(Mock())
+        return self.gateways[-1]
+
+    def add(self, host, timeout):
+        return self.ioloop.run_sync(partial(
+            add_location, host, self.make_gateway, 'a', timeout, 0.05,
+            ioloop=self.ioloop))
+
+    def test_restarted_worker(self):
+        host = Host(self.ioloop, 0.3)
+        gateway = self.add(host, 0.4)
+        self.assertIs(self.gateways[-1], gateway)
+        self.assertGreater(host.attempts, 2)
+        for refused in self.gateways[:-1]:
+            refused.root.close.assert_called_once_with()
+        self.assertFalse(gateway.root.close.called)
+
+    def test_timeout(self):
+        gateway = self.add(Host(self.ioloop, 1), 0.2)
+        self.assertIsNone(gateway)
+        self.assertTrue(all(g.root.close.called for g in self.gateways))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import unittest
+import msgpack
+from unittest.mock import Mock, patch
+from sulaco.outer_server.tcp_server import SimpleProtocol, EXTENSION_FRAME
+from sulaco.outer_server.connection_manager import ConnectionHandler
+from sulaco.outer_server.outbound import CONTROL, BULK
+
+
+class Stream(object):
+    """
+    Delivers written data to the peer stream.
+    While blocked, data is kept until flush() like in a full socket.
+    """
+
+    def __init__(self):
+        self.peer = None
+        self.buffer = b''
+        self.reads = []
+        self.written = []
+        self.is_closed = False
+        self.blocked = False
+        self.pending = b''
+        self.write_callback = None
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_bytes(self, num_bytes, callback):
+        self.reads.append((num_bytes, callback))
+        self._process()
+
+    def write(self, data, callback=None):
+        self.written.append(data)
+        self.write_callback = callback
+        self.pending += data
+        if not self.blocked:
+            self.flush()
+
+    def writing(self):
+        return bool(self.pending)
+
+    def flush(self):
+        data, self.pending = self.pending, b''
+        self.peer.buffer += data
+        self.peer._process()
+
+    def flushed(self):
+        self.flush()
+        callback, self.write_callback = self.write_callback, None
+        if callback is not None:
+            callback()
+
+    def _process(self):
+        while self.reads and len(self.buffer) >= self.reads[0][0]:
+            num_bytes, callback = self.reads.pop(0)
+            data, self.buffer = self.buffer[:num_bytes], self.buffer[num_bytes:]
+            callback(data)
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class Protocol(SimpleProtocol):
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.received = []
+
+    def on_message(self, message):
+        self.received.append(message)
+
+    def on_close(self):
+        pass
+
+
+class HandlerProtocol(ConnectionHandler, Protocol):
+    pass
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        client_stream, server_stream = Stream(), Stream()
+        client_stream.peer = server_stream
+        server_stream.peer = client_stream
+        self.client = Protocol(client_stream)
+        self.server = Protocol(server_stream)
+        self.server.compression_threshold = 100
+        self.client.on_open()
+        self.server.on_open()
+        self.large = {'path': 'init', 'kwargs': {'users': ['user'] * 100}}
+        self.small = {'path': 'echo', 'kwargs': {'text': 'hi'}}
+
+    def test_not_negotiated(self):
+        self.server.send(self.large)
+        self.assertTrue(self.server._stream.written[-1].startswith(b'0'))
+        self.assertEqual([self.large], self.client.received)
+
+    def test_negotiated(self):
+        self.client.request_compression()
+        self.assertEqual(100, self.client._compress)
+        self.server.send(self.small)
+        self.assertTrue(self.server._stream.written[-1].startswith(b'0'))
+        self.server.send(self.large)
+        frame = self.server._stream.written[-1]
+        self.assertTrue(frame.startswith(b'z'))
+        self.assertLess(len(frame), 100)
+        self.client.send(self.large)
+        self.assertEqual([self.small, self.large], self.client.received)
+        self.assertEqual([self.large], self.server.received)
+
+    def test_disabled_on_server(self):
+        self.server.compression_threshold = None
+        self.client.request_compression()
+        self.assertIsNone(self.client._compress)
+        self.assertIsNone(self.server._compress)
+
+    def test_compressed_without_negotiation(self):
+        self.client._compress = 10
+        self.client.send(self.large)
+        self.assertEqual([], self.server.received)
+        self.assertTrue(self.server.closed())
+
+    def test_malformed_extension(self):
+        self.client._send_frame(EXTENSION_FRAME, msgpack.dumps([1]))
+        self.assertTrue(self.server.closed())
+
+    def test_wrong_threshold(self):
+        self.client._send_frame(EXTENSION_FRAME, msgpack.dumps(
+                    {'compression': 'zlib', 'reply': True, 'threshold': -1}))
+        self.assertIsNone(self.server._compress)
+        self.assertTrue(self.server.closed())
+
+
+class TestOutboundLanes(unittest.TestCase):
+
+    def setUp(self):
+        client_stream, server_stream = Stream(), Stream()
+        client_stream.peer = server_stream
+        server_stream.peer = client_stream
+        self.client = Protocol(client_stream)
+        self.server = HandlerProtocol(server_stream)
+        self.server.setup(Mock(fanout=None), None)
+        self.client.on_open()
+        self.server.on_open()
+        self.stream = server_stream
+
+    def message(self, path):
+        return {'path': path, 'kwargs': {}}
+
+    def test_priorities(self):
+        self.stream.blocked = True
+        self.server.send(self.message('first'))
+        self.server.send(self.message('bulk'), BULK)
+        self.assertEqual(1, len(self.server._outbound))
+        self.server.send(self.message('normal'))
+        self.server.send(self.message('control'), CONTROL)
+        self.stream.blocked = False
+        self.stream.flushed()
+        self.assertEqual(['first', 'control', 'normal', 'bulk'],
+                         [m['path'] for m in self.client.received])
+        self.assertIsNone(self.server._outbound)
+
+    def test_expiry(self):
+        self.stream.blocked = True
+        self.server.send(self.message('first'))
+        with patch('sulaco.outer_server.outbound.monotonic') as monotonic:
+            monotonic.return_value = 100
+            self.server.send(self.message('stale'), ttl=1)
+            self.server.send(self.message('fresh'), ttl=10)
+            monotonic.return_value = 102
+            self.stream.blocked = False
+            self.stream.flushed()
+        self.assertEqual(['first', 'fresh'],
+                         [m['path'] for m in self.client.received])
+
+    def test_max_queued(self):
+        self.server.max_queued = 2
+        self.stream.blocked = True
+        self.server.send(self.message('first'))
+        self.server.send(self.message('bulk'), BULK)
+        self.server.send(self.message('normal'))
+        self.server.send(self.message('control'), CONTROL)
+        self.stream.blocked = False
+        self.stream.flushed()
+        self.assertEqual(['first', 'control', 'normal'],
+                         [m['path'] for m in self.client.received])
+
+
+if __name__ == '__main__':
+    unittest.main()
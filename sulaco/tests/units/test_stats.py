@@ -0,0 +1,92 @@
+import unittest
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from sulaco.utils.stats import Stats, Histogram, MAX_PATHS, OTHER_PATH
+from sulaco.utils.receiver import message_receiver, ReceiverError
+
+
+class Root(object):
+
+    def __init__(self):
+        self.future = Future()
+
+    @message_receiver()
+    def sync(self):
+        pass
+
+    @message_receiver()
+    def failing(self):
+        raise ValueError('failed')
+
+    @message_receiver()
+    def waiting(self):
+        yield self.future
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        hist = Histogram((1, 10))
+        for value in (0.5, 1, 5, 20):
+            hist.observe(value)
+        self.assertEqual([2, 1, 1], hist.counts)
+        self.assertEqual(4, hist.count)
+        self.assertEqual(20, hist.max)
+        self.assertEqual([
+            'h_bucket{x="y",le="1"} 2',
+            'h_bucket{x="y",le="10"} 3',
+            'h_bucket{x="y",le="+Inf"} 4',
+            'h_sum{x="y"} 26.5',
+            'h_count{x="y"} 4',
+            'h_max{x="y"} 20'], list(hist.lines('h', (('x', 'y'),))))
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = Stats()
+        self.root = Root()
+
+    def test_dispatch(self):
+        pstats = self.stats.path('test', 'sync')
+        pstats.dispatch(self.root, ['sync'], {}, None, 100)
+        self.assertEqual((1, 0), (pstats.calls, pstats.errors))
+        self.assertEqual(1, pstats.latency.count)
+        self.assertEqual(1, pstats.request_bytes.count)
+
+    def test_errors(self):
+        pstats = self.stats.path('test', 'failing')
+        with self.assertRaises(ValueError):
+            pstats.dispatch(self.root, ['failing'], {}, None)
+        with self.assertRaises(ReceiverError):
+            pstats.dispatch(self.root, ['unknown'], {}, None)
+        self.assertEqual((2, 2), (pstats.calls, pstats.errors))
+        self.assertEqual(0, pstats.request_bytes.count)
+
+    def test_coroutine_duration(self):
+        pstats = self.stats.path('test', 'waiting')
+        future = pstats.dispatch(self.root, ['waiting'], {}, None)
+        self.assertEqual(0, pstats.latency.count)
+        self.root.future.set_result(None)
+        IOLoop.instance().run_sync(lambda: future)
+        self.assertEqual(1, pstats.latency.count)
+
+    def test_paths_limit(self):
+        for i in range(MAX_PATHS + 10):
+            self.stats.path('test', str(i)).calls += 1
+        self.assertEqual(10, self.stats.path('test', OTHER_PATH).calls)
+
+    def test_exposition(self):
+        self.stats.incr('requests', topic='a')
+        self.stats.incr('requests', 2, topic='a')
+        self.stats.gauge('connections', lambda: 5)
+        self.stats.path('test', 'sync')
+        text = self.stats.exposition()
+        self.assertIn('requests{topic="a"} 3\n', text)
+        self.assertIn('connections 5\n', text)
+        self.assertIn('sulaco_path_calls_total'
+                      '{component="test",path="sync"} 0\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import Mock
+from sulaco.location_server.sync import StateSync
+
+
+class TestStateSync(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = Mock()
+        self.sync = StateSync(self.gateway, history=2)
+        self.sync.set('user:1', {'x': 0, 'y': 0, 'name': 'a'})
+        self.sync.add_recipient('1')
+
+    def sent(self):
+        self.gateway.private_message.reset_mock()
+        self.sync.flush()
+        if not self.gateway.private_message.called:
+            return None
+        uid, msg = self.gateway.private_message.call_args[0]
+        self.assertEqual('sync', msg['path'])
+        return msg['kwargs']['objects']
+
+    def test_snapshot_then_delta(self):
+        sync = self.sync
+        self.assertEqual([{'name': 'user:1', 'version': 1,
+                           'state': {'x': 0, 'y': 0, 'name': 'a'}}],
+                         self.sent())
+        self.assertIsNone(self.sent())
+        sync.ack('1', {'user:1': 1})
+        sync.update('user:1', {'x': 1, 'name': 'a'})
+        self.assertEqual([{'name': 'user:1', 'base': 1, 'version': 2,
+                           'set': {'x': 1}}], self.sent())
+        # not acknowledged yet, the next delta has both changes
+        sync.unset('user:1', 'name')
+        self.assertEqual([{'name': 'user:1', 'base': 1, 'version': 3,
+                           'set': {'x': 1}, 'unset': ['name']}], self.sent())
+        sync.ack('1', {'user:1': 3})
+        sync.update('user:1', {'y': 5})
+        self.assertEqual([{'name': 'user:1', 'base': 3, 'version': 4,
+                           'set': {'y': 5}}], self.sent())
+
+    def test_gap(self):
+        sync = self.sync
+        self.sent()
+        sync.ack('1', {'user:1': 1})
+        for x in range(1, 4):
+            sync.update('user:1', {'x': x})
+        # history is 2 changes, version 1 is too old for a delta
+        self.assertEqual([{'name': 'user:1', 'version': 4,
+                           'state': {'x': 3, 'y': 0, 'name': 'a'}}],
+                         self.sent())
+        sync.ack('1', {'user:1': 4})
+        sync.resync('1')
+        self.assertEqual(4, self.sent()[0]['version'])
+        self.assertIsNone(self.sent())
+
+    def test_ack(self):
+        sync = self.sync
+        self.sent()
+        sync.ack('1', {'user:1': 5, 'unknown': 1})
+        sync.update('user:1', {'x': 1})
+        self.assertIn('state', self.sent()[0])
+
+    def test_recipients(self):
+        sync = self.sync
+        sync.add_recipient('2', names=['user:2'])
+        sync.set('user:2', {'x': 1})
+        self.gateway.private_message.reset_mock()
+        sync.flush()
+        calls = {c[0][0]: c[0][1]['kwargs']['objects']
+                 for c in self.gateway.private_message.call_args_list}
+        self.assertEqual(['user:1', 'user:2'],
+                         sorted(e['name'] for e in calls['1']))
+        self.assertEqual(['user:2'], [e['name'] for e in calls['2']])
+        sync.remove('user:2')
+        sync.remove_recipient('1')
+        self.assertEqual([{'name': 'user:2', 'removed': True}], self.sent())
+
+
+if __name__ == '__main__':
+    unittest.main()
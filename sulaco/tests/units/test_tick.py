@@ -0,0 +1,109 @@
+import unittest
+import msgpack
+from unittest.mock import Mock
+from sulaco.location_server.gateway import Gateway
+from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN
+
+
+class Root(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.received = []
+
+    @message_receiver(INTERNAL_SIGN)
+    def move(self, uid):
+        self.received.append(uid)
+        self.gateway.prs(uid).moved()
+        self.gateway.pubs.user_moved(uid=uid)
+
+
+class IOLoop(object):
+
+    def __init__(self):
+        self.now = 100
+        self.timeouts = []
+
+    def time(self):
+        return self.now
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return deadline
+
+    def remove_timeout(self, timeout):
+        pass
+
+
+class TestTickScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = Gateway(None, 'loc')
+        self.root = Root(self.gateway)
+        self.gateway.setup(self.root)
+        self.gateway._pub_sock = Mock()
+        self.ioloop = IOLoop()
+        self.system = Mock()
+        self.ticks = self.gateway.enable_ticks(10, [self.system],
+                                               self.ioloop)
+
+    def frame(self, uid):
+        return msgpack.dumps({'path': 'move', 'kwargs': {'uid': uid},
+                              'sign': INTERNAL_SIGN})
+
+    def run_tick(self, duration=0):
+        deadline, callback = self.ioloop.timeouts[-1]
+        self.ioloop.now = deadline
+        self.system.side_effect = lambda dt: setattr(
+                                self.ioloop, 'now', deadline + duration)
+        callback()
+
+    def test_tick(self):
+        self.gateway._receive([self.frame('1'), self.frame('2')])
+        self.gateway._receive([self.frame('1')])
+        self.assertEqual([], self.root.received)
+        self.run_tick()
+        self.assertEqual(['1', '2', '1'], self.root.received)
+        self.assertAlmostEqual(0.1, self.system.call_args[0][0])
+        self.assertFalse(self.gateway._pub_sock.send.called)
+        sent = [args[0] for args, kwargs in
+                self.gateway._pub_sock.send_multipart.call_args_list]
+        self.assertEqual([b'private_message_from_location:loc:1',
+                          b'public_message_from_location:loc',
+                          b'private_message_from_location:loc:2'],
+                         [parts[0] for parts in sent])
+        self.assertEqual([3, 4, 2], [len(parts) for parts in sent])
+
+    def test_overrun(self):
+        self.run_tick(0.25)
+        self.assertEqual(1, self.ticks.overruns)
+        # ticks at 100.2 and 100.3 are skipped
+        self.assertAlmostEqual(100.4, self.ioloop.timeouts[-1][0])
+        self.run_tick(0.05)
+        self.assertEqual(1, self.ticks.overruns)
+        self.assertAlmostEqual(100.5, self.ioloop.timeouts[-1][0])
+
+    def test_migration(self):
+        self.gateway._receive([self.frame('1')])
+        self.gateway.migration = Mock()
+        self.run_tick()
+        self.assertEqual([], self.root.received)
+        self.assertFalse(self.system.called)
+        self.gateway.migration.input.assert_called_once_with(self.frame('1'))
+
+    def test_malformed_input(self):
+        self.gateway._receive([b'\xc1', msgpack.dumps({'path': 'move'}),
+                               self.frame('1')])
+        self.run_tick()
+        self.assertEqual(['1'], self.root.received)
+        self.assertEqual(2, len(self.ioloop.timeouts))
+
+    def test_exception(self):
+        self.gateway.flush_output = Mock(side_effect=ValueError)
+        self.run_tick()
+        self.assertEqual(2, len(self.ioloop.timeouts))
+        self.assertEqual(0, self.ticks.ticks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import random
+import unittest
+from unittest.mock import Mock
+from sulaco.utils.timers import TimerWheel
+from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN
+
+
+class IOLoop(object):
+
+    def __init__(self):
+        self.now = 0
+        self.timeouts = []
+
+    def time(self):
+        return self.now
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return deadline
+
+    def run_until(self, end):
+        while self.timeouts and self.timeouts[0][0] <= end:
+            deadline, callback = self.timeouts.pop(0)
+            self.now = max(self.now, deadline)
+            callback()
+        self.now = end
+
+
+class Root(object):
+
+    def __init__(self):
+        self.received = []
+
+    @message_receiver(INTERNAL_SIGN)
+    def respawn(self, entity):
+        self.received.append(entity)
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = IOLoop()
+        # 2 levels of 4 slots cover 16 ticks
+        self.wheel = TimerWheel(1, slots=4, levels=2, ioloop=self.ioloop)
+
+    def test_random_timers(self):
+        rnd = random.Random(1)
+        fired = []
+        expected = []
+        for i in range(300):
+            delay = rnd.choice((0, 1, 3, 4, 15, 16, 17, 63, 200))
+            if rnd.random() < 0.5:
+                self.ioloop.run_until(self.ioloop.now + rnd.randint(0, 5))
+            now = self.ioloop.now
+            handle = self.wheel.call_later(delay, lambda i=i, now=now:
+                                    fired.append((i, self.ioloop.now - now)))
+            if rnd.random() < 0.2:
+                self.assertTrue(handle.cancel())
+                self.assertFalse(handle.cancel())
+            else:
+                expected.append((i, max(delay, 1)))
+        self.ioloop.run_until(self.ioloop.now + 300)
+        self.assertEqual(sorted(expected), sorted(fired))
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.ioloop.timeouts)
+
+    def test_cancel_from_callback(self):
+        fired = []
+        second = None
+        def first():
+            fired.append(1)
+            second.cancel()
+        self.wheel.call_later(2, first)
+        second = self.wheel.call_later(2, fired.append, 2)
+        self.wheel.call_later(2, fired.append, 3)
+        self.ioloop.run_until(5)
+        self.assertEqual([1, 3], fired)
+        self.assertEqual(0, len(self.wheel))
+
+    def test_senders(self):
+        send = Mock()
+        handle = self.wheel.sender(3, send).cooldown(skill=1)
+        self.wheel.sender(3, send).cooldown(skill=2)
+        handle.cancel()
+        root = Root()
+        self.wheel.loopback(5, root).respawn(entity='a')
+        self.ioloop.run_until(4)
+        send.assert_called_once_with({'path': 'cooldown',
+                                      'kwargs': {'skill': 2}})
+        self.assertEqual([], root.received)
+        self.ioloop.run_until(6)
+        self.assertEqual(['a'], root.received)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import json
+import tempfile
+import unittest
+import msgpack
+from unittest.mock import Mock
+from sulaco.utils import Sender, trace
+from sulaco.utils.trace import Tracer
+from sulaco.utils.trace_report import read_traces, report
+from sulaco.location_server.gateway import Gateway
+from sulaco.outer_server.tcp_server import SimpleProtocol
+from sulaco.outer_server.connection_manager import (
+    ConnectionManager, ConnectionHandler)
+from sulaco.utils.receiver import message_receiver, INTERNAL_SIGN
+
+
+class Protocol(ConnectionHandler, SimpleProtocol):
+    __slots__ = ConnectionHandler.connection_slots
+
+
+class Root(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    @message_receiver(INTERNAL_SIGN)
+    def move(self, uid):
+        self.gateway.prs(uid).moved(x=1)
+
+
+class OuterRoot(object):
+
+    def __init__(self, connman):
+        self.connman = connman
+
+    @message_receiver()
+    def ping(self, conn):
+        self.connman.alls.pong()
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.tracer = Tracer(1, self.path, 'test')
+        Tracer.install(self.tracer)
+
+    def tearDown(self):
+        self.tracer._sink.close()
+        os.remove(self.path)
+        Tracer.install(None)
+        trace.activate(None)
+
+    def records(self):
+        with open(self.path) as f:
+            return [json.loads(l) for l in f]
+
+    def test_sampling(self):
+        self.assertIsNotNone(self.tracer.start('a'))
+        self.tracer.sample_rate = 0
+        self.assertIsNone(self.tracer.start('a'))
+        self.assertEqual('id', self.tracer.start('a', 'id')[0])
+        self.assertIsNone(Tracer().start('a', 'id'))
+
+    def test_sender(self):
+        sent = []
+        s = Sender(sent.append)
+        s.a(x=1)
+        self.assertNotIn('trace', sent[0])
+        context = self.tracer.start('receive')
+        trace.activate(context)
+        s.a(x=1)
+        s.b(x=2)
+        trace.activate(None)
+        self.assertEqual(context, sent[1]['trace'])
+        self.assertIsNot(context, sent[1]['trace'])
+        trace.stamp(sent[1], 'send')
+        self.assertEqual(['receive', 'send'],
+                         [h[0] for h in sent[1]['trace'][1]])
+        self.assertEqual(1, len(sent[2]['trace'][1]))
+        self.assertIsNone(trace.stamp({}, 'send'))
+
+    def test_client_ids(self):
+        connman = ConnectionManager()
+        root = OuterRoot(connman)
+        conns = []
+        for i in range(3):
+            stream = Mock(**{'writing.return_value': False})
+            conn = Protocol(stream)
+            conn.setup(connman, root)
+            conn.on_open()
+            conns.append(conn)
+        self.tracer.sample_rate = 0
+        message = {'path': 'ping', 'kwargs': {}, 'trace': 'id'}
+        conns[0].on_message(dict(message, kwargs={}))
+        self.assertEqual([], self.records())
+        self.tracer.client_ids = True
+        conns[0].on_message(dict(message, kwargs={}))
+        # the broadcast is recorded once
+        self.assertEqual([trace.CLIENT_SEND, trace.OUTER_DONE],
+                         [r['hops'][-1][0] for r in self.records()])
+        self.assertEqual(6, sum(c._stream.write.call_count for c in conns))
+
+    def test_gateway(self):
+        gateway = Gateway(None, 'loc')
+        gateway.setup(Root(gateway))
+        gateway._pub_sock = Mock()
+        context = ['id', [['outer_receive', 1.0]]]
+        gateway._receive([msgpack.dumps({'path': 'move',
+                                         'kwargs': {'uid': '1'},
+                                         'sign': INTERNAL_SIGN,
+                                         'trace': context})])
+        body = gateway._pub_sock.send.call_args_list[-1][0][0]
+        hops = msgpack.loads(body, encoding='utf-8')['trace'][1]
+        self.assertEqual(['outer_receive', trace.LOCATION_RECEIVE,
+                          trace.DISPATCH, trace.LOCATION_PUBLISH],
+                         [h[0] for h in hops])
+        record, = self.records()
+        self.assertEqual('id', record['trace'])
+        self.assertEqual(trace.LOCATION_DONE, record['hops'][-1][0])
+        self.assertIsNone(trace.current())
+
+    def test_report(self):
+        lines = [
+            json.dumps({'trace': 'a', 'hops': [['x', 0], ['y', 0.01]]}),
+            json.dumps({'trace': 'a', 'hops': [['x', 0], ['y', 0.01],
+                                               ['z', 0.03]]}),
+            json.dumps({'trace': 'b', 'hops': [['x', 0], ['y', 0.02]]})]
+        traces = read_traces(lines)
+        self.assertEqual(3, len(traces['a']))
+        result = report(traces)
+        self.assertEqual(2, result['traces'])
+        xy, yz = result['steps']
+        self.assertEqual('x -> y', xy['step'])
+        self.assertEqual(2, xy['count'])
+        self.assertAlmostEqual(15, xy['mean_ms'])
+        self.assertAlmostEqual(20, xy['max_ms'])
+        self.assertEqual('y -> z', yz['step'])
+        self.assertAlmostEqual(30, result['total']['max_ms'])
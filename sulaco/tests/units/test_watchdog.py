@@ -0,0 +1,68 @@
+import time
+import unittest
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from sulaco.utils.receiver import root_dispatch, message_receiver
+from sulaco.utils.watchdog import SlowHandlerWatchdog
+
+
+class Root(object):
+
+    def __init__(self):
+        self.future = Future()
+
+    @message_receiver()
+    def fast(self, **kwargs):
+        pass
+
+    @message_receiver()
+    def slow(self, **kwargs):
+        time.sleep(0.03)
+
+    @message_receiver()
+    def slow_resumption(self):
+        ret = yield self.future
+        time.sleep(0.03)
+        return ret
+
+
+class TestSlowHandlerWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.watchdog = SlowHandlerWatchdog(threshold=0.02)
+        self.watchdog.install()
+        self.root = Root()
+
+    def tearDown(self):
+        self.watchdog.uninstall()
+
+    def test_slow_call(self):
+        root_dispatch(self.root, ['fast'], {}, None)
+        with self.assertLogs('sulaco.utils.watchdog', 'WARNING') as cm:
+            root_dispatch(self.root, ['slow'], {'text': 'x' * 1000}, None)
+        self.assertEqual({'slow': 1}, self.watchdog.counts)
+        record = cm.output[0]
+        self.assertIn('path: slow', record)
+        self.assertIn("text='xxx", record)
+        self.assertIn('time.sleep(0.03)', record)
+        self.assertNotIn('x' * 201, record)
+
+    def test_slow_resumption(self):
+        future = root_dispatch(self.root, ['slow_resumption'], {}, None)
+        self.assertEqual({}, self.watchdog.counts)
+        self.root.future.set_result('result')
+        with self.assertLogs('sulaco.utils.watchdog', 'WARNING'):
+            IOLoop.instance().run_sync(lambda: future)
+        self.assertEqual('result', future.result())
+        self.assertEqual({'slow_resumption': 1}, self.watchdog.counts)
+
+    def test_rate_limit(self):
+        with self.assertLogs('sulaco.utils.watchdog', 'WARNING') as cm:
+            for i in range(3):
+                root_dispatch(self.root, ['slow'], {}, None)
+        self.assertEqual(1, len(cm.output))
+        self.assertEqual({'slow': 3}, self.watchdog.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
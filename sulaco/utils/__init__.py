@@ -8,6 +8,8 @@ from tornado.ioloop import IOLoop
 from tornado.gen import Task
 from tornado.concurrent import return_future
 
+from sulaco.utils import trace
+
 
 class Config(object):
 
@@ -31,8 +33,14 @@ class Config(object):
     def __getitem__(self, name):
         return self._dct[name]
 
+    def get(self, name, default=None):
+        if name not in self._dct:
+            return default
+        return getattr(self, name)
+
 
 class Sender(object):
+    __slots__ = ('_send', '_path')
 
     def __init__(self, send, path=tuple()):
         assert callable(send), send
@@ -44,6 +52,8 @@ class Sender(object):
 
     def __call__(self, **kwargs):
         message = dict(kwargs=kwargs, path='.'.join(self._path))
+        if trace._current is not None:
+            message['trace'] = trace.branch()
         return self._send(message)
 
 
@@ -0,0 +1,116 @@
+import logging
+
+from tornado.ioloop import IOLoop
+
+from sulaco.utils.stats import Stats
+
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5)
+
+
+class LagMonitor(object):
+    """
+    Schedules a timeout every `interval` seconds and measures
+    how late it fires. A busy IOLoop runs timeouts late.
+
+    `lag` is the last measured value, `peak` is the maximum since
+    the last take_peak() (heartbeats report it), all values are
+    observed in the sulaco_ioloop_lag_seconds histogram.
+    Threshold callbacks get the lag when it rises above the threshold
+    and, optionally, when it falls back (e.g. to shed load meanwhile).
+    """
+
+    _instance = None
+
+    def __init__(self, interval=0.1, ioloop=None):
+        self.interval = interval
+        self.lag = 0
+        self.peak = 0
+        self._ioloop = ioloop or IOLoop.instance()
+        self._timeout = None
+        self._expected = None
+        self._thresholds = [] # [threshold, on_exceed, on_recover, exceeded]
+        stats = Stats.instance()
+        self._histogram = stats.histogram('sulaco_ioloop_lag_seconds',
+                                          LAG_BUCKETS)
+        stats.gauge('sulaco_ioloop_lag_last_seconds', lambda: self.lag)
+
+    @classmethod
+    def instance(cls):
+        """ The monitor of the process, it's started if necessary """
+
+        if cls._instance is None:
+            cls._instance = cls()
+        cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def install(cls, monitor):
+        cls._instance = monitor
+
+    @classmethod
+    def from_config(cls, conf, ioloop=None):
+        """ conf has optional interval and warning_threshold (seconds) """
+
+        if conf is None:
+            return cls(ioloop=ioloop)
+        monitor = cls(conf.get('interval', 0.1), ioloop)
+        threshold = conf.get('warning_threshold')
+        if threshold is not None:
+            def warn(lag):
+                logger.warning('IOLoop lag is %.3f seconds', lag)
+            def recover(lag):
+                logger.info('IOLoop lag is back to %.3f seconds', lag)
+            monitor.add_threshold(threshold, warn, recover)
+        return monitor
+
+    @property
+    def started(self):
+        return self._timeout is not None
+
+    def start(self):
+        if self._timeout is None:
+            self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def add_threshold(self, threshold, on_exceed, on_recover=None):
+        self._thresholds.append([threshold, on_exceed, on_recover, False])
+
+    def take_peak(self):
+        """ Returns the maximum lag since the previous call """
+
+        peak, self.peak = self.peak, 0
+        return peak
+
+    def _schedule(self):
+        self._expected = self._ioloop.time() + self.interval
+        self._timeout = self._ioloop.add_timeout(self._expected, self._probe)
+
+    def _probe(self):
+        self.lag = lag = max(0, self._ioloop.time() - self._expected)
+        if lag > self.peak:
+            self.peak = lag
+        self._histogram.observe(lag)
+        for item in self._thresholds:
+            threshold, on_exceed, on_recover, exceeded = item
+            if exceeded == (lag > threshold):
+                continue
+            item[3] = not exceeded
+            if not exceeded:
+                Stats.instance().incr('sulaco_ioloop_lag_exceeded_total',
+                                      threshold=threshold)
+            callback = on_recover if exceeded else on_exceed
+            if callback is None:
+                continue
+            try:
+                callback(lag)
+            except Exception:
+                logger.exception('Exception in lag threshold callback')
+        self._schedule()
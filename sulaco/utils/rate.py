@@ -0,0 +1,50 @@
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average and bursts up to `burst`.
+    Time is passed by the caller to avoid a clock call per bucket.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def consume(self, now, tokens=1):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class KeyedTokenBuckets(object):
+    """ Token bucket per key, idle buckets are dropped by `cleanup` """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    def consume(self, key, now, tokens=1):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate,
+                                                      self.burst, now)
+        return bucket.consume(now, tokens)
+
+    def cleanup(self, now):
+        # a full bucket behaves like a new one
+        self._buckets = {k: b for k, b in self._buckets.items()
+                         if not b.is_full(now)}
+
+    def __len__(self):
+        return len(self._buckets)
@@ -6,7 +6,7 @@ from functools import wraps, partial
 from tornado.ioloop import IOLoop
 from tornado.gen import coroutine
 
-from sulaco.utils import Sender
+from sulaco.utils import Sender, trace
 
 
 MESSAGE_ROUTER = '__message_router__'
@@ -17,6 +17,8 @@ INTERNAL_SIGN = '__internal_sign__'
 INTERNAL_USER_SIGN = '__internal_user_sign__'
 SIGNS = (None, USER_SIGN, INTERNAL_USER_SIGN, INTERNAL_SIGN,)
 
+_watchdog = None
+
 
 class ReceiverError(Exception):
     pass
@@ -145,7 +147,11 @@ def root_dispatch(root, path, kwargs, sign):
                 continue
             error = "Got special kwarg '{}'. Forbidden for users".format(k)
             raise SignError(error)
+    if trace._current is not None:
+        trace.hop(trace._current, trace.DISPATCH)
     func = _dispatch(root, path, kwargs, sign, 0, True)
+    if _watchdog is not None:
+        func = _watchdog.wrap(func, path, sign, kwargs)
     future = coroutine(func)()
     if isinstance(root, LoopbackMixin):
         future.add_done_callback(root.process_loopback_callbacks)
@@ -156,6 +162,16 @@ def root_dispatch(root, path, kwargs, sign):
     return future
 
 
+def set_watchdog(watchdog):
+    """
+    Installs an object which wraps every dispatched handler,
+    see sulaco.utils.watchdog. None removes it.
+    """
+
+    global _watchdog
+    _watchdog = watchdog
+
+
 class LoopbackMixin(object):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,41 @@
+import logging
+import zmq
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from zmq.eventloop.zmqstream import ZMQStream
+
+
+logger = logging.getLogger(__name__)
+
+
+@gen.coroutine
+def request(context, address, parts, timeout=5, retries=2, ioloop=None):
+    """
+    Sends a request to a REP socket without blocking the IOLoop.
+    Every attempt waits `timeout` seconds for the reply on a new
+    socket, since a REQ socket without the reply can't be reused.
+    Resolves to reply parts or None if all attempts time out.
+    """
+
+    ioloop = ioloop or IOLoop.instance()
+    parts = [p.encode('utf-8') if isinstance(p, str) else p for p in parts]
+    for attempt in range(retries + 1):
+        sock = context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(address)
+        stream = ZMQStream(sock, ioloop)
+        reply = Future()
+        stream.on_recv(reply.set_result)
+        stream.send_multipart(parts)
+        try:
+            result = yield gen.with_timeout(ioloop.time() + timeout, reply,
+                                            ioloop)
+            return result
+        except gen.TimeoutError:
+            logger.warning('No reply from %s in %s seconds, attempt %s/%s',
+                           address, timeout, attempt + 1, retries + 1)
+        finally:
+            stream.close()
+    return None
@@ -0,0 +1,195 @@
+import logging
+
+from time import perf_counter
+from bisect import bisect_left
+from tornado.tcpserver import TCPServer
+from tornado.concurrent import is_future
+
+from sulaco.utils.receiver import root_dispatch
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# paths over the limit are accounted together,
+# clients can't blow up memory by sending random paths
+MAX_PATHS = 1000
+OTHER_PATH = '__other__'
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield format_line(name + '_bucket',
+                              labels + (('le', repr(bound)),), cumulative)
+        yield format_line(name + '_bucket', labels + (('le', '+Inf'),),
+                                                                self.count)
+        yield format_line(name + '_sum', labels, self.sum)
+        yield format_line(name + '_count', labels, self.count)
+        yield format_line(name + '_max', labels, self.max)
+
+
+class PathStats(object):
+    """ Accounting of messages that have the same path """
+
+    __slots__ = ('calls', 'errors', 'latency',
+                 'request_bytes', 'response_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+
+    def track(self, size, func, *args):
+        """
+        Calls func and measures it. If func returns a future, it is
+        measured until the future is resolved, so coroutine handlers
+        are timed as a whole.
+        """
+
+        self.calls += 1
+        if size:
+            self.request_bytes.observe(size)
+        start = perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            self.errors += 1
+            self.latency.observe(perf_counter() - start)
+            raise
+        if not is_future(result):
+            self.latency.observe(perf_counter() - start)
+            return result
+        def done(future):
+            self.latency.observe(perf_counter() - start)
+            if future.exception() is not None:
+                self.errors += 1
+        result.add_done_callback(done)
+        return result
+
+    def dispatch(self, root, path, kwargs, sign, size=0):
+        return self.track(size, root_dispatch, root, path, kwargs, sign)
+
+
+class Stats(object):
+    """ Process-wide registry of counters, gauges and histograms """
+
+    _instance = None
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._paths = {}
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, func, **labels):
+        """ Registers a callable that is evaluated on every pull """
+
+        key = (name, tuple(sorted(labels.items())))
+        self._gauges[key] = func
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = Histogram(bounds)
+        return hist
+
+    def path(self, component, path):
+        key = (component, path)
+        pstats = self._paths.get(key)
+        if pstats is not None:
+            return pstats
+        if len(self._paths) >= MAX_PATHS and path != OTHER_PATH:
+            return self.path(component, OTHER_PATH)
+        pstats = self._paths[key] = PathStats()
+        return pstats
+
+    def exposition(self):
+        lines = []
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(format_line(name, labels, value))
+        for (name, labels), func in sorted(self._gauges.items(),
+                                           key=lambda i: i[0]):
+            try:
+                value = func()
+            except Exception:
+                logger.exception("Gauge '%s' failed", name)
+                continue
+            lines.append(format_line(name, labels, value))
+        for (name, labels), hist in sorted(self._histograms.items(),
+                                           key=lambda i: i[0]):
+            lines.extend(hist.lines(name, labels))
+        for (component, path), pstats in sorted(self._paths.items()):
+            labels = (('component', component), ('path', path))
+            lines.append(format_line('sulaco_path_calls_total',
+                                     labels, pstats.calls))
+            lines.append(format_line('sulaco_path_errors_total',
+                                     labels, pstats.errors))
+            lines.extend(pstats.latency.lines('sulaco_path_seconds', labels))
+            lines.extend(pstats.request_bytes.lines(
+                                'sulaco_path_request_bytes', labels))
+            lines.extend(pstats.response_bytes.lines(
+                                'sulaco_path_response_bytes', labels))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def format_line(name, labels, value):
+    if labels:
+        pairs = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                         for k, v in labels)
+        name = '{}{{{}}}'.format(name, pairs)
+    return '{} {}'.format(name, value)
+
+
+class StatsServer(TCPServer):
+    """ Writes the exposition text to every connection and closes it """
+
+    def __init__(self, stats=None, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats or Stats.instance()
+
+    def handle_stream(self, stream, address):
+        data = self._stats.exposition().encode('utf-8')
+        stream.write(data, stream.close)
+
+
+def serve_stats(port, address='127.0.0.1', stats=None):
+    server = StatsServer(stats)
+    server.listen(port, address)
+    logger.info('Stats are served on %s:%s', address, port)
+    return server
@@ -0,0 +1,178 @@
+import logging
+
+from math import ceil
+from functools import partial
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+from sulaco.utils import Sender
+from sulaco.utils.stats import Stats
+from sulaco.utils.receiver import root_dispatch, INTERNAL_SIGN
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle(object):
+    __slots__ = ('expires', 'callback', 'args', 'cancelled', '_wheel',
+                 '_slot')
+
+    def __init__(self, wheel, expires, callback, args):
+        self._wheel = wheel
+        self.expires = expires # tick number
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._slot = None
+
+    def cancel(self):
+        """ Returns False if the timer has already fired or is cancelled """
+
+        if self.cancelled or self._slot is None:
+            return False
+        self.cancelled = True
+        del self._slot[self]
+        self._slot = None
+        self._wheel._count -= 1
+        return True
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel. Time is divided into ticks of
+    `resolution` seconds, timers that expire within `slots` ticks
+    are kept in the slots of the first level, later ones in coarser levels
+    and are moved down when their slot comes. One IOLoop timeout per tick
+    is used while there are pending timers, the work of a tick
+    doesn't depend on the number of pending timers.
+
+    Timers fire no earlier than requested and at most one tick later
+    (later if the IOLoop is busy). Timers beyond the range of the wheel
+    are moved down several times.
+    """
+
+    _instance = None
+
+    def __init__(self, resolution=0.01, slots=64, levels=4, name='default',
+                 ioloop=None):
+        assert slots & (slots - 1) == 0, 'slots should be a power of two'
+        self.resolution = resolution
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._levels = [[{} for i in range(slots)] for l in range(levels)]
+        self._ioloop = ioloop or IOLoop.instance()
+        self._current = None # number of the last processed tick
+        self._count = 0
+        self._timeout = None
+        Stats.instance().gauge('sulaco_timers_pending', lambda: self._count,
+                               wheel=name)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self._ioloop.time() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        if self._current is None:
+            self._current = int(self._ioloop.time() / self.resolution)
+        expires = max(ceil(deadline / self.resolution), self._current + 1)
+        handle = TimerHandle(self, expires, callback, args)
+        self._place(handle)
+        self._count += 1
+        if self._timeout is None:
+            self._schedule()
+        return handle
+
+    def sleep(self, seconds):
+        """ Returns a future for coroutines """
+
+        future = Future()
+        self.call_later(seconds, future.set_result, None)
+        return future
+
+    def sender(self, delay, send):
+        """
+        Returns a sender that calls `send` with the message later,
+        the call returns a handle
+        """
+
+        return Sender(partial(self.call_later, delay, send))
+
+    def loopback(self, delay, root):
+        """ Returns a sender that dispatches the message to the root later """
+
+        def dispatch(message):
+            root_dispatch(root, message['path'].split('.'),
+                          message['kwargs'], INTERNAL_SIGN)
+        return self.sender(delay, dispatch)
+
+    def _place(self, handle):
+        delta = handle.expires - self._current
+        bits = self._bits
+        levels = self._levels
+        top = len(levels) - 1
+        for level in range(top + 1):
+            if delta >> (bits * (level + 1)) == 0:
+                expires = handle.expires
+                break
+        else:
+            # beyond the range, it comes back to the top level later
+            level = top
+            expires = self._current + (1 << (bits * (top + 1))) - 1
+        slot = levels[level][(expires >> (bits * level)) & self._mask]
+        slot[handle] = None
+        handle._slot = slot
+
+    def _schedule(self):
+        deadline = (self._current + 1) * self.resolution
+        self._timeout = self._ioloop.add_timeout(deadline, self._run)
+
+    def _run(self):
+        self._timeout = None
+        target = int(self._ioloop.time() / self.resolution)
+        while self._current < target and self._count:
+            self._tick()
+        if self._count:
+            self._schedule()
+        else:
+            self._current = None
+
+    def _tick(self):
+        self._current = current = self._current + 1
+        bits = self._bits
+        mask = self._mask
+        levels = self._levels
+        # coarser levels first, their timers can go to the first level
+        for level in range(len(levels) - 1, 0, -1):
+            if current & ((1 << (bits * level)) - 1):
+                continue
+            slots = levels[level]
+            index = (current >> (bits * level)) & mask
+            slot = slots[index]
+            if slot:
+                slots[index] = {}
+                for handle in slot:
+                    self._place(handle)
+        slots = levels[0]
+        index = current & mask
+        slot = slots[index]
+        if not slot:
+            return
+        slots[index] = {}
+        for handle in list(slot):
+            if handle._slot is not slot:
+                continue # cancelled by a previous callback
+            del slot[handle]
+            handle._slot = None
+            self._count -= 1
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception('Exception in timer callback')
@@ -0,0 +1,132 @@
+"""
+Sampled tracing of messages across outer servers and locations.
+
+A trace context is [trace id, hops], a hop is [name, unix time].
+It is carried in the 'trace' key of message envelopes ({'path', 'kwargs'}).
+While a traced message is dispatched its context is current: Sender
+attaches a copy of it to every message it builds, transports stamp
+hops on the way, root_dispatch stamps the start of a handler.
+Processes write contexts that end in them (sent to a client or handled)
+to the file sink as JSON lines, see sulaco.utils.trace_report.
+"""
+
+import os
+import json
+import random
+
+from time import time
+from uuid import uuid4
+
+
+OUTER_RECEIVE = 'outer_receive'
+OUTER_DONE = 'outer_done'
+DISPATCH = 'dispatch'
+LOCATION_SEND = 'location_send'
+LOCATION_RECEIVE = 'location_receive'
+LOCATION_PUBLISH = 'location_publish'
+LOCATION_DONE = 'location_done'
+OUTER_LOCATION_RECEIVE = 'outer_location_receive'
+CLIENT_SEND = 'client_send'
+
+_current = None
+
+
+def current():
+    return _current
+
+
+def activate(context):
+    """ Makes the context current and returns the previous one """
+
+    global _current
+    previous = _current
+    _current = context
+    return previous
+
+
+def branch():
+    """ Returns a copy of the current context, hops are added to it """
+
+    return [_current[0], list(_current[1])]
+
+
+def hop(context, name):
+    context[1].append([name, time()])
+
+
+def stamp(message, name):
+    """
+    Adds the hop to the context of the message, a message without it
+    gets a copy of the current context. Returns the context or None.
+    """
+
+    context = message.get('trace')
+    if context is None:
+        if _current is None:
+            return None
+        context = message['trace'] = branch()
+    hop(context, name)
+    return context
+
+
+class Tracer(object):
+    """
+    Starts sampled traces and writes finished ones to the sink.
+    Without a sink traces are neither started nor written.
+    Trace ids sent by clients are used only if `client_ids` is set,
+    otherwise any client could force tracing of its messages.
+    """
+
+    _instance = None
+
+    def __init__(self, sample_rate=0, sink=None, process=None,
+                 client_ids=False):
+        self.sample_rate = sample_rate if sink is not None else 0
+        self.process = process or str(os.getpid())
+        self.client_ids = client_ids
+        self._sink = None
+        if sink is not None:
+            self._sink = open(sink, 'a', buffering=1)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def install(cls, tracer):
+        cls._instance = tracer
+
+    @classmethod
+    def from_config(cls, conf, process=None):
+        if conf is None:
+            return cls()
+        return cls(conf.get('sample_rate', 0), conf.get('sink'), process,
+                   conf.get('client_ids', False))
+
+    @property
+    def enabled(self):
+        return self._sink is not None
+
+    def start(self, name, trace_id=None):
+        """ Returns a new context or None if the trace isn't sampled """
+
+        if trace_id is None:
+            rate = self.sample_rate
+            if not rate or random.random() >= rate:
+                return None
+            trace_id = uuid4().hex[:16]
+        elif self._sink is None:
+            return None
+        else:
+            trace_id = str(trace_id)
+        return [trace_id, [[name, time()]]]
+
+    def finish(self, context, name):
+        hop(context, name)
+        sink = self._sink
+        if sink is not None:
+            sink.write(json.dumps({'trace': context[0],
+                                   'process': self.process,
+                                   'hops': context[1]}) + '\n')
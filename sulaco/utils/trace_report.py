@@ -0,0 +1,92 @@
+"""
+Latency breakdown of traces written by sulaco.utils.trace.
+
+Usage: python -m sulaco.utils.trace_report trace.jsonl [--json]
+
+Prints latency between consecutive hops over all traces, the longest
+record of a trace is used. Timestamps come from different processes,
+so their clocks should be synchronized.
+"""
+
+import json
+import argparse
+
+
+def read_traces(lines):
+    """ Returns the longest record of every trace: id -> hops """
+
+    traces = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        hops = record['hops']
+        known = traces.get(record['trace'])
+        if known is None or len(hops) > len(known):
+            traces[record['trace']] = hops
+    return traces
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(traces):
+    """ Returns latency statistics between consecutive hops in ms """
+
+    steps = {} # (from, to) -> [latencies, positions]
+    totals = []
+    for hops in traces.values():
+        if len(hops) < 2:
+            continue
+        totals.append(hops[-1][1] - hops[0][1])
+        for position, (prev, hop) in enumerate(zip(hops, hops[1:])):
+            step = steps.get((prev[0], hop[0]))
+            if step is None:
+                step = steps[(prev[0], hop[0])] = [[], []]
+            step[0].append(hop[1] - prev[1])
+            step[1].append(position)
+
+    def summary(values):
+        return {'count': len(values),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+                'max_ms': round(max(values) * 1000, 3)}
+
+    ordered = sorted(steps.items(),
+                     key=lambda i: sum(i[1][1]) / len(i[1][1]))
+    result = {'traces': len(totals),
+              'steps': [dict(summary(latencies), step=' -> '.join(step))
+                        for step, (latencies, positions) in ordered]}
+    if totals:
+        result['total'] = summary(totals)
+    return result
+
+
+def main(options):
+    with open(options.path) as f:
+        result = report(read_traces(f))
+    if options.json:
+        print(json.dumps(result, indent=2))
+        return
+    print('traces: {}'.format(result['traces']))
+    row = '{:<48} {:>7} {:>10} {:>10} {:>10} {:>10}'
+    print(row.format('step', 'count', 'mean ms', 'p50 ms', 'p95 ms',
+                     'max ms'))
+    rows = list(result['steps'])
+    if 'total' in result:
+        rows.append(dict(result['total'], step='total'))
+    for step in rows:
+        print(row.format(step['step'], step['count'], step['mean_ms'],
+                         step['p50_ms'], step['p95_ms'], step['max_ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='file sink with traces')
+    parser.add_argument('--json', help='print results as json',
+                        action='store_true', dest='json')
+    main(parser.parse_args())
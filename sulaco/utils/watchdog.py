@@ -0,0 +1,148 @@
+import signal
+import logging
+import traceback
+
+from time import perf_counter
+from types import GeneratorType
+
+from sulaco.utils import receiver
+from sulaco.utils.stats import Stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlowHandlerWatchdog(object):
+    """
+    Times every step of dispatched handlers: the initial call and each
+    resumption of a generator handler. A step that runs longer than
+    the threshold blocks the IOLoop, it is logged with the path, the sign,
+    trimmed kwargs and a stack sample.
+
+    The stack is sampled by SIGALRM while the step is still running
+    (like IOLoop.set_blocking_signal_threshold does), so the watchdog
+    must be installed in the main thread. Without sampling the stack
+    shows where the handler was suspended after the slow step.
+
+    Logging is rate-limited per path; suppressed occurrences are counted
+    and reported with the next record of the path.
+    """
+
+    def __init__(self, threshold=0.05, log_interval=10, kwargs_limit=200,
+                 stack_limit=15, sample_stack=True):
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.kwargs_limit = kwargs_limit
+        self.stack_limit = stack_limit
+        self.sample_stack = sample_stack and hasattr(signal, 'setitimer')
+        self.counts = {} # path -> total number of slow steps
+        self._suppressed = {} # path -> (count, max duration)
+        self._last_logged = {}
+        self._depth = 0
+        self._sample = None
+        self._stats = Stats.instance()
+
+    def install(self):
+        if self.sample_stack:
+            signal.signal(signal.SIGALRM, self._on_alarm)
+        receiver.set_watchdog(self)
+
+    def uninstall(self):
+        receiver.set_watchdog(None)
+        if self.sample_stack:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+    def wrap(self, func, path, sign, kwargs):
+        info = (path, sign, kwargs)
+        def wrapped():
+            start = self._step_started()
+            try:
+                result = func()
+            finally:
+                self._step_finished(start, info, None)
+            if isinstance(result, GeneratorType):
+                return self._timed(result, info)
+            return result
+        return wrapped
+
+    def _timed(self, gen, info):
+        value = None
+        error = None
+        while True:
+            start = self._step_started()
+            try:
+                if error is None:
+                    yielded = gen.send(value)
+                else:
+                    yielded = gen.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self._step_finished(start, info, gen)
+            error = None
+            try:
+                value = yield yielded
+            except GeneratorExit:
+                gen.close()
+                raise
+            except BaseException as e:
+                error = e
+
+    def _step_started(self):
+        self._depth += 1
+        if self._depth == 1 and self.sample_stack:
+            self._sample = None
+            signal.setitimer(signal.ITIMER_REAL, self.threshold)
+        return perf_counter()
+
+    def _step_finished(self, start, info, gen):
+        duration = perf_counter() - start
+        self._depth -= 1
+        if self._depth == 0 and self.sample_stack:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if duration >= self.threshold:
+            self._report(duration, info, gen)
+
+    def _on_alarm(self, signum, frame):
+        if self._depth:
+            self._sample = traceback.extract_stack(frame,
+                                                   limit=self.stack_limit)
+
+    def _report(self, duration, info, gen):
+        path, sign, kwargs = info
+        path = '.'.join(path)
+        self.counts[path] = self.counts.get(path, 0) + 1
+        self._stats.incr('sulaco_slow_handler_steps_total', path=path)
+        now = perf_counter()
+        last = self._last_logged.get(path)
+        if last is not None and now - last < self.log_interval:
+            count, max_duration = self._suppressed.get(path, (0, 0))
+            self._suppressed[path] = (count + 1, max(max_duration, duration))
+            return
+        self._last_logged[path] = now
+        count, max_duration = self._suppressed.pop(path, (0, 0))
+        stack = self._sample
+        if stack is None and gen is not None and gen.gi_frame is not None:
+            stack = traceback.extract_stack(gen.gi_frame,
+                                            limit=self.stack_limit)
+        stack = ''.join(traceback.format_list(stack or []))
+        logger.warning("Slow handler step %.1f ms - path: %s, sign: %s, "
+                       "kwargs: %s, suppressed since last record: %s "
+                       "(max %.1f ms), total: %s\n%s",
+                       duration * 1000, path, sign,
+                       self.trim_kwargs(kwargs), count, max_duration * 1000,
+                       self.counts[path], stack)
+
+    def trim_kwargs(self, kwargs):
+        limit = self.kwargs_limit
+        items = []
+        for k, v in sorted(kwargs.items()):
+            v = repr(v)
+            if len(v) > limit:
+                v = v[:limit] + '...'
+            items.append('{}={}'.format(k, v))
+        text = ', '.join(items)
+        if len(text) > limit * 4:
+            text = text[:limit * 4] + '...'
+        return '{' + text + '}'